@@ -2,6 +2,7 @@
 
 import argparse
 import asyncio
+import errno
 import logging
 import os
 import sys
@@ -12,9 +13,6 @@ import argparse
 import asyncio
 import logging
 
-from multiprocessing import Process
-from multiprocessing import Queue
-
 from joycontrol import utils
 from joycontrol.controller import Controller
 
@@ -25,16 +23,24 @@ import hid
 import joystick
 
 from joycontrol import logging_default as log, utils
+from joycontrol.broadcast import StateBroadcaster
+from joycontrol.capture import FlightRecorder
 from joycontrol.controller import Controller
-from joycontrol.controller_state import ControllerState
-from joycontrol.memory import FlashMemory
+from joycontrol.controller_state import ControllerState, JoyConPairState
+from joycontrol.memory import FlashMemory, share_flash_image, unlink_shared_flash_images
+from joycontrol.pairing import DEFAULT_PATH as PAIRING_CACHE_PATH, PairingCache
 from joycontrol.protocol import controller_protocol_factory
-from joycontrol.server import create_hid_server
+from joycontrol.rumble import EvdevRumbleDevice, RumbleForwarder
+from joycontrol.scheduler import FanOutScheduler, FrameScheduler
+from joycontrol.server import create_hid_server, reconnect_hid_server
+from joycontrol.shared_state import ControlBlock, ControlBlockInput
 
 logger = logging.getLogger(__name__)
 
+EXIT_COMMANDS = ('exit', 'quit', 'q', 'bye', 'shutdown')
+
 
-async def init_relais():
+async def init_relais(id=0):
     # Pro Controller Keymap
     buttons = {
         0: 'b',
@@ -55,29 +61,28 @@ async def init_relais():
         15: 'left',
         16: 'right',
     }
-    if not os.path.exists("/dev/input/js0"):
+    if not os.path.exists("/dev/input/js{}".format(id)):
         logger.warn("Please connect any controller! Waiting...")
 
-    while not os.path.exists("/dev/input/js0"):
+    while not os.path.exists("/dev/input/js{}".format(id)):
         await asyncio.sleep(1)
 
     logger.info("Controller connected.")
-    return buttons, 0
+    return buttons, id
 
 
-async def relais(protocol, controller_state):
+async def relais(controller_state, id=0):
+    """
+    :param id: number of the joystick device (/dev/input/js<id>) to read
+    """
     def normalize(value):
         return max(min(value, 32767), -32767) / 32767
 
-    def clamp(value, minv=0, maxv=4095):
-        return min(max(value, minv), maxv)
-
-    buttons, id = await init_relais()
+    buttons, id = await init_relais(id)
     sticks = (controller_state.l_stick_state, controller_state.r_stick_state)
     logger.info("Polling Joystick...")
     async for event in joystick.joystick_poll(id):
-        if protocol.ended:
-            break
+        # keeps updating the state while a lost connection is restored, see keep_connected
         _timestamp, value, type, number = event
         if type == joystick.EVENT_BUTTON:
             controller_state.button_state.set_button(buttons[number], value)
@@ -85,105 +90,255 @@ async def relais(protocol, controller_state):
             is_vertical = (number & 1)
             stick_state = sticks[number // 2]
             axis = normalize(value)
+            # joystick y axis points down
             if is_vertical:
-                stick_state.set_v(clamp(int((-axis + 1) / 2 * 4095)))
+                stick_state.set_normalized_v(-axis)
             else:
-                stick_state.set_h(clamp(int((axis + 1) / 2 * 4095)))
-        protocol.dirty = True
+                stick_state.set_normalized_h(axis)
     logger.info("Polling Ended")
 
 
-async def send_at_60Hz(protocol):
-    delay_base = 0.0166666667
-    while True:
-        sleep = delay_base
-        if protocol.dirty:
-            start = time.time()
-            if not await protocol.flush():
-                return
-            end = time.time()
-            sleep -= (end - start)
-            protocol.dirty = False
-        await asyncio.sleep(max(sleep, 0))
-    logger.info("Synchronization Ended")
-
-
-async def monitor_throughput(throughput):
+async def monitor_throughput(throughput, rumble=None, fan_out=None):
     while True:
         await asyncio.sleep(3)
         throughput.update()
-        logger.info("{} Packets/sec".format(throughput.counts_sec))
-
-
-
+        logger.info("{} Packets/sec, {} Bytes/sec".format(throughput.counts_sec, throughput.bytes_sec))
+        if rumble is not None:
+            stats = rumble.get_stats()
+            logger.info("Rumble: {} received, {} forwarded, decode {:.1f}us, latency {:.1f}ms (max {:.1f}ms)".format(
+                stats['received'], stats['forwarded'], stats['decode_mean'] * 1e6,
+                stats['latency_mean'] * 1e3, stats['latency_max'] * 1e3))
+        if fan_out is not None:
+            stats = fan_out.get_stats()
+            logger.info("Fan out to {} consoles: {} frames, send skew {:.1f}us (max {:.1f}us)".format(
+                len(fan_out.get_protocols()), stats['fan_out_frames'], stats['skew_mean'] * 1e6,
+                stats['skew_max'] * 1e6))
+
+
+async def keep_connected(protocol, scheduler, reconnect_bt_addr, device_id, ctl_psm, itr_psm, pairing_cache=None,
+                         adapter=None, flight_recorder=None):
+    """
+    Reconnects the protocol whenever its connection is lost. The controller state is kept, held buttons are
+    send again with the first report of the new connection.
+    Returns if the Switch unplugged the virtual cable, its pairing is removed from the pairing cache.
+    :param adapter: adapter of the pairing cache entry, defaults to device_id
+    :param flight_recorder: FlightRecorder of the protocol, kept by the reconnected transports
+    """
+    while True:
+        await protocol.wait_for_connection_lost()
+        if protocol.unplugged:
+            logger.warning("{} was unplugged by the Switch - not reconnecting".format(
+                protocol.controller.device_name()))
+            if pairing_cache is not None:
+                pairing_cache.forget(protocol.controller, device_id if adapter is None else adapter)
+            scheduler.remove(protocol)
+            return
+        logger.warning("{} lost the connection - reconnecting".format(protocol.controller.device_name()))
+        await reconnect_hid_server(protocol, reconnect_bt_addr, ctl_psm=ctl_psm, itr_psm=itr_psm,
+                                   device_id=device_id, flight_recorder=flight_recorder)
+        scheduler.add(protocol)
+        stats = protocol.get_connection_stats()
+        logger.info("Connection {} restored after {:.2f}s (max {:.2f}s)".format(
+            stats['connections'], stats['last_recovery_time'], stats['max_recovery_time']))
+
+
+def start_rumble_forwarding(protocol, id):
+    device_path = joystick.event_device_path(id)
+    if device_path is None:
+        logger.warning("Rumble forwarding disabled - no event device for js{}".format(id))
+        return None
+    try:
+        rumble = RumbleForwarder(EvdevRumbleDevice(device_path))
+    except (ImportError, ValueError, OSError) as err:
+        logger.warning("Rumble forwarding disabled - {}".format(err))
+        return None
+    protocol.set_rumble_listener(rumble.submit)
+    asyncio.ensure_future(rumble.run())
+    return rumble
+
+
+
+
+
+
+async def connect_controller(factory, controller, device_id, pairing_cache, reconnect_bt_addr=None,
+                             ctl_psm=17, itr_psm=19, restart_bluetooth_service=True, adapter=None,
+                             flight_recorder=None):
+    """
+    Reconnects to the Switch of the last pairing if the pairing cache (or reconnect_bt_addr) knows it,
+    pairs otherwise. A new pairing is stored in the cache.
+    :param factory: protocol factory of the controller
+    :param device_id: adapter to bind to, see create_hid_server
+    :param pairing_cache: PairingCache or None
+    :param reconnect_bt_addr: Switch to reconnect to, ignores the pairing cache
+    :param restart_bluetooth_service: see create_hid_server
+    :param adapter: adapter of the pairing cache entry, defaults to device_id
+    :param flight_recorder: FlightRecorder or None, see create_hid_server
+    :returns transport, protocol and True if the controller was paired
+    """
+    if adapter is None:
+        adapter = device_id
+    given_bt_addr = reconnect_bt_addr
+    if reconnect_bt_addr is None and pairing_cache is not None:
+        entry = pairing_cache.lookup(controller, adapter)
+        if entry is not None:
+            reconnect_bt_addr = entry['console']
+            logger.info("Reconnecting {} to {} (paired {})".format(
+                controller.device_name(), reconnect_bt_addr,
+                datetime.fromtimestamp(entry['paired_at']).strftime('%Y-%m-%d %H:%M')))
+
+    if reconnect_bt_addr is not None:
+        try:
+            transport, protocol = await create_hid_server(factory, reconnect_bt_addr=reconnect_bt_addr,
+                                                          ctl_psm=ctl_psm, itr_psm=itr_psm, device_id=device_id,
+                                                          flight_recorder=flight_recorder)
+            return transport, protocol, False
+        except OSError as err:
+            if given_bt_addr is not None:
+                raise
+            logger.warning("Reconnecting to {} failed - {}, pairing again".format(reconnect_bt_addr, err))
+            # only a refusal means the Switch removed the pairing, it may just be switched off or out of range
+            if err.errno == errno.ECONNREFUSED:
+                pairing_cache.forget(controller, adapter)
+
+    print('INFO: Waiting for Switch to connect... Please open the "Change Grip/Order" menu')
+    transport, protocol = await create_hid_server(factory, ctl_psm=ctl_psm, itr_psm=itr_psm, device_id=device_id,
+                                                  restart_bluetooth_service=restart_bluetooth_service,
+                                                  flight_recorder=flight_recorder)
+    if pairing_cache is not None:
+        pairing_cache.store(controller, transport.get_extra_info('peername')[0], adapter=adapter,
+                            adapter_address=transport.get_extra_info('sockname')[0])
+    return transport, protocol, True
+
+
+async def command_loop(controller_state):
+    """
+    Pushes the buttons typed on stdin until one of EXIT_COMMANDS is entered.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        cmd = await loop.run_in_executor(None, input, 'cmd >> ')
+        if cmd in EXIT_COMMANDS:
+            break
+        await test_button(controller_state, cmd)
 
 
+async def relay_input(controller_state):
+    await relais(controller_state)
+    await command_loop(controller_state)
 
-async def _main(args, c, q, reconnect_bt_addr=None):
 
-    # Get controller name to emulate from arguments
-    controller = Controller.PRO_CONTROLLER
+async def _main(args, start_time):
 
-    # prepare the the emulated controller
-    factory = controller_protocol_factory(controller,
-                            reconnect = reconnect_bt_addr)
+    # Get controllers to emulate from arguments, a Joy-Con pair uses two adapters.
+    # A fan out emulates one Pro Controller per adapter, each connected to its own Switch.
+    if args.pair:
+        controllers = ((Controller.JOYCON_L, args.device_id), (Controller.JOYCON_R, args.pair_device_id))
+    else:
+        controllers = tuple((Controller.PRO_CONTROLLER, device_id) for device_id in [args.device_id] + args.fan_out)
 
     ctl_psm, itr_psm = 17, 19
+    pairing_cache = PairingCache(args.pairing_cache) if args.pairing_cache else None
 
-    print('', end='\n' if c else ' ')
+    print()
     print('  Joy Transfer  v0.1')
-    print('INFO: Waiting for Switch to connect...', end='\n' if c else ' ')
-
-    if c < 1:
-        print('Please open the "Change Grip/Order" menu')
 
-    transport, protocol, ns_addr = await create_hid_server(factory,
-                                                  reconnect_bt_addr=reconnect_bt_addr,
-                                                  ctl_psm=ctl_psm,
-                                                  itr_psm=itr_psm,
-                                                  unpair = not reconnect_bt_addr)
-    controller_state = protocol.get_controller_state()
+    protocols, flight_recorders, paired = [], [], False
+    for i, (controller, device_id) in enumerate(controllers):
+        # the flash image is shared by all controllers, only modified pages are private
+        spi_flash = FlashMemory.from_shared(args.flash_image, default_stick_cal=not args.spi_flash)
+        # the consoles of a fan out are driven by the controller state of the first one
+        shared_state = protocols[0].get_controller_state() if args.fan_out and protocols else None
+        factory = controller_protocol_factory(controller, spi_flash=spi_flash, combined=args.pair,
+                                              controller_state=shared_state)
+        # the other consoles of a fan out are known from the pairing cache
+        reconnect_bt_addr = args.reconnect_bt_addr if i == 0 or args.pair else None
+        # one recorder per connection, dumped if it is lost
+        flight_recorder = FlightRecorder(directory=args.flight_recorder) if args.flight_recorder else None
+        _, protocol, new_pairing = await connect_controller(factory, controller, device_id, pairing_cache,
+                                                            reconnect_bt_addr, ctl_psm, itr_psm,
+                                                            flight_recorder=flight_recorder)
+        protocols.append(protocol)
+        flight_recorders.append(flight_recorder)
+        paired = paired or new_pairing
+    ns_addrs = [protocol.transport.get_extra_info('peername')[0] for protocol in protocols]
+
+    if args.pair:
+        controller_state = JoyConPairState(protocols[0].get_controller_state(), protocols[1].get_controller_state())
+    else:
+        controller_state = protocols[0].get_controller_state()
 
     # this is needed
-    await controller_state.connect()
+    await asyncio.gather(*(protocol.sig_set_player_lights.wait() for protocol in protocols))
 
-    if not reconnect_bt_addr:
-        reconnect_bt_addr = ns_addr
-        q.put(ns_addr)
-
-    # wait back home in nintendo switch
-    if c < 1:
-        print('INFO: NINTENDO SWITCH', reconnect_bt_addr)
+    print('INFO: NINTENDO SWITCH', ' '.join(sorted(set(ns_addrs))))
+    if paired:
+        # leave the "Change Grip/Order" menu, the input phase starts right away on the same connection.
+        # If the Switch drops the connection meanwhile, keep_connected reconnects.
         if args.auto:
             controller_state.button_state.set_button('a', pushed=True)
             await controller_state.send()
+            controller_state.button_state.set_button('a', pushed=False)
         else:
             print('INFO: Press the button A or B or HOME')
         print()
 
-        while 1:
-            await asyncio.sleep(0.2)
-    protocol.frequency.value = 0.3
-
-    asyncio.ensure_future(monitor_throughput(protocol.throughput))
-    asyncio.ensure_future(send_at_60Hz(protocol))
-    logger.info("Connected!")
-       
+    # one scheduler sends the reports of all emulated controllers in the same tick,
+    # a fan out encodes the input report once and writes it to all consoles
+    if args.fan_out:
+        scheduler = FanOutScheduler(controller_state, protocols)
+    else:
+        scheduler = FrameScheduler(protocols)
+    # protocols sending their own controller state
+    state_protocols = protocols[:1] if args.fan_out else protocols
+    # rumble of the right Joy-Con is dropped, the physical pad has a single rumble device
+    rumble = start_rumble_forwarding(protocols[0], 0)
+    asyncio.ensure_future(monitor_throughput(protocols[0].throughput, rumble,
+                                             scheduler if args.fan_out else None))
+    # input injected by other processes through shared memory, sampled once per frame
+    if args.control_block:
+        for protocol in state_protocols:
+            scheduler.add_tick_listener(ControlBlockInput(ControlBlock(args.control_block), protocol).tick)
+    # live state for overlays and dashboards, a second Joy-Con gets its own socket
+    broadcasters = []
+    if args.broadcast:
+        for i, protocol in enumerate(state_protocols):
+            broadcaster = StateBroadcaster(protocol.get_controller_state(),
+                                           args.broadcast if i == 0 else f'{args.broadcast}.{i}')
+            await broadcaster.start()
+            scheduler.add_tick_listener(broadcaster.publish)
+            broadcasters.append(broadcaster)
+    # protocols are removed from the scheduler while disconnected and added again after reconnecting
+    scheduler_task = asyncio.ensure_future(scheduler.run(stop_when_empty=False))
+    scheduler_task.add_done_callback(utils.create_error_check_callback(ignore=asyncio.CancelledError))
+    reconnectors = [asyncio.ensure_future(keep_connected(protocol, scheduler, ns_addr, device_id,
+                                                         ctl_psm, itr_psm, pairing_cache,
+                                                         flight_recorder=flight_recorder))
+                    for protocol, ns_addr, (_, device_id), flight_recorder
+                    in zip(protocols, ns_addrs, controllers, flight_recorders)]
+
+    await controller_state.send()
+    logger.info("Connected! Time to first input {:.2f}s ({})".format(
+        time.perf_counter() - start_time, 'new pairing' if paired else 'reconnected'))
+
+    input_task = asyncio.ensure_future(relay_input(controller_state))
     try:
-        await relais(protocol, controller_state)
+        # a controller unplugged by the Switch ends its reconnector and the bridge, it has to pair again
+        done, _ = await asyncio.wait([input_task] + reconnectors, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
     finally:
         logger.info('Stopping communication...')
-        await transport.close()
-    q.put('unlock') # unlock console
-    print('hi :3')
+        input_task.cancel()
+        for reconnector in reconnectors:
+            reconnector.cancel()
+        for broadcaster in broadcasters:
+            await broadcaster.stop()
+        for protocol in protocols:
+            if protocol.transport is not None:
+                await protocol.transport.close()
 
 
-    while 1:
-        cmd = q.get() # wait command
-
-        await test_button(controller_state, cmd)
-        
-
 '''
 NINTENDO SWITCH
     - version 12.1.0
@@ -217,17 +372,10 @@ def handle_exception(loop, context):
     for task in tasks:
         task.cancel()
 
-count = 0
-
-def test(args, c, q, b):
-    try:
-        loop.run_until_complete(
-            _main(args, c, q, b)
-        )
-    except:
-        pass
 
 if __name__ == '__main__':
+    # time to first input is measured from here, a reconnect needs no second interpreter start
+    start_time = time.perf_counter()
 
     # check if root
     if not os.geteuid() == 0:
@@ -238,42 +386,48 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--log')
     parser.add_argument('-d', '--device_id')
     parser.add_argument('--auto', dest='auto', action='store_true')
+    parser.add_argument('--pair', action='store_true',
+                        help='Emulate a combined Joy-Con pair, the left Joy-Con uses --device_id, '
+                             'the right one --pair_device_id')
+    parser.add_argument('--pair_device_id', help='Bluetooth adapter of the right Joy-Con in --pair mode')
+    parser.add_argument('--fan_out', nargs='+', default=[], metavar='DEVICE_ID',
+                        help='Further Bluetooth adapters, each connected to its own Switch. All consoles receive '
+                             'the same input at the same time (see joycontrol.scheduler.FanOutScheduler)')
+    parser.add_argument('--broadcast', help='Unix socket path, subscribers receive live controller state snapshots '
+                                            '(see joycontrol.broadcast)')
+    parser.add_argument('--control_block', help='Name of a shared memory control block to create, other processes '
+                                                'inject input by writing to it (see joycontrol.shared_state)')
+    parser.add_argument('--spi_flash', help='Memory dump of a real Switch controller')
     parser.add_argument('-r', '--reconnect_bt_addr', type=str, default=None,
                         help='The Switch console Bluetooth address (or "auto" for automatic detection), for reconnecting as an already paired controller.')
+    parser.add_argument('--pairing_cache', default=PAIRING_CACHE_PATH,
+                        help='File remembering the Switch of the last pairing per adapter and controller type, '
+                             'used to reconnect without pairing again. Empty to disable')
+    parser.add_argument('--flight_recorder', metavar='DIRECTORY',
+                        help='Keep the last reports in memory, dumped to DIRECTORY if a connection is lost')
     args = parser.parse_args()
+    if args.pair and args.fan_out:
+        parser.error('--fan_out emulates Pro Controllers, it can not be combined with --pair.')
 
-    loop = asyncio.get_event_loop()
-    loop.set_exception_handler(handle_exception)
-
-    queue = Queue()
-
-    cmd = None
-
-    ns_addr = args.reconnect_bt_addr
-    if ns_addr:
-        count = 1
+    # publish the flash image once, every emulated controller attaches to it
+    if args.spi_flash:
+        with open(args.spi_flash, 'rb') as spi_flash_file:
+            args.flash_image = share_flash_image(spi_flash_file.read())
+    else:
+        # blank memory, the default stick calibration is added per controller
+        args.flash_image = share_flash_image(b'\xFF' * 0x80000)
 
-    for _ in range(2 - count):
-        p = Process(target=test, args=(args, count, queue, ns_addr))
-        p.start()
+    control_block = ControlBlock(args.control_block, create=True) if args.control_block else None
 
-        if count < 1:
-            ns_addr = queue.get() # wait nintendo switch address
-            p.join()
-        else:
-            queue.get() # lock console
-
-        while p.is_alive():
-            cmd = input('cmd >> ')
-            if cmd in ['exit', 'quit', 'q', 'bye', 'shutdown']:
-                p.kill()
-                break
-
-            queue.put(cmd)
-            time.sleep(0.2) # not needed
-
-        # wait reconnection
-        time.sleep(2) # important 2 or more
-        count += 1
+    loop = asyncio.get_event_loop()
+    loop.set_exception_handler(handle_exception)
 
+    try:
+        loop.run_until_complete(_main(args, start_time))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        unlink_shared_flash_images()
+        if control_block is not None:
+            control_block.close()
     print("bye")
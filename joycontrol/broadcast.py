@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class _Subscriber:
+    """
+    Connected viewer. Holds only the newest snapshot, older undelivered snapshots are overwritten.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.latest = None
+        self.ready = asyncio.Event()
+        self.task = None
+        # notices a disconnect while there is nothing to deliver
+        self.watch_task = None
+
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, snapshot):
+        if self.latest is not None:
+            self.dropped += 1
+        self.latest = snapshot
+        self.ready.set()
+
+
+class StateBroadcaster:
+    """
+    Publishes controller state snapshots (see ControllerState.pack_snapshot and unpack_snapshot) to local
+    subscribers connected to a Unix socket. The stream consists of back to back SNAPSHOT records.
+
+    Delivery is latest-value-wins: publishing never waits for a subscriber, a slow subscriber just skips
+    snapshots. Register publish() as tick listener of a FrameScheduler (see FrameScheduler.add_tick_listener).
+    """
+
+    def __init__(self, controller_state, path, every_frame=False):
+        """
+        :param controller_state: ControllerState to publish
+        :param path: Unix socket path
+        :param every_frame: True to publish a snapshot every frame, False only after changes
+        """
+        self._controller_state = controller_state
+        self.path = path
+        self.every_frame = every_frame
+
+        self._server = None
+        self._subscribers = []
+        self._published_generation = None
+
+        # statistics
+        self.published = 0
+
+    async def start(self):
+        """
+        Starts accepting subscribers.
+        """
+        if os.path.exists(self.path):
+            # left over from a previous run
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._subscribe, path=self.path)
+        logger.info(f'Broadcasting controller state on {self.path}')
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for subscriber in list(self._subscribers):
+            self._unsubscribe(subscriber)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _subscribe(self, reader, writer):
+        subscriber = _Subscriber(writer)
+        self._subscribers.append(subscriber)
+        subscriber.task = asyncio.ensure_future(self._deliver(subscriber))
+        subscriber.watch_task = asyncio.ensure_future(self._watch(subscriber, reader))
+        # the current state right away
+        subscriber.offer(self._controller_state.pack_snapshot())
+        logger.info(f'State subscriber connected ({len(self._subscribers)} connected)')
+
+    def _unsubscribe(self, subscriber):
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+            subscriber.task.cancel()
+            subscriber.watch_task.cancel()
+            subscriber.writer.close()
+            logger.info(f'State subscriber disconnected ({len(self._subscribers)} connected)')
+
+    async def _deliver(self, subscriber):
+        try:
+            while True:
+                await subscriber.ready.wait()
+                subscriber.ready.clear()
+                snapshot, subscriber.latest = subscriber.latest, None
+                subscriber.writer.write(snapshot)
+                # only this subscriber waits for its socket, the publisher keeps overwriting latest meanwhile
+                await subscriber.writer.drain()
+                subscriber.sent += 1
+        except (ConnectionError, OSError):
+            self._unsubscribe(subscriber)
+
+    async def _watch(self, subscriber, reader):
+        """
+        Subscribers send nothing, the end of the stream means they disconnected.
+        """
+        try:
+            while await reader.read(0x100):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        self._unsubscribe(subscriber)
+
+    def publish(self):
+        """
+        Offers the current state to all subscribers, cheap enough to be called every frame.
+        """
+        generation = self._controller_state.generation
+        if not self._subscribers or (not self.every_frame and generation == self._published_generation):
+            return
+        snapshot = self._controller_state.pack_snapshot()
+        for subscriber in self._subscribers:
+            subscriber.offer(snapshot)
+        self._published_generation = generation
+        self.published += 1
+
+    def get_stats(self):
+        return {
+            'subscribers': len(self._subscribers),
+            'published': self.published,
+            'sent': sum(subscriber.sent for subscriber in self._subscribers),
+            'dropped': sum(subscriber.dropped for subscriber in self._subscribers),
+        }
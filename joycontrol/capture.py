@@ -0,0 +1,573 @@
+import asyncio
+import logging
+import lzma
+import os
+import queue
+import struct
+import threading
+import time
+from array import array
+from datetime import datetime
+import zlib
+
+logger = logging.getLogger(__name__)
+
+"""
+Legacy capture file format (version 1): records of
+    time    8 bytes, double, seconds since the epoch
+    size    4 bytes, int
+    data    size bytes, input report (0xA1...) or output report (0xA2...)
+
+Chunked capture file format (version 2, little endian):
+    file header     magic b'JCCAPT', version (2 bytes)
+    chunks          chunk header b'CHNK', compression (1 byte, see COMPRESSION), compressed size (4 bytes),
+                    uncompressed size (4 bytes), number of records (4 bytes), time of the first and the last
+                    record (2 doubles), followed by the compressed version 1 records
+    index           per chunk: chunk offset (8 bytes), first and last time (2 doubles), number of records
+                    (4 bytes), number of report types (2 bytes), followed by a (report prefix, report id, count)
+                    entry per report type
+    trailer         index offset (8 bytes), number of chunks (4 bytes), magic b'JCIX'
+
+Chunk headers alone are enough to walk the file, the index just saves reading them and adds report type counts.
+A capture without trailer (e.g. after a crash) stays readable, see CaptureReader.
+"""
+
+RECORD_HEADER = struct.Struct('di')
+
+CAPTURE_MAGIC = b'JCCAPT'
+CAPTURE_VERSION = 2
+FILE_HEADER = struct.Struct('<6sH')
+CHUNK_MAGIC = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sBIIIdd')
+INDEX_ENTRY = struct.Struct('<QddIH')
+REPORT_COUNT = struct.Struct('<BBI')
+INDEX_MAGIC = b'JCIX'
+TRAILER = struct.Struct('<QI4s')
+
+COMPRESSION = {
+    'none': 0,
+    'zlib': 1,
+    'lzma': 2,
+}
+
+
+def _compress(compression, data):
+    if compression == COMPRESSION['zlib']:
+        return zlib.compress(data, 6)
+    elif compression == COMPRESSION['lzma']:
+        return lzma.compress(data)
+    return bytes(data)
+
+
+def _decompress(compression, data):
+    if compression == COMPRESSION['zlib']:
+        return zlib.decompress(data)
+    elif compression == COMPRESSION['lzma']:
+        return lzma.decompress(data)
+    elif compression == COMPRESSION['none']:
+        return data
+    raise ValueError(f'Unknown chunk compression {compression}.')
+
+
+def iter_records(data):
+    """
+    :param data: version 1 records
+    :returns generator of (time, report bytes) tuples
+    """
+    offset = 0
+    end = len(data)
+    while offset + RECORD_HEADER.size <= end:
+        _time, size = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + size > end:
+            # truncated record
+            break
+        yield _time, bytes(data[offset:offset + size])
+        offset += size
+
+
+class ChunkInfo:
+    """
+    Position, time range and contents of a chunk of a version 2 capture.
+    """
+
+    def __init__(self, offset, records, start_time, end_time, report_counts=None):
+        """
+        :param offset: file offset of the chunk header
+        :param report_counts: (report prefix, report id) -> number of reports, None if not known
+        """
+        self.offset = offset
+        self.records = records
+        self.start_time = start_time
+        self.end_time = end_time
+        self.report_counts = report_counts
+
+    def overlaps(self, start_time=None, end_time=None):
+        return (start_time is None or self.end_time >= start_time) and \
+               (end_time is None or self.start_time <= end_time)
+
+    def __repr__(self):
+        return f'ChunkInfo(offset={self.offset}, records={self.records}, start_time={self.start_time}, ' \
+               f'end_time={self.end_time})'
+
+
+def encode_chunk(data, compression=COMPRESSION['zlib']):
+    """
+    :param data: version 1 records
+    :param compression: value of COMPRESSION
+    :returns encoded chunk (bytes) and its ChunkInfo with offset 0
+    """
+    records = 0
+    start_time = end_time = 0
+    report_counts = {}
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        _time, size = RECORD_HEADER.unpack_from(data, offset)
+        if records == 0:
+            start_time = _time
+        end_time = _time
+        key = (data[offset + RECORD_HEADER.size], data[offset + RECORD_HEADER.size + 1]) if size >= 2 else (0, 0)
+        report_counts[key] = report_counts.get(key, 0) + 1
+        records += 1
+        offset += RECORD_HEADER.size + size
+
+    payload = _compress(compression, data)
+    header = CHUNK_HEADER.pack(CHUNK_MAGIC, compression, len(payload), len(data), records, start_time, end_time)
+    return header + payload, ChunkInfo(0, records, start_time, end_time, report_counts)
+
+
+def encode_index(chunks, offset):
+    """
+    :param chunks: ChunkInfo objects
+    :param offset: file offset of the index
+    :returns index and trailer (bytes)
+    """
+    index = bytearray()
+    for chunk in chunks:
+        report_counts = chunk.report_counts or {}
+        index += INDEX_ENTRY.pack(chunk.offset, chunk.start_time, chunk.end_time, chunk.records,
+                                  len(report_counts))
+        for (prefix, report_id), count in sorted(report_counts.items()):
+            index += REPORT_COUNT.pack(prefix, report_id, count)
+    index += TRAILER.pack(offset, len(chunks), INDEX_MAGIC)
+    return bytes(index)
+
+
+class CaptureWriter:
+    """
+    Writes reports to a capture file without blocking the event loop.
+
+    Records are packed into a preallocated buffer. Full buffers, and buffers older than flush_interval,
+    are queued to a background thread which writes them in one call each. The number of buffers is fixed:
+    if the disk can not keep up and all buffers are queued, records go on filling the current buffer. Once it is
+    full, new records are dropped and counted instead of delaying the sender.
+
+    write() and close() must be called from the same thread (the event loop).
+    """
+
+    def __init__(self, file, buffer_size=0x10000, buffers=8, flush_interval=1.0):
+        """
+        :param file: opened binary file, it is not closed by the writer
+        :param buffer_size: size of a buffer in bytes, records larger than a buffer are dropped
+        :param buffers: number of preallocated buffers
+        :param flush_interval: seconds after which a partially filled buffer is queued by the next write
+        """
+        if buffers < 2:
+            raise ValueError('At least two buffers are required.')
+        self._file = file
+        self.flush_interval = flush_interval
+
+        self._free = queue.Queue()
+        for _ in range(buffers):
+            self._free.put(bytearray(buffer_size))
+        # (buffer, used bytes) tuples and None to stop the thread, there is always room for all buffers
+        self._pending = queue.Queue(maxsize=buffers + 1)
+        self._buffer = self._free.get_nowait()
+        self._used = 0
+        self._flush_deadline = time.time() + flush_interval
+        self._closed = False
+
+        # statistics
+        self.records = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.bytes_written = 0
+        self.write_errors = 0
+        self._flush_time = 0
+        self.max_flush_latency = 0
+
+        self._thread = threading.Thread(target=self._run, name='capture-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        """
+        Appends a record, never blocks on I/O.
+        :param data: input or output report (bytes)
+        :returns True if the record was buffered, False if it was dropped
+        """
+        now = time.time()
+        size = len(data)
+        offset = self._used
+        end = offset + RECORD_HEADER.size + size
+        if end > len(self._buffer) or now >= self._flush_deadline:
+            if self._closed:
+                self.dropped += 1
+                return False
+            if self._swap(now):
+                offset = 0
+                end = RECORD_HEADER.size + size
+            # no free buffer, only a record which does not fit any more is dropped
+            if end > len(self._buffer):
+                self.dropped += 1
+                return False
+        buffer = self._buffer
+        RECORD_HEADER.pack_into(buffer, offset, now, size)
+        buffer[end - size:end] = data
+        self._used = end
+        self.records += 1
+        return True
+
+    def _swap(self, now):
+        self._flush_deadline = now + self.flush_interval
+        if not self._used:
+            return True
+        try:
+            buffer = self._free.get_nowait()
+        except queue.Empty:
+            return False
+        self._pending.put_nowait((self._buffer, self._used))
+        self._buffer = buffer
+        self._used = 0
+        return True
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+
+            buffer, used = item
+            start = time.perf_counter()
+            try:
+                with memoryview(buffer) as view:
+                    self.bytes_written += self._write_buffer(view[:used])
+                self._file.flush()
+            except (OSError, ValueError) as err:
+                self.write_errors += 1
+                logger.error(f'Writing capture failed - {err}')
+            latency = time.perf_counter() - start
+
+            self.flushes += 1
+            self._flush_time += latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self._free.put(buffer)
+
+        try:
+            self._finish()
+        except (OSError, ValueError) as err:
+            self.write_errors += 1
+            logger.error(f'Finishing capture failed - {err}')
+
+    def _write_buffer(self, records):
+        """
+        Called by the writer thread.
+        :param records: version 1 records
+        :returns number of bytes written
+        """
+        self._file.write(records)
+        return len(records)
+
+    def _finish(self):
+        """
+        Called by the writer thread after the last buffer was written.
+        """
+
+    def close(self):
+        """
+        Stops accepting records and queues the remaining ones, see wait_closed.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._used:
+            self._pending.put_nowait((self._buffer, self._used))
+            self._used = 0
+        self._pending.put_nowait(None)
+
+    def wait_closed(self):
+        """
+        Blocks until all queued records are written.
+        """
+        self._thread.join()
+
+    def get_stats(self):
+        return {
+            'records': self.records,
+            'dropped': self.dropped,
+            'flushes': self.flushes,
+            'bytes_written': self.bytes_written,
+            'write_errors': self.write_errors,
+            'mean_flush_latency': self._flush_time / self.flushes if self.flushes else 0,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+
+class ChunkedCaptureWriter(CaptureWriter):
+    """
+    CaptureWriter of the chunked format (version 2). Every buffer becomes a chunk, compression runs in the
+    writer thread. The index is written by close(), the file has to be new or truncated.
+    """
+
+    def __init__(self, file, compression='zlib', buffer_size=0x40000, buffers=4, flush_interval=10.0):
+        """
+        :param compression: 'none', 'zlib' or 'lzma'
+        :param flush_interval: seconds after which a partially filled buffer becomes a chunk,
+                               the time granularity of the index
+        """
+        if compression not in COMPRESSION:
+            raise ValueError(f'Unknown compression "{compression}", expected one of {", ".join(COMPRESSION)}.')
+        self._compression = COMPRESSION[compression]
+        self._chunks = []
+
+        header = FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION)
+        file.write(header)
+        self._offset = len(header)
+
+        super().__init__(file, buffer_size=buffer_size, buffers=buffers, flush_interval=flush_interval)
+
+    def _write_buffer(self, records):
+        chunk, info = encode_chunk(records, self._compression)
+        self._file.write(chunk)
+        info.offset = self._offset
+        self._chunks.append(info)
+        self._offset += len(chunk)
+        return len(chunk)
+
+    def _finish(self):
+        index = encode_index(self._chunks, self._offset)
+        self._file.write(index)
+        self._file.flush()
+        self.bytes_written += len(index)
+
+
+class CaptureReader:
+    """
+    Reads captures of both formats from a seekable binary file.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        file.seek(0)
+        magic, version = FILE_HEADER.unpack(file.read(FILE_HEADER.size).ljust(FILE_HEADER.size, b'\x00'))
+        if magic == CAPTURE_MAGIC:
+            if version != CAPTURE_VERSION:
+                raise ValueError(f'Unsupported capture version {version}.')
+            self.version = version
+        else:
+            self.version = 1
+        self._chunks = None
+
+    def get_chunks(self):
+        """
+        Reads the index, or the chunk headers if the index is missing.
+        :returns list of ChunkInfo, empty for legacy captures
+        """
+        if self.version == 1:
+            return []
+        if self._chunks is None:
+            self._chunks = self._read_index()
+            if self._chunks is None:
+                logger.warning('Capture has no index, reading chunk headers')
+                self._chunks = self._scan_chunks()
+        return self._chunks
+
+    def _read_index(self):
+        file = self._file
+        size = file.seek(0, os.SEEK_END)
+        if size < FILE_HEADER.size + TRAILER.size:
+            return None
+        file.seek(size - TRAILER.size)
+        offset, count, magic = TRAILER.unpack(file.read(TRAILER.size))
+        if magic != INDEX_MAGIC or offset > size - TRAILER.size:
+            return None
+        file.seek(offset)
+        index = file.read(size - TRAILER.size - offset)
+
+        chunks = []
+        position = 0
+        for _ in range(count):
+            chunk_offset, start_time, end_time, records, types = INDEX_ENTRY.unpack_from(index, position)
+            position += INDEX_ENTRY.size
+            report_counts = {}
+            for _ in range(types):
+                prefix, report_id, report_count = REPORT_COUNT.unpack_from(index, position)
+                position += REPORT_COUNT.size
+                report_counts[prefix, report_id] = report_count
+            chunks.append(ChunkInfo(chunk_offset, records, start_time, end_time, report_counts))
+        return chunks
+
+    def _scan_chunks(self):
+        file = self._file
+        size = file.seek(0, os.SEEK_END)
+        chunks = []
+        offset = FILE_HEADER.size
+        while True:
+            file.seek(offset)
+            header = file.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                break
+            magic, _, compressed_size, _, records, start_time, end_time = CHUNK_HEADER.unpack(header)
+            if magic != CHUNK_MAGIC:
+                # index or garbage
+                break
+            end = offset + CHUNK_HEADER.size + compressed_size
+            if size < end:
+                # chunk was not completely written
+                break
+            chunks.append(ChunkInfo(offset, records, start_time, end_time))
+            offset = end
+        return chunks
+
+    def read_chunk(self, chunk):
+        """
+        :param chunk: ChunkInfo
+        :returns decompressed version 1 records of the chunk
+        """
+        self._file.seek(chunk.offset)
+        magic, compression, compressed_size, size, *_ = CHUNK_HEADER.unpack(self._file.read(CHUNK_HEADER.size))
+        if magic != CHUNK_MAGIC:
+            raise ValueError(f'No chunk at offset {chunk.offset}.')
+        data = _decompress(compression, self._file.read(compressed_size))
+        if len(data) != size:
+            raise ValueError(f'Chunk at offset {chunk.offset} is corrupted.')
+        return data
+
+    def records(self, start_time=None, end_time=None):
+        """
+        :param start_time: skip records before this time (seconds since the epoch)
+        :param end_time: stop at records after this time
+        :returns generator of (time, report bytes) tuples
+        """
+        if self.version == 1:
+            self._file.seek(0)
+            for _time, data in self._read_legacy():
+                if end_time is not None and _time > end_time:
+                    break
+                if start_time is None or _time >= start_time:
+                    yield _time, data
+            return
+
+        for chunk in self.get_chunks():
+            # chunks outside of the range are not decompressed
+            if not chunk.overlaps(start_time, end_time):
+                continue
+            for _time, data in iter_records(self.read_chunk(chunk)):
+                if (start_time is None or _time >= start_time) and (end_time is None or _time <= end_time):
+                    yield _time, data
+
+    def _read_legacy(self):
+        while True:
+            header = self._file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            _time, size = RECORD_HEADER.unpack(header)
+            data = self._file.read(size)
+            if len(data) < size:
+                break
+            yield _time, data
+
+
+class FlightRecorder:
+    """
+    Keeps the last reports of both directions in a preallocated ring buffer, to be dumped in the capture format
+    after a failure. Recording a report is a slice copy into a fixed slot, no allocations and no I/O.
+    """
+
+    def __init__(self, capacity=2048, slot_size=400, directory=None):
+        """
+        :param capacity: number of reports kept
+        :param slot_size: maximum report size, longer reports are truncated
+        :param directory: directory of the dumps, defaults to the working directory
+        """
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.directory = directory
+
+        self._data = bytearray(capacity * slot_size)
+        self._times = array('d', bytes(8 * capacity))
+        self._sizes = array('H', bytes(2 * capacity))
+        self._index = 0
+        self._count = 0
+
+        # offset of the wall clock to time.monotonic(), records use the monotonic clock
+        self._epoch_offset = time.time() - time.monotonic()
+
+    def record(self, data):
+        """
+        :param data: input or output report (bytes)
+        """
+        index = self._index
+        size = len(data)
+        if size > self.slot_size:
+            size = self.slot_size
+            data = data[:size]
+        offset = index * self.slot_size
+        self._data[offset:offset + size] = data
+        self._sizes[index] = size
+        self._times[index] = time.monotonic()
+
+        self._index = (index + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._index = 0
+        self._count = 0
+
+    def records(self):
+        """
+        :returns list of (wall clock time, report bytes) tuples, oldest first
+        """
+        start = (self._index - self._count) % self.capacity
+        records = []
+        for i in range(self._count):
+            index = (start + i) % self.capacity
+            offset = index * self.slot_size
+            records.append((self._times[index] + self._epoch_offset,
+                            bytes(self._data[offset:offset + self._sizes[index]])))
+        return records
+
+    def _serialize(self):
+        return b''.join(RECORD_HEADER.pack(_time, len(data)) + data for _time, data in self.records())
+
+    def _get_path(self, reason):
+        name = f'flight-{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}-{reason}.capture'
+        return os.path.join(self.directory, name) if self.directory else name
+
+    def _write(self, path, data):
+        with open(path, 'wb') as dump_file:
+            dump_file.write(data)
+        logger.info(f'Flight recorder: {len(data)} bytes dumped to {path}')
+
+    def dump(self, reason='manual', path=None):
+        """
+        Writes the recorded reports in the capture format.
+        :param reason: part of the generated file name
+        :param path: file to write, generated in the dump directory if None
+        :returns path of the dump
+        """
+        path = path or self._get_path(reason)
+        self._write(path, self._serialize())
+        return path
+
+    async def dump_async(self, reason='manual', path=None):
+        """
+        Takes a snapshot of the recorded reports and writes it using the default executor.
+        :returns path of the dump
+        """
+        path = path or self._get_path(reason)
+        await asyncio.get_event_loop().run_in_executor(None, self._write, path, self._serialize())
+        return path
@@ -1,11 +1,91 @@
 import asyncio
+import math
+import struct
 
-from joycontrol import utils
 from joycontrol.controller import Controller
 from joycontrol.memory import FlashMemory
+from joycontrol.nfc_tag import NFCTag
+
+
+# Button names by bit of the 24 bit button status (byte 1 = bits 0-7, byte 2 = bits 8-15, byte 3 = bits 16-23)
+BUTTON_BITS = (
+    'y', 'x', 'b', 'a', 'sr', 'sl', 'r', 'zr',
+    'minus', 'plus', 'r_stick', 'l_stick', 'home', 'capture', None, None,
+    'down', 'up', 'right', 'left', 'sr', 'sl', 'l', 'zl',
+)
+
+_AVAILABLE_BUTTONS = {
+    Controller.PRO_CONTROLLER: {'y', 'x', 'b', 'a', 'r', 'zr',
+                                'minus', 'plus', 'r_stick', 'l_stick', 'home', 'capture',
+                                'down', 'up', 'right', 'left', 'l', 'zl'},
+    Controller.JOYCON_R: {'y', 'x', 'b', 'a', 'sr', 'sl', 'r', 'zr',
+                          'plus', 'r_stick', 'home'},
+    Controller.JOYCON_L: {'minus', 'l_stick', 'capture',
+                          'down', 'up', 'right', 'left', 'sr', 'sl', 'l', 'zl'},
+}
+
+
+def _button_masks(controller):
+    # sr and sl exist twice, in byte 1 for the right and in byte 3 for the left Joy-Con
+    sr_sl_byte = 2 if controller == Controller.JOYCON_L else 0
+    return {name: 1 << bit for bit, name in enumerate(BUTTON_BITS)
+            if name in _AVAILABLE_BUTTONS[controller] and (name not in ('sr', 'sl') or bit // 8 == sr_sl_byte)}
+
+
+# button name to bit mask for each controller
+BUTTON_MASKS = {controller: _button_masks(controller) for controller in Controller}
+AVAILABLE_BUTTON_MASKS = {controller: sum(masks.values()) for controller, masks in BUTTON_MASKS.items()}
+
+# indices of the set bits of every byte value, see ControllerState._buttons_changed
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(0x100))
+
+
+class StateDiff:
+    """
+    Changes of a controller state between two generations, see ControllerState.changes_since
+    """
+    def __init__(self, generation, buttons, l_stick, r_stick):
+        # current generation of the state
+        self.generation = generation
+        # names of the changed buttons
+        self.buttons = buttons
+        # True if the stick changed
+        self.l_stick = l_stick
+        self.r_stick = r_stick
+
+    def __bool__(self):
+        return bool(self.buttons) or self.l_stick or self.r_stick
+
+    def __str__(self):
+        return f'generation:{self.generation} buttons:{self.buttons} l_stick:{self.l_stick} r_stick:{self.r_stick}'
+
+
+# Compact binary snapshot of a controller state (see ControllerState.pack_snapshot), little endian:
+# controller (1 byte), generation (4 bytes), buttons mask (4 bytes, see BUTTON_BITS),
+# raw left stick h, v and right stick h, v (2 bytes each, 0xFFFF if the controller has no such stick)
+SNAPSHOT = struct.Struct('<BIIHHHH')
+
+NO_STICK = 0xFFFF
+
+
+def unpack_snapshot(data):
+    """
+    :returns controller, generation, buttons mask, left stick (h, v) and right stick (h, v) or None
+    """
+    controller, generation, buttons, l_h, l_v, r_h, r_v = SNAPSHOT.unpack(data)
+    return (Controller(controller), generation, buttons,
+            None if l_h == NO_STICK else (l_h, l_v),
+            None if r_h == NO_STICK else (r_h, r_v))
 
 
 class ControllerState:
+    """
+    Buttons and sticks of the emulated controller.
+
+    Every change of the button or stick states increments the generation number.
+    Senders and observers remember the generation they have processed and use changes_since
+    to find out what changed, changes can't be missed this way.
+    """
     def __init__(self, protocol, controller: Controller, spi_flash: FlashMemory = None):
         self._protocol = protocol
         self._controller = controller
@@ -13,7 +93,17 @@ class ControllerState:
 
         self._spi_flash = spi_flash
 
-        self.button_state = ButtonState(controller)
+        self._generation = 0
+        # generation of the last change per button bit and stick
+        self._button_generations = [0] * 24
+        self._l_stick_generation = 0
+        self._r_stick_generation = 0
+        # cached result of pack_snapshot
+        self._snapshot = None
+        self._snapshot_generation = -1
+
+        self.button_state = ButtonState(controller, on_change=self._buttons_changed)
+        self._button_bits = tuple((mask.bit_length() - 1, name) for name, mask in BUTTON_MASKS[controller].items())
 
         # create left stick state
         self.l_stick_state = self.r_stick_state = None
@@ -26,7 +116,7 @@ class ControllerState:
                     calibration_data = spi_flash.get_factory_l_stick_calibration()
                 calibration = LeftStickCalibration.from_bytes(calibration_data)
 
-            self.l_stick_state = StickState(calibration=calibration)
+            self.l_stick_state = StickState(calibration=calibration, on_change=self._l_stick_changed)
             if calibration is not None:
                 self.l_stick_state.set_center()
 
@@ -41,12 +131,65 @@ class ControllerState:
                 calibration = RightStickCalibration.from_bytes(
                     calibration_data)
 
-            self.r_stick_state = StickState(calibration=calibration)
+            self.r_stick_state = StickState(calibration=calibration, on_change=self._r_stick_changed)
             if calibration is not None:
                 self.r_stick_state.set_center()
 
         self.sig_is_send = asyncio.Event()
 
+    @property
+    def generation(self):
+        """
+        Monotonically increasing number, incremented by every change of the buttons or sticks
+        """
+        return self._generation
+
+    def _buttons_changed(self, mask):
+        generation = self._generation = self._generation + 1
+        generations = self._button_generations
+        if not mask & (mask - 1):
+            # a single button
+            generations[mask.bit_length() - 1] = generation
+            return
+        offset = 0
+        while mask:
+            for bit in _BYTE_BITS[mask & 0xFF]:
+                generations[offset + bit] = generation
+            mask >>= 8
+            offset += 8
+
+    def _l_stick_changed(self):
+        self._generation += 1
+        self._l_stick_generation = self._generation
+
+    def _r_stick_changed(self):
+        self._generation += 1
+        self._r_stick_generation = self._generation
+
+    def changes_since(self, generation):
+        """
+        :param generation: previously seen generation number
+        :returns StateDiff of all buttons and sticks changed after the given generation
+        """
+        if generation >= self._generation:
+            return StateDiff(self._generation, [], False, False)
+        buttons = [name for bit, name in self._button_bits if self._button_generations[bit] > generation]
+        return StateDiff(self._generation, buttons,
+                         self._l_stick_generation > generation, self._r_stick_generation > generation)
+
+    def pack_snapshot(self):
+        """
+        :returns SNAPSHOT bytes of the current state, only packed again after a change
+        """
+        if self._snapshot_generation != self._generation:
+            l_stick, r_stick = self.l_stick_state, self.r_stick_state
+            self._snapshot = SNAPSHOT.pack(
+                self._controller.value, self._generation & 0xFFFFFFFF, self.button_state.get_mask(),
+                NO_STICK if l_stick is None else l_stick.get_h(), NO_STICK if l_stick is None else l_stick.get_v(),
+                NO_STICK if r_stick is None else r_stick.get_h(), NO_STICK if r_stick is None else r_stick.get_v())
+            self._snapshot_generation = self._generation
+        return self._snapshot
+
     def get_controller(self):
         return self._controller
 
@@ -54,6 +197,11 @@ class ControllerState:
         return self._spi_flash
 
     def set_nfc(self, nfc_content):
+        """
+        :param nfc_content: NFCTag, 540 bytes of NTAG215 data or None to remove the tag
+        """
+        if nfc_content is not None and not isinstance(nfc_content, NFCTag):
+            nfc_content = NFCTag(nfc_content)
         self._nfc_content = nfc_content
 
     def get_nfc(self):
@@ -73,6 +221,91 @@ class ControllerState:
         await self._protocol.sig_set_player_lights.wait()
 
 
+class JoyConPairState:
+    """
+    Controller states of a combined Joy-Con pair, driven like a single controller.
+    Buttons are routed to the Joy-Con they belong to, the sticks are the ones of the left and right Joy-Con.
+    """
+
+    def __init__(self, left: ControllerState, right: ControllerState):
+        if left.get_controller() != Controller.JOYCON_L or right.get_controller() != Controller.JOYCON_R:
+            raise ValueError('A Joy-Con pair consists of a left and a right Joy-Con.')
+        self.left = left
+        self.right = right
+
+        self.button_state = _PairButtonState(left.button_state, right.button_state)
+        self.l_stick_state = left.l_stick_state
+        self.r_stick_state = right.r_stick_state
+
+    @property
+    def generation(self):
+        return self.left.generation + self.right.generation
+
+    async def send(self):
+        """
+        Returns after the state of both Joy-Cons was send.
+        """
+        await asyncio.gather(self.left.send(), self.right.send())
+
+    async def connect(self):
+        """
+        Waits until the Switch accepts button commands from both Joy-Cons.
+        """
+        await asyncio.gather(self.left.connect(), self.right.connect())
+
+
+class _PairButtonState:
+    """
+    Routes button changes to the ButtonState of the left or right Joy-Con.
+    SL and SR exist on both Joy-Cons and are set on both.
+    """
+
+    def __init__(self, left, right):
+        self._sides = (left, right)
+
+    def _split(self, buttons):
+        if isinstance(buttons, str):
+            buttons = (buttons,)
+        split = ([], [])
+        for button in buttons:
+            found = False
+            for names, side in zip(split, self._sides):
+                if button in side.get_available_buttons():
+                    names.append(button)
+                    found = True
+            if not found:
+                raise ValueError(f'Given button "{button}" is not available to a Joy-Con pair.')
+        return split
+
+    def set_button(self, button, pushed=True):
+        self.set_buttons((button,), pushed)
+
+    def get_button(self, button):
+        return any(side.get_button(button) for side in self._sides if button in side.get_available_buttons())
+
+    def set_buttons(self, buttons, pushed=True):
+        """
+        :param buttons: iterable of button names
+        """
+        for names, side in zip(self._split(buttons), self._sides):
+            if names:
+                side.set_buttons(names, pushed)
+
+    def replace_buttons(self, buttons):
+        for names, side in zip(self._split(buttons), self._sides):
+            side.replace_buttons(names)
+
+    def get_pushed_buttons(self):
+        return sorted(set(self._sides[0].get_pushed_buttons()) | set(self._sides[1].get_pushed_buttons()))
+
+    def get_available_buttons(self):
+        return self._sides[0].get_available_buttons() | self._sides[1].get_available_buttons()
+
+    def clear(self):
+        for side in self._sides:
+            side.clear()
+
+
 class ButtonState:
     """
     Utility class to set buttons in the input report
@@ -82,114 +315,161 @@ class ButtonState:
     2       Minus 	Plus 	R Stick L Stick Home 	Capture
     3       Down 	Up 	    Right 	Left 	SR 	    SL 	    L 	    ZL
 
-    Example for generated methods: home button (byte_2, 4)
+    The three bytes are stored as one 24 bit integer (byte 1 = bits 0-7), see BUTTON_BITS.
+    Buttons can be changed one by one or many at once using masks or iterables of names:
+
+        button_state.set_button('a')
+        button_state.set_buttons(('a', 'b'))
+        button_state.set_buttons(button_state.to_mask(('a', 'b')), pushed=False)
+        button_state.replace_buttons({'x', 'zr'})
 
-    def home(self, pushed=True):
-        if pushed != utils.get_bit(self.byte_2, 4):
-            self.byte_2 = utils.flip_bit(self.byte_2, 4)
+    For compatibility, every available button also has a setter and getter, e.g. for the home button:
 
-    def home_is_set(self):
-        return get_bit(self.byte_2, 4)
+        button_state.home(pushed=True)
+        button_state.home_is_set()
     """
 
-    def __init__(self, controller: Controller):
+    def __init__(self, controller: Controller, on_change=None):
+        """
+        :param on_change: function called with the mask of changed bits (see BUTTON_BITS) after every change
+        """
         self.controller = controller
-
-        # 3 bytes
-        self._byte_1 = 0
-        self._byte_2 = 0
-        self._byte_3 = 0
-
-        # generating methods for each button
-        def button_method_factory(byte, bit):
-            def setter(pushed=True):
-                _byte = getattr(self, byte)
-
-                if pushed != utils.get_bit(_byte, bit):
-                    setattr(self, byte, utils.flip_bit(_byte, bit))
-
-            def getter():
-                return utils.get_bit(getattr(self, byte), bit)
-            return setter, getter
-
-        if self.controller == Controller.PRO_CONTROLLER:
-            self._available_buttons = {'y', 'x', 'b', 'a', 'r', 'zr',
-                                       'minus', 'plus', 'r_stick', 'l_stick', 'home', 'capture',
-                                       'down', 'up', 'right', 'left', 'l', 'zl'}
-        elif self.controller == Controller.JOYCON_R:
-            self._available_buttons = {'y', 'x', 'b', 'a', 'sr', 'sl', 'r', 'zr',
-                                       'plus', 'r_stick', 'home'}
-        elif self.controller == Controller.JOYCON_L:
-            self._available_buttons = {'minus', 'l_stick', 'capture',
-                                       'down', 'up', 'right', 'left', 'sr', 'sl', 'l', 'zl'}
-
-        # byte 1
-        if self.controller == Controller.PRO_CONTROLLER or self.controller == Controller.JOYCON_R:
-            self.y, self.y_is_set = button_method_factory('_byte_1', 0)
-            self.x, self.x_is_set = button_method_factory('_byte_1', 1)
-            self.b, self.b_is_set = button_method_factory('_byte_1', 2)
-            self.a, self.a_is_set = button_method_factory('_byte_1', 3)
-
-            if self.controller == Controller.JOYCON_R:
-                self.sr, self.sr_is_set = button_method_factory('_byte_1', 4)
-                self.sl, self.sl_is_set = button_method_factory('_byte_1', 5)
-
-            self.r, self.r_is_set = button_method_factory('_byte_1', 6)
-            self.zr, self.zr_is_set = button_method_factory('_byte_1', 7)
-
-        # byte 2
-        self.minus, self.minus_is_set = button_method_factory('_byte_2', 0)
-        self.plus, self.plus_is_set = button_method_factory('_byte_2', 1)
-        self.r_stick, self.r_stick_is_set = button_method_factory('_byte_2', 2)
-        self.l_stick, self.l_stick_is_set = button_method_factory('_byte_2', 3)
-        if self.controller == Controller.JOYCON_R or self.controller == Controller.PRO_CONTROLLER:
-            self.home, self.home_is_set = button_method_factory('_byte_2', 4)
-        if self.controller == Controller.JOYCON_L or self.controller == Controller.PRO_CONTROLLER:
-            self.capture, self.capture_is_set = button_method_factory(
-                '_byte_2', 5)
-
-        # byte 3
-        if self.controller == Controller.PRO_CONTROLLER or self.controller == Controller.JOYCON_L:
-            self.down, self.down_is_set = button_method_factory('_byte_3', 0)
-            self.up, self.up_is_set = button_method_factory('_byte_3', 1)
-            self.right, self.right_is_set = button_method_factory('_byte_3', 2)
-            self.left, self.left_is_set = button_method_factory('_byte_3', 3)
-
-            if self.controller == Controller.JOYCON_L:
-                self.sr, self.sr_is_set = button_method_factory('_byte_3', 4)
-                self.sl, self.sl_is_set = button_method_factory('_byte_3', 5)
-
-            self.l, self.l_is_set = button_method_factory('_byte_3', 6)
-            self.zl, self.zl_is_set = button_method_factory('_byte_3', 7)
+        self._on_change = on_change
+        self._masks = BUTTON_MASKS[controller]
+        self._available_mask = AVAILABLE_BUTTON_MASKS[controller]
+        self._buttons = 0
+
+    def __getattr__(self, name):
+        # only called if the attribute does not exist, resolves the per button methods
+        masks = self.__dict__.get('_masks')
+        if masks is not None:
+            if name.endswith('_is_set') and name[:-7] in masks:
+                mask = masks[name[:-7]]
+                return lambda: self._buttons & mask != 0
+            elif name in masks:
+                mask = masks[name]
+                return lambda pushed=True: self.set_buttons(mask, pushed)
+        raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
+
+    def _update(self, buttons):
+        changed = buttons ^ self._buttons
+        if changed:
+            self._buttons = buttons
+            if self._on_change is not None:
+                self._on_change(changed)
+
+    def to_mask(self, buttons):
+        """
+        :param buttons: bit mask or iterable of button names
+        :returns bit mask of the given buttons
+        """
+        if isinstance(buttons, int):
+            if buttons & ~self._available_mask:
+                raise ValueError(f'Mask {buttons:06x} contains buttons not available to '
+                                 f'{self.controller.device_name()}.')
+            return buttons
+        if isinstance(buttons, str):
+            buttons = (buttons,)
+        mask = 0
+        masks = self._masks
+        for button in buttons:
+            try:
+                mask |= masks[button]
+            except KeyError:
+                raise ValueError(
+                    f'Given button "{button}" is not available to {self.controller.device_name()}.')
+        return mask
 
     def set_button(self, button, pushed=True):
-        if button not in self._available_buttons:
+        mask = self._masks.get(button)
+        if mask is None:
             raise ValueError(
                 f'Given button "{button}" is not available to {self.controller.device_name()}.')
-        getattr(self, button)(pushed=pushed)
+        # _update inlined, this is the hot path of the input relays
+        buttons = self._buttons
+        if pushed:
+            if buttons & mask:
+                return
+            self._buttons = buttons | mask
+        else:
+            if not buttons & mask:
+                return
+            self._buttons = buttons & ~mask
+        if self._on_change is not None:
+            self._on_change(mask)
 
     def get_button(self, button):
-        if button not in self._available_buttons:
+        mask = self._masks.get(button)
+        if mask is None:
             raise ValueError(
                 f'Given button "{button}" is not available to {self.controller.device_name()}.')
-        return getattr(self, f'{button}_is_set')()
+        return self._buttons & mask != 0
+
+    def set_buttons(self, buttons, pushed=True):
+        """
+        Pushes or releases many buttons at once, other buttons are not changed.
+        :param buttons: bit mask or iterable of button names
+        """
+        mask = self.to_mask(buttons)
+        self._update(self._buttons | mask if pushed else self._buttons & ~mask)
+
+    def replace_buttons(self, buttons):
+        """
+        Pushes exactly the given buttons and releases all others.
+        :param buttons: bit mask or iterable of button names
+        """
+        self._update(self.to_mask(buttons))
+
+    def get_mask(self):
+        """
+        :returns bit mask of all pushed buttons
+        """
+        return self._buttons
+
+    def get_pushed_buttons(self):
+        """
+        :returns list of pushed button names
+        """
+        return [button for button, mask in self._masks.items() if self._buttons & mask]
 
     def get_available_buttons(self):
         """
         :returns: set of valid buttons
         """
-        return set(self._available_buttons)
+        return set(self._masks)
 
     def __iter__(self):
         """
         :returns: iterator over the button bytes
         """
-        yield self._byte_1
-        yield self._byte_2
-        yield self._byte_3
+        yield self._buttons & 0xFF
+        yield self._buttons >> 8 & 0xFF
+        yield self._buttons >> 16
+
+    def __bytes__(self):
+        return self._buttons.to_bytes(3, 'little')
 
     def clear(self):
-        self._byte_1 = self._byte_2 = self._byte_3 = 0
+        self._update(0)
+
+
+# resolution of the normalized stick API, each direction of an axis is divided into this many steps
+NORMALIZED_STEPS = 2048
+
+
+def _normalize(offset, max_offset):
+    if max_offset == 0:
+        return 0.0
+    return min(max(offset / max_offset, -1.0), 1.0)
+
+
+def _normalized_index(value):
+    # clamps a normalized position and maps it to an index of the calibration tables
+    if value >= 1:
+        return 2 * NORMALIZED_STEPS
+    if value <= -1:
+        return 0
+    return NORMALIZED_STEPS + round(value * NORMALIZED_STEPS)
 
 
 class _StickCalibration:
@@ -202,6 +482,47 @@ class _StickCalibration:
         self.h_max_below_center = h_max_below_center
         self.v_max_below_center = v_max_below_center
 
+        self._h_table = None
+        self._v_table = None
+
+    @staticmethod
+    def _axis_table(center, max_below_center, max_above_center):
+        table = []
+        for step in range(-NORMALIZED_STEPS, NORMALIZED_STEPS + 1):
+            offset = max_above_center if step > 0 else max_below_center
+            table.append(min(max(center + round(step * offset / NORMALIZED_STEPS), 0), 0xFFF))
+        return tuple(table)
+
+    def get_h_table(self):
+        """
+        :returns tuple mapping normalized horizontal positions to raw values, see StickState.set_normalized
+        """
+        if self._h_table is None:
+            self._h_table = self._axis_table(self.h_center, self.h_max_below_center, self.h_max_above_center)
+        return self._h_table
+
+    def get_v_table(self):
+        """
+        :returns tuple mapping normalized vertical positions to raw values, see StickState.set_normalized
+        """
+        if self._v_table is None:
+            self._v_table = self._axis_table(self.v_center, self.v_max_below_center, self.v_max_above_center)
+        return self._v_table
+
+    def normalize_h(self, value):
+        """
+        :returns raw horizontal value mapped to [-1, 1]
+        """
+        offset = value - self.h_center
+        return _normalize(offset, self.h_max_above_center if offset > 0 else self.h_max_below_center)
+
+    def normalize_v(self, value):
+        """
+        :returns raw vertical value mapped to [-1, 1]
+        """
+        offset = value - self.v_center
+        return _normalize(offset, self.v_max_above_center if offset > 0 else self.v_max_below_center)
+
     def __str__(self):
         return f'h_center:{self.h_center} v_center:{self.v_center} h_max_above_center:{self.h_max_above_center} ' \
                f'v_max_above_center:{self.v_max_above_center} h_max_below_center:{self.h_max_below_center} ' \
@@ -237,20 +558,34 @@ class RightStickCalibration(_StickCalibration):
 
 
 class StickState:
-    def __init__(self, h=0, v=0, calibration: _StickCalibration = None):
+    def __init__(self, h=0, v=0, calibration: _StickCalibration = None, on_change=None):
+        """
+        :param on_change: function called after every change of the stick position
+        """
         for val in (h, v):
             if not 0 <= val < 0x1000:
                 raise ValueError(f'Stick values must be in [0,{0x1000})')
 
         self._h_stick = h
         self._v_stick = v
+        # cached wire encoding, see __bytes__
+        self._bytes = None
 
         self._calibration = calibration
+        self._on_change = on_change
+
+    def _set(self, h, v):
+        if h != self._h_stick or v != self._v_stick:
+            self._h_stick = h
+            self._v_stick = v
+            self._bytes = None
+            if self._on_change is not None:
+                self._on_change()
 
     def set_h(self, value):
         if not 0 <= value < 0x1000:
             raise ValueError(f'Stick values must be in [0,{0x1000})')
-        self._h_stick = value
+        self._set(value, self._v_stick)
 
     def get_h(self):
         return self._h_stick
@@ -258,7 +593,7 @@ class StickState:
     def set_v(self, value):
         if not 0 <= value < 0x1000:
             raise ValueError(f'Stick values must be in [0,{0x1000})')
-        self._v_stick = value
+        self._set(self._h_stick, value)
 
     def get_v(self):
         return self._v_stick
@@ -269,8 +604,7 @@ class StickState:
         """
         if self._calibration is None:
             raise ValueError('No calibration data available.')
-        self._h_stick = self._calibration.h_center
-        self._v_stick = self._calibration.v_center
+        self._set(self._calibration.h_center, self._calibration.v_center)
 
     def is_center(self, radius=0):
         return self._calibration.h_center - radius <= self._h_stick <= self._calibration.h_center + radius and \
@@ -283,9 +617,8 @@ class StickState:
         """
         if self._calibration is None:
             raise ValueError('No calibration data available.')
-        self._h_stick = self._calibration.h_center
-        self._v_stick = self._calibration.v_center + \
-            self._calibration.v_max_above_center
+        self._set(self._calibration.h_center,
+                  self._calibration.v_center + self._calibration.v_max_above_center)
 
     def set_down(self):
         """
@@ -293,9 +626,8 @@ class StickState:
         """
         if self._calibration is None:
             raise ValueError('No calibration data available.')
-        self._h_stick = self._calibration.h_center
-        self._v_stick = self._calibration.v_center - \
-            self._calibration.v_max_below_center
+        self._set(self._calibration.h_center,
+                  self._calibration.v_center - self._calibration.v_max_below_center)
 
     def set_left(self):
         """
@@ -303,9 +635,8 @@ class StickState:
         """
         if self._calibration is None:
             raise ValueError('No calibration data available.')
-        self._h_stick = self._calibration.h_center - \
-            self._calibration.h_max_below_center
-        self._v_stick = self._calibration.v_center
+        self._set(self._calibration.h_center - self._calibration.h_max_below_center,
+                  self._calibration.v_center)
 
     def set_right(self):
         """
@@ -313,9 +644,47 @@ class StickState:
         """
         if self._calibration is None:
             raise ValueError('No calibration data available.')
-        self._h_stick = self._calibration.h_center + \
-            self._calibration.h_max_above_center
-        self._v_stick = self._calibration.v_center
+        self._set(self._calibration.h_center + self._calibration.h_max_above_center,
+                  self._calibration.v_center)
+
+    def set_normalized(self, x, y):
+        """
+        Sets the stick position relative to the calibration data.
+        :param x: horizontal position, -1 (left) to 1 (right), values outside are clamped
+        :param y: vertical position, -1 (down) to 1 (up), values outside are clamped
+        """
+        calibration = self.get_calibration()
+        self._set(calibration.get_h_table()[_normalized_index(x)],
+                  calibration.get_v_table()[_normalized_index(y)])
+
+    def set_normalized_h(self, x):
+        """
+        Sets the horizontal position relative to the calibration data, see set_normalized.
+        """
+        self._set(self.get_calibration().get_h_table()[_normalized_index(x)], self._v_stick)
+
+    def set_normalized_v(self, y):
+        """
+        Sets the vertical position relative to the calibration data, see set_normalized.
+        """
+        self._set(self._h_stick, self.get_calibration().get_v_table()[_normalized_index(y)])
+
+    def set_polar(self, angle, magnitude=1.0):
+        """
+        Sets the stick position relative to the calibration data.
+        :param angle: direction in degrees, 0 = right, 90 = up
+        :param magnitude: distance from the center, 0 to 1
+        """
+        magnitude = min(max(magnitude, 0.0), 1.0)
+        angle = math.radians(angle)
+        self.set_normalized(magnitude * math.cos(angle), magnitude * math.sin(angle))
+
+    def get_normalized(self):
+        """
+        :returns horizontal and vertical position relative to the calibration data, see set_normalized
+        """
+        calibration = self.get_calibration()
+        return calibration.normalize_h(self._h_stick), calibration.normalize_v(self._v_stick)
 
     def set_calibration(self, calibration):
         self._calibration = calibration
@@ -333,8 +702,45 @@ class StickState:
         return StickState(h=stick_h, v=stick_v)
 
     def __bytes__(self):
-        byte_1 = 0xFF & self._h_stick
-        byte_2 = (self._h_stick >> 8) | ((0xF & self._v_stick) << 4)
-        byte_3 = self._v_stick >> 4
-        assert all(0 <= byte <= 0xFF for byte in (byte_1, byte_2, byte_3))
-        return bytes((byte_1, byte_2, byte_3))
+        # only encoded again after the position changed
+        if self._bytes is None:
+            self._bytes = bytes((self._h_stick & 0xFF,
+                                 (self._h_stick >> 8) | ((self._v_stick & 0xF) << 4),
+                                 self._v_stick >> 4))
+        return self._bytes
+
+
+async def button_press(controller_state, *buttons):
+    """
+    Set given buttons in the controller state to the pressed down state and wait till send.
+    :param controller_state:
+    :param buttons: Buttons to press down (see ButtonState.get_available_buttons)
+    """
+    if not buttons:
+        raise ValueError('No Buttons were given.')
+    controller_state.button_state.set_buttons(buttons)
+    await controller_state.send()
+
+
+async def button_release(controller_state, *buttons):
+    """
+    Set given buttons in the controller state to the unpressed state and wait till send.
+    :param controller_state:
+    :param buttons: Buttons to release (see ButtonState.get_available_buttons)
+    """
+    if not buttons:
+        raise ValueError('No Buttons were given.')
+    controller_state.button_state.set_buttons(buttons, pushed=False)
+    await controller_state.send()
+
+
+async def button_push(controller_state, *buttons, sec=0.1):
+    """
+    Shortly push the given buttons. Wait until the controller state is send.
+    :param controller_state:
+    :param buttons: Buttons to push (see ButtonState.get_available_buttons)
+    :param sec: Seconds to wait before releasing the button, default: 0.1
+    """
+    await button_press(controller_state, *buttons)
+    await asyncio.sleep(sec)
+    await button_release(controller_state, *buttons)
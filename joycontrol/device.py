@@ -34,6 +34,22 @@ class HidDevice:
         else:
             raise ValueError(f'Adapter {device_id} not found.')
 
+    @staticmethod
+    def get_adapters():
+        """
+        Lists all Bluetooth adapters with a single D-Bus call.
+        :returns dict of adapter name (e.g. "hci0") to Bluetooth address
+        """
+        bus = dbus.SystemBus()
+        manager = dbus.Interface(bus.get_object(
+            'org.bluez', '/'), 'org.freedesktop.DBus.ObjectManager')
+        adapters = {}
+        for path, ifaces in manager.GetManagedObjects().items():
+            adapter_info = ifaces.get('org.bluez.Adapter1')
+            if adapter_info is not None:
+                adapters[path.split('/')[-1]] = str(adapter_info['Address'])
+        return adapters
+
     def get_address(self) -> str:
         """
         :returns adapter Bluetooth address
@@ -0,0 +1,248 @@
+import collections
+import logging
+from enum import Enum
+
+logger = logging.getLogger(__name__)
+
+"""
+NFC/IR MCU emulation for 0x31 input reports. References:
+https://github.com/dekuNukem/Nintendo_Switch_Reverse_Engineering/blob/master/bluetooth_hid_subcommands_notes.md
+https://github.com/CTCaer/jc_toolkit (MCU/NFC flow)
+"""
+
+# size of the MCU data in 0x31 input reports (including the trailing crc byte)
+MCU_DATA_SIZE = 313
+# size of the MCU data in 0x21 replies to the SET_NFC_IR_MCU_CONFIG sub command
+MCU_CONFIG_REPLY_SIZE = 34
+
+MCU_FIRMWARE_VERSION = '0008001b'
+
+
+def _crc8_table(polynomial=0x07):
+    table = []
+    for byte in range(0x100):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ polynomial) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data):
+    """
+    CRC-8 (polynomial 0x07, initial value 0) as used by the MCU
+    """
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def pack_message(*parts, size=MCU_DATA_SIZE):
+    """
+    Packs hex strings, byte sequences, integers and enums into a MCU message of the given size.
+    The last byte is the crc8 of all previous bytes.
+    :returns bytes
+    """
+    data = bytearray(size)
+    offset = 0
+    for part in parts:
+        if isinstance(part, str):
+            part = bytes.fromhex(part)
+        elif isinstance(part, Enum):
+            part = bytes((part.value,))
+        elif isinstance(part, int):
+            part = bytes((part,))
+        end = offset + len(part)
+        if end >= size:
+            raise ValueError(f'MCU message exceeds {size - 1} bytes.')
+        data[offset:end] = part
+        offset = end
+    data[-1] = crc8(memoryview(data)[:-1])
+    return bytes(data)
+
+
+class MCUPowerState(Enum):
+    SUSPENDED = 0x00
+    READY = 0x01
+
+
+class MCUMode(Enum):
+    STANDBY = 0x01
+    NFC = 0x04
+    IR = 0x05
+    INITIALIZING = 0x06
+
+
+class NFCState(Enum):
+    NONE = 0x00
+    POLL = 0x01
+    PENDING_READ = 0x02
+    TAG_DETECTED = 0x09
+
+
+class MCUCommand(Enum):
+    REQUEST_STATUS = 0x01
+    NFC = 0x02
+    IR = 0x03
+
+
+class NFCCommand(Enum):
+    START_POLLING = 0x01
+    STOP_POLLING = 0x02
+    REQUEST_STATUS = 0x04
+    READ_NTAG = 0x06
+
+
+def pack_nfc_status(nfc_state: NFCState, uid=None):
+    """
+    :param nfc_state: current NFC state
+    :param uid: 7 byte uid of a detected tag
+    """
+    if uid is None:
+        return pack_message('2a000500000931', nfc_state)
+    return pack_message('2a000500000931', nfc_state, '0000000101020007', uid)
+
+
+def pack_ntag_read_messages(uid, data):
+    """
+    Chunks a NTAG215 dump (540 bytes) into the two MCU messages answering a read command.
+    :returns tuple of messages
+    """
+    if len(data) != 540:
+        raise ValueError(f'NTAG215 dump must be 540 bytes, got {len(data)}.')
+    return (
+        pack_message('3a0007010001310200000001020007', uid,
+                     '000000007dfdf0793651abd7466e39c191babeb856ceedf1ce44cc75eafb27094d087ae803003b3c7778860000',
+                     data[0:245]),
+        pack_message('3a000702000927', data[245:540]),
+    )
+
+
+class MicroControllerUnit:
+    """
+    State machine of the NFC/IR MCU.
+
+    Sub commands 0x21/0x22 and 0x11 output reports change the state and queue responses.
+    Every 0x31 input report carries exactly one MCU message (see get_data).
+    All messages are precomputed bytes, so filling a report is a single copy.
+    """
+
+    def __init__(self, controller_state):
+        self._controller_state = controller_state
+
+        self.power_state = MCUPowerState.SUSPENDED
+        self.mode = MCUMode.STANDBY
+        self.nfc_state = NFCState.NONE
+
+        self._responses = collections.deque()
+
+        self._no_data = pack_message('ff')
+        self._status = {mode: pack_message('0100', '00', MCU_FIRMWARE_VERSION, mode) for mode in MCUMode}
+        self._nfc_status = {state: pack_nfc_status(state) for state in NFCState}
+
+    def set_power_state(self, resume):
+        """
+        Handles the SET_NFC_IR_MCU_STATE sub command.
+        :param resume: True to resume, False to suspend the MCU
+        """
+        if resume:
+            self.power_state = MCUPowerState.READY
+        else:
+            self.power_state = MCUPowerState.SUSPENDED
+            self.mode = MCUMode.STANDBY
+            self.nfc_state = NFCState.NONE
+            self._responses.clear()
+
+    def set_config(self, sub_command_data):
+        """
+        Handles the SET_NFC_IR_MCU_CONFIG sub command.
+        :returns data of the 0x21 reply
+        """
+        # 0x21 0x00 <mode>: set MCU mode
+        if sub_command_data[0] == 0x21 and sub_command_data[1] == 0x00:
+            try:
+                self.mode = MCUMode(sub_command_data[2])
+            except ValueError:
+                logger.warning(f'MCU mode {sub_command_data[2]:x} not implemented - ignoring')
+            else:
+                logger.info(f'MCU mode set to {self.mode}')
+            if self.mode != MCUMode.NFC:
+                self.nfc_state = NFCState.NONE
+
+        return pack_message('0100ff', MCU_FIRMWARE_VERSION, self.mode, size=MCU_CONFIG_REPLY_SIZE)
+
+    def received_11(self, report):
+        """
+        Handles 0x11 output reports (MCU requests).
+        :param report: OutputReport
+        """
+        if self.power_state == MCUPowerState.SUSPENDED:
+            logger.warning('MCU request while suspended - ignoring')
+            return
+
+        try:
+            command = MCUCommand(report.data[11])
+        except ValueError:
+            logger.warning(f'MCU command {report.data[11]:x} not implemented - ignoring')
+            return
+
+        if command == MCUCommand.REQUEST_STATUS:
+            self._responses.append(self._status[self.mode])
+        elif command == MCUCommand.NFC:
+            if self.mode != MCUMode.NFC:
+                logger.warning('NFC command outside of NFC mode - ignoring')
+                return
+            self._nfc_command(report.data[12])
+        else:
+            logger.warning(f'{command} not implemented - ignoring')
+
+    def _nfc_command(self, _id):
+        tag = self._controller_state.get_nfc()
+
+        try:
+            command = NFCCommand(_id)
+        except ValueError:
+            logger.debug(f'NFC command {_id:x} not implemented - answering with status')
+            command = NFCCommand.REQUEST_STATUS
+
+        if command == NFCCommand.START_POLLING:
+            self.nfc_state = NFCState.POLL
+        elif command == NFCCommand.STOP_POLLING:
+            self.nfc_state = NFCState.NONE
+        elif command == NFCCommand.READ_NTAG:
+            if tag is not None:
+                self._responses.extend(tag.get_mcu_read_messages())
+                self.nfc_state = NFCState.PENDING_READ
+            else:
+                logger.warning('NFC read without tag - ignoring')
+
+        if self.nfc_state in (NFCState.POLL, NFCState.TAG_DETECTED) and tag is not None:
+            self.nfc_state = NFCState.TAG_DETECTED
+            self._responses.append(tag.get_mcu_detected_message())
+        else:
+            self._responses.append(self._nfc_status[self.nfc_state])
+
+    def has_data(self):
+        """
+        :returns True if responses are waiting to be send
+        """
+        return bool(self._responses)
+
+    def get_data(self):
+        """
+        :returns the next MCU message (313 bytes) for a 0x31 input report
+        """
+        if self._responses:
+            return self._responses.popleft()
+        if self.power_state == MCUPowerState.SUSPENDED:
+            return self._no_data
+        if self.mode == MCUMode.NFC:
+            tag = self._controller_state.get_nfc()
+            if self.nfc_state == NFCState.TAG_DETECTED and tag is not None:
+                return tag.get_mcu_detected_message()
+            return self._nfc_status[self.nfc_state]
+        return self._status[self.mode]
@@ -1,54 +1,303 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+logger = logging.getLogger(__name__)
+
+# size of the pages copied into the overlay on writes
+PAGE_SIZE = 0x1000
+
+# erase granularity of the SPI flash
+SECTOR_SIZE = 0x1000
+
+# blank flash memory (all 0xFF) by size, shared by all FlashMemory instances
+_BLANK = {}
+
+
+def _blank(size):
+    data = _BLANK.get(size)
+    if data is None:
+        data = _BLANK[size] = b'\xFF' * size
+    return data
+
+
+# process-wide cache of flash images by sha256 of their content, see flash_image
+_IMAGES = {}
+# shared memory blocks created or attached by this process by name, see share_flash_image
+_SHARED = {}
+# names of the blocks in _SHARED created by this process, only these are unlinked
+_CREATED = set()
+
+SHARED_MEMORY_PREFIX = 'joycontrol_flash_'
+
+
+def flash_image(data):
+    """
+    Deduplicates flash images within the process. Protocols created from identical dumps share one read-only copy.
+    :param data: flash memory dump (bytes or buffer)
+    :returns cached read-only buffer with the same content
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    image = _IMAGES.get(digest)
+    if image is None:
+        image = _IMAGES[digest] = bytes(data)
+    return image
+
+
+def share_flash_image(data):
+    """
+    Publishes a flash image in shared memory, to be attached by other processes using attach_flash_image.
+    Identical images are published only once.
+    :returns name of the shared memory block
+    """
+    name = SHARED_MEMORY_PREFIX + hashlib.sha256(data).hexdigest()[:24]
+    if name not in _SHARED:
+        try:
+            block = shared_memory.SharedMemory(name=name, create=True, size=len(data))
+            block.buf[:len(data)] = data
+            _CREATED.add(name)
+        except FileExistsError:
+            # published by another process, which also unlinks it
+            block = attach_shared_memory(name)
+        _SHARED[name] = block
+    return name
+
+
+def attach_shared_memory(name):
+    """
+    Attaches to a shared memory block created by another process.
+    The block is not registered with the resource tracker, which would otherwise remove it when this process exits
+    although the creating process still owns it (only the creator should unlink it).
+    """
+    try:
+        # Python 3.13+
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Older versions always register the block. If the resource tracker is shared with the creator (child
+    # processes), unregistering also drops the creator's registration: the block is then only removed by
+    # unlink_shared_flash_images, not by the tracker if the creator crashes.
+    block = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+def unlink_shared_memory(block):
+    """
+    Removes a shared memory block created by this process.
+    """
+    # an attaching child may have dropped the registration of a shared resource tracker (see
+    # attach_shared_memory), unlink unregisters the block again
+    resource_tracker.register(block._name, 'shared_memory')
+    block.unlink()
+
+
+def attach_flash_image(name):
+    """
+    :param name: name returned by share_flash_image
+    :returns read-only memoryview of a flash image published by another process
+    """
+    block = _SHARED.get(name)
+    if block is None:
+        block = _SHARED[name] = attach_shared_memory(name)
+    return block.buf.toreadonly()
+
+
+def unlink_shared_flash_images():
+    """
+    Removes the shared memory blocks published by this process. Processes attached to them keep their mapping.
+    Blocks attached from other processes are left to their creator.
+    """
+    for name in list(_CREATED):
+        try:
+            unlink_shared_memory(_SHARED.pop(name))
+        except FileNotFoundError:
+            pass
+        _CREATED.discard(name)
+
 
 class FlashMemory:
+    """
+    SPI flash memory of the controller.
+
+    The memory dump is never copied: it is kept as (shared) bytes object or read-only mmap.
+    Writes, e.g. the default stick calibration, go to a sparse overlay of copied pages (copy-on-write).
+    """
+
     def __init__(self, spi_flash_memory_data=None, default_stick_cal=False, size=0x80000):
         """
         :param spi_flash_memory_data: data from a memory dump (can be created using dump_spi_flash.py).
+                                      bytes, mmap or any other buffer. Lists and bytes are deduplicated
+                                      with other instances in the process, see flash_image.
         :param default_stick_cal: If True, override stick calibration bytes with factory default
         :param size of the memory dump, should be constant
         """
         if spi_flash_memory_data is None:
-            spi_flash_memory_data = [0xFF] * size  # Blank data is all 0xFF
+            spi_flash_memory_data = _blank(size)  # Blank data is all 0xFF
             default_stick_cal = True
 
         if len(spi_flash_memory_data) != size:
             raise ValueError(
                 f'Given data size {len(spi_flash_memory_data)} does not match size {size}.')
-        if isinstance(spi_flash_memory_data, bytes):
-            spi_flash_memory_data = list(spi_flash_memory_data)
+        if isinstance(spi_flash_memory_data, (list, bytes, bytearray)) and \
+                spi_flash_memory_data is not _BLANK.get(size):
+            # private copies of a dump are replaced by the process-wide image
+            spi_flash_memory_data = flash_image(bytes(spi_flash_memory_data))
+
+        self._data = spi_flash_memory_data
+        self._view = memoryview(spi_flash_memory_data)
+        self._size = size
+        # page index -> bytearray of modified pages
+        self._pages = {}
+        # persists writes and erases, see set_journal
+        self._journal = None
 
         # set default controller stick calibration
         if default_stick_cal:
             # L-stick factory calibration
-            spi_flash_memory_data[0x603D:0x6046] = [
-                0x00, 0x07, 0x70, 0x00, 0x08, 0x80, 0x00, 0x07, 0x70]
+            self.write(0x603D, [0x00, 0x07, 0x70, 0x00, 0x08, 0x80, 0x00, 0x07, 0x70])
             # R-stick factory calibration
-            spi_flash_memory_data[0x6046:0x604F] = [
-                0x00, 0x08, 0x80, 0x00, 0x07, 0x70, 0x00, 0x07, 0x70]
+            self.write(0x6046, [0x00, 0x08, 0x80, 0x00, 0x07, 0x70, 0x00, 0x07, 0x70])
+
+    @staticmethod
+    def from_shared(name, default_stick_cal=False, size=0x80000):
+        """
+        Creates a flash memory on top of an image published in shared memory, see share_flash_image.
+        Only modified pages (the overlay) are private to the instance.
+        """
+        data = attach_flash_image(name)
+        # shared memory blocks may be rounded up to the page size
+        return FlashMemory(data[:size], default_stick_cal=default_stick_cal, size=size)
+
+    @staticmethod
+    def from_file(path, default_stick_cal=False, size=0x80000):
+        """
+        Memory maps a memory dump read-only.
+        """
+        with open(path, 'rb') as dump_file:
+            data = mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return FlashMemory(data, default_stick_cal=default_stick_cal, size=size)
+
+    def write(self, offset, data):
+        """
+        Writes data to the overlay, the underlying dump stays unchanged.
+        :param offset: start byte in [0, size)
+        :param data: bytes to write
+        """
+        if offset < 0 or offset + len(data) > self._size:
+            raise ValueError(f'Address range exceeds flash memory size {self._size}.')
+        data = memoryview(bytes(data))
+        while data:
+            index, page_offset = divmod(offset, PAGE_SIZE)
+            page = self._pages.get(index)
+            if page is None:
+                page = self._pages[index] = bytearray(self._view[index * PAGE_SIZE:(index + 1) * PAGE_SIZE])
+            length = min(len(data), PAGE_SIZE - page_offset)
+            page[page_offset:page_offset + length] = data[:length]
+            data = data[length:]
+            offset += length
+
+    def erase(self, offset):
+        """
+        Erases (sets to 0xFF) the sector containing the given offset.
+        """
+        self.write(offset - offset % SECTOR_SIZE, _blank(SECTOR_SIZE))
+
+    def set_journal(self, journal):
+        """
+        Replays the journal and records all following writes and erases from the Switch in it.
+        :param journal: FlashJournal or None
+        """
+        if journal is not None:
+            journal.replay(self)
+        self._journal = journal
+
+    def get_journal(self):
+        return self._journal
 
-        self.data = spi_flash_memory_data
+    def spi_write(self, offset, data):
+        """
+        Handles a SPI flash write of the Switch, the write is journaled if a journal is set.
+        """
+        self.write(offset, data)
+        if self._journal is not None:
+            self._journal.append(FlashJournal.WRITE, offset, data)
+
+    def spi_erase(self, offset):
+        """
+        Handles a SPI sector erase of the Switch, the erase is journaled if a journal is set.
+        """
+        self.erase(offset)
+        if self._journal is not None:
+            self._journal.append(FlashJournal.ERASE, offset)
+
+    def get(self, start, stop):
+        """
+        :returns memoryview of the bytes in [start, stop), only copied if the range spans a modified page
+        """
+        start, stop, _ = slice(start, stop).indices(self._size)
+        stop = max(start, stop)
+        if not self._pages:
+            return self._view[start:stop]
+
+        first, last = start // PAGE_SIZE, max(stop - 1, start) // PAGE_SIZE
+        if first == last:
+            page = self._pages.get(first)
+            if page is None:
+                return self._view[start:stop]
+            return memoryview(page)[start - first * PAGE_SIZE:stop - first * PAGE_SIZE]
+
+        chunks = []
+        for index in range(first, last + 1):
+            page_start = index * PAGE_SIZE
+            page = self._pages.get(index)
+            page = self._view[page_start:page_start + PAGE_SIZE] if page is None else memoryview(page)
+            chunks.append(page[max(start - page_start, 0):stop - page_start])
+        return memoryview(b''.join(chunks))
+
+    def __len__(self):
+        return self._size
 
     def __getitem__(self, item):
-        return self.data[item]
+        if isinstance(item, slice):
+            if item.step not in (None, 1):
+                return bytes(self.get(0, self._size))[item]
+            return self.get(item.start, item.stop)
+
+        if item < 0:
+            item += self._size
+        if not 0 <= item < self._size:
+            raise IndexError('Flash memory index out of range')
+        page = self._pages.get(item // PAGE_SIZE)
+        if page is None:
+            return self._view[item]
+        return page[item % PAGE_SIZE]
 
     def get_factory_l_stick_calibration(self):
         """
         :returns 9 left stick factory calibration bytes
         """
-        return self.data[0x603D:0x6046]
+        return self.get(0x603D, 0x6046)
 
     def get_factory_r_stick_calibration(self):
         """
         :returns 9 right stick factory calibration bytes
         """
-        return self.data[0x6046:0x604F]
+        return self.get(0x6046, 0x604F)
 
     def get_user_l_stick_calibration(self):
         """
         :returns 9 left stick user calibration bytes if the data is available, otherwise None
         """
         # check if calibration data is available:
-        if self.data[0x8010] == 0xB2 and self.data[0x8011] == 0xA1:
-            return self.data[0x8012:0x801B]
+        if self[0x8010] == 0xB2 and self[0x8011] == 0xA1:
+            return self.get(0x8012, 0x801B)
         else:
             return None
 
@@ -57,7 +306,161 @@ class FlashMemory:
         :returns 9 right stick user calibration bytes if the data is available, otherwise None
         """
         # check if calibration data is available:
-        if self.data[0x801B] == 0xB2 and self.data[0x801C] == 0xA1:
-            return self.data[0x801D:0x8026]
+        if self[0x801B] == 0xB2 and self[0x801C] == 0xA1:
+            return self.get(0x801D, 0x8026)
         else:
             return None
+
+
+class FlashJournal:
+    """
+    Append-only file of the flash writes and erases received from the Switch.
+
+    append() only buffers the record, the buffer is written and fsynced in batches by a task
+    using the default executor, so journaling never blocks the event loop.
+    On startup (see FlashMemory.set_journal) the journal is replayed and compacted into
+    one record per modified page.
+
+    Record: kind (1 byte), offset (4 bytes), size (2 bytes), crc32 of the data (4 bytes), data
+    """
+    WRITE = 0x11
+    ERASE = 0x12
+
+    _HEADER = struct.Struct('<BIHI')
+
+    def __init__(self, path, batch_delay=0.5):
+        """
+        :param path: journal file, created if it does not exist
+        :param batch_delay: seconds records are collected before they are written and fsynced
+        """
+        self.path = path
+        self.batch_delay = batch_delay
+
+        self._file = None
+        self._pending = bytearray()
+        self._flush_task = None
+        self._closed = False
+        # records taken by a flush, but not yet written by the executor
+        self._in_flight = None
+        # held while records are written, close waits for a write running in the executor
+        self._write_lock = threading.Lock()
+
+        # statistics
+        self.records = 0
+        self.syncs = 0
+
+    def _pack(self, kind, offset, data=b''):
+        return self._HEADER.pack(kind, offset, len(data), zlib.crc32(data)) + data
+
+    def _read_records(self):
+        try:
+            with open(self.path, 'rb') as journal_file:
+                data = journal_file.read()
+        except FileNotFoundError:
+            return
+
+        position = 0
+        while position + self._HEADER.size <= len(data):
+            kind, offset, size, crc = self._HEADER.unpack_from(data, position)
+            start = position + self._HEADER.size
+            record_data = data[start:start + size]
+            if len(record_data) != size or zlib.crc32(record_data) != crc or kind not in (self.WRITE, self.ERASE):
+                # torn record of an interrupted write, everything before is valid
+                logger.warning(f'Flash journal {self.path} is truncated at byte {position}')
+                return
+            yield kind, offset, record_data
+            position = start + size
+
+    def replay(self, flash_memory):
+        """
+        Applies all journaled records to the flash memory, then compacts the journal.
+        """
+        modified = set()
+        count = 0
+        for kind, offset, data in self._read_records():
+            if kind == self.WRITE:
+                flash_memory.write(offset, data)
+                end = offset + len(data)
+            else:
+                offset -= offset % SECTOR_SIZE
+                flash_memory.erase(offset)
+                end = offset + SECTOR_SIZE
+            modified.update(range(offset // PAGE_SIZE, (end - 1) // PAGE_SIZE + 1))
+            count += 1
+
+        # one record per modified page, written to a temporary file and atomically swapped in
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as tmp_file:
+            for index in sorted(modified):
+                tmp_file.write(self._pack(self.WRITE, index * PAGE_SIZE,
+                                          bytes(flash_memory.get(index * PAGE_SIZE, (index + 1) * PAGE_SIZE))))
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, self.path)
+        if count:
+            logger.info(f'Replayed {count} flash journal records, compacted to {len(modified)} pages')
+
+        self._file = open(self.path, 'ab')
+
+    def append(self, kind, offset, data=b''):
+        """
+        Queues a record, it is written and fsynced after batch_delay. Records after close are dropped.
+        """
+        if self._closed:
+            logger.warning(f'Flash journal {self.path} is closed - record at 0x{offset:X} is not persisted')
+            return
+        self._pending += self._pack(kind, offset, bytes(data))
+        self.records += 1
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # records appended during a flush are picked up by the next round
+        while self._pending and not self._closed:
+            await asyncio.sleep(self.batch_delay)
+            await self.flush()
+
+    def _write(self, data):
+        with self._write_lock:
+            if self._file is None:
+                # written by close
+                return
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._in_flight = None
+
+    async def flush(self):
+        """
+        Writes and fsyncs all queued records in the default executor.
+        """
+        if not self._pending or self._file is None:
+            return
+        data, self._pending = bytes(self._pending), bytearray()
+        self._in_flight = data
+        await asyncio.get_event_loop().run_in_executor(None, self._write, data)
+        self.syncs += 1
+
+    def close(self):
+        """
+        Synchronously writes the queued records and closes the journal.
+        Waits for a flush running in the executor, its records are written before the queued ones.
+        """
+        self._closed = True
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        with self._write_lock:
+            if self._file is None:
+                return
+            # a flush whose executor write did not start yet
+            data = (self._in_flight or b'') + bytes(self._pending)
+            self._in_flight = None
+            if data:
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._pending = bytearray()
+                self.syncs += 1
+            self._file.close()
+            self._file = None
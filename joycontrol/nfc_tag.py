@@ -0,0 +1,87 @@
+import logging
+import mmap
+import os
+
+from joycontrol.mcu import NFCState, pack_nfc_status, pack_ntag_read_messages
+
+logger = logging.getLogger(__name__)
+
+NTAG215_SIZE = 540
+
+
+class NFCTag:
+    """
+    NTAG215 dump (e.g. an amiibo). The MCU messages for detecting and reading the tag are built
+    once when the tag is created, streaming them later only copies bytes.
+    """
+
+    def __init__(self, data, source=None):
+        """
+        :param data: 540 bytes of tag data (bytes, mmap or memoryview)
+        :param source: file the data was loaded from
+        """
+        if len(data) != NTAG215_SIZE:
+            raise ValueError(f'NTAG215 dump must be {NTAG215_SIZE} bytes, got {len(data)}.')
+        self.data = data
+        self.source = source
+
+        self._mcu_detected_message = pack_nfc_status(NFCState.TAG_DETECTED, self.get_uid())
+        self._mcu_read_messages = pack_ntag_read_messages(self.get_uid(), data)
+
+    @staticmethod
+    def from_file(path):
+        """
+        Memory maps a tag dump read-only.
+        """
+        with open(path, 'rb') as tag_file:
+            data = mmap.mmap(tag_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return NFCTag(data, source=path)
+
+    def get_uid(self):
+        """
+        :returns 7 byte uid, page 0 contains uid 0-2 and a check byte, page 1 uid 3-6
+        """
+        return bytes(self.data[0:3]) + bytes(self.data[4:8])
+
+    def get_mcu_detected_message(self):
+        return self._mcu_detected_message
+
+    def get_mcu_read_messages(self):
+        return self._mcu_read_messages
+
+    def __str__(self):
+        return f'NFCTag {self.get_uid().hex()} ({self.source})'
+
+
+class AmiiboLibrary:
+    """
+    Directory of tag dumps (*.bin). Dumps are memory mapped and chunked on first use only.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            raise ValueError(f'Amiibo library {directory} is not a directory.')
+        self.directory = directory
+        self._tags = {}
+
+    def list(self):
+        """
+        :returns sorted names of the available dumps (file names without extension)
+        """
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(self.directory)
+                      if name.endswith('.bin'))
+
+    def get(self, name):
+        """
+        :param name: dump name as returned by list()
+        :returns NFCTag
+        """
+        tag = self._tags.get(name)
+        if tag is None:
+            path = os.path.join(self.directory, f'{name}.bin')
+            if not os.path.isfile(path):
+                raise ValueError(f'Amiibo "{name}" not found in {self.directory}.')
+            tag = NFCTag.from_file(path)
+            logger.info(f'Loaded {tag}')
+            self._tags[name] = tag
+        return tag
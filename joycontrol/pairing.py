@@ -0,0 +1,121 @@
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+"""
+Pairing cache: remembers which Switch an emulated controller was paired with, so the next start can reconnect
+right away instead of waiting in the "Change Grip/Order" menu.
+
+The cache is a JSON file with one entry per adapter and controller type:
+    {"entries": [{"console": "98:B6:E9:..", "adapter": "hci0", "adapter_address": "00:1A:7D:..",
+                  "controller": "Pro Controller", "paired_at": 1700000000.0}, ...]}
+
+Several processes (e.g. the workers of supervisor.py) may share one cache, changes are made under a file lock.
+"""
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'joycontrol', 'pairing.json')
+
+# adapter key of entries paired with the default adapter (no device id given)
+ANY_ADAPTER = 'default'
+
+
+class PairingCache:
+    def __init__(self, path=DEFAULT_PATH):
+        """
+        :param path: cache file, created with the first stored pairing
+        """
+        self.path = path
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as cache_file:
+                entries = json.load(cache_file)['entries']
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            # a broken cache only costs a new pairing
+            logger.warning(f'Ignoring pairing cache {self.path} - {err}')
+            return []
+        return [entry for entry in entries if isinstance(entry, dict) and 'console' in entry]
+
+    @contextmanager
+    def _update(self):
+        """
+        Reloads the cache under an exclusive lock, the block modifies the entries which are saved afterwards.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # changes of other processes since loading
+            self._entries = self._load()
+            yield
+            self._save()
+
+    def _save(self):
+        # replaced atomically, an interrupted write keeps the previous cache
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump({'entries': self._entries}, cache_file, indent=1)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _adapter_key(adapter):
+        return ANY_ADAPTER if adapter is None else str(adapter)
+
+    def get_entries(self):
+        return list(self._entries)
+
+    def lookup(self, controller, adapter=None):
+        """
+        :param controller: Controller type
+        :param adapter: device id of the Bluetooth adapter as given to create_hid_server, None for the default one
+        :returns the cache entry (dict) of the last pairing, None if there is none
+        """
+        key = self._adapter_key(adapter)
+        for entry in self._entries:
+            if entry.get('adapter') == key and entry.get('controller') == controller.device_name():
+                return entry
+        return None
+
+    def store(self, controller, console_address, adapter=None, adapter_address=None):
+        """
+        Remembers a pairing, replaces an older one of the same adapter and controller type.
+        :param controller: Controller type
+        :param console_address: Bluetooth address of the Switch
+        :param adapter: device id of the Bluetooth adapter, None for the default one
+        :param adapter_address: Bluetooth address of the adapter, informational
+        :returns the new cache entry
+        """
+        entry = {
+            'console': console_address,
+            'adapter': self._adapter_key(adapter),
+            'adapter_address': adapter_address,
+            'controller': controller.device_name(),
+            'paired_at': time.time(),
+        }
+        with self._update():
+            previous = self.lookup(controller, adapter)
+            if previous is not None:
+                self._entries.remove(previous)
+            self._entries.append(entry)
+        logger.info(f'Stored pairing of {entry["controller"]} on {entry["adapter"]} with {console_address}')
+        return entry
+
+    def forget(self, controller, adapter=None):
+        """
+        Removes the pairing of an adapter and controller type, e.g. after the Switch refused to reconnect.
+        :returns True if there was a pairing
+        """
+        with self._update():
+            entry = self.lookup(controller, adapter)
+            if entry is not None:
+                self._entries.remove(entry)
+        return entry is not None
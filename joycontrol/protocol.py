@@ -2,34 +2,126 @@ import asyncio
 import logging
 import time
 from asyncio import BaseTransport, BaseProtocol
+from collections import OrderedDict
 from contextlib import suppress
 from typing import Optional, Union, Tuple, Text
 from multiprocessing import Value
 
-from joycontrol import utils
 from joycontrol.controller import Controller
 from joycontrol.controller_state import ControllerState
+from joycontrol.mcu import MicroControllerUnit
 from joycontrol.memory import FlashMemory
 from joycontrol.report import OutputReport, SubCommand, InputReport, OutputReportID
-from joycontrol.transport import NotConnectedError
+from joycontrol.simple_hid import encode_simple_hid
+from joycontrol.transport import NotConnectedError, VirtualCableUnplugError
 from joycontrol.throughput import ThroughputMonitor
 
 logger = logging.getLogger(__name__)
 
+# Seconds between two input reports in the continuous input report modes.
+# 0x3F (simple HID) reports are small and only send on changes, so they are checked more often.
+INPUT_REPORT_INTERVALS = {
+    0x30: 1 / 60,
+    0x31: 1 / 60,
+    0x3F: 1 / 125,
+}
 
-def controller_protocol_factory(controller: Controller, spi_flash=None):
+# stick data of a controller without the stick
+_NO_STICK = bytes(3)
+
+
+class EncodedFrameCache:
+    """
+    LRU cache of encoded 0x30 input reports by input state (buttons mask and stick bytes).
+    Bots cycling through a few states find their frame here, sending then only patches the timer byte.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._frames = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :returns cached frame (bytes) or None
+        """
+        frame = self._frames.get(key)
+        if frame is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._frames.move_to_end(key)
+        return frame
+
+    def put(self, key, frame):
+        self._frames[key] = frame
+        if len(self._frames) > self.maxsize:
+            self._frames.popitem(last=False)
+
+    def clear(self):
+        self._frames.clear()
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._frames)}
+
+
+def encode_frame(input_report, controller_state, frame_cache=None):
+    """
+    Encodes a 0x30 input report containing the controller state. The timer byte is left to the sender.
+    :param input_report: 0x30 InputReport, its button and stick data are overwritten
+    :param frame_cache: EncodedFrameCache or None
+    :returns frame (bytes)
+    """
+    l_stick = controller_state.l_stick_state
+    r_stick = controller_state.r_stick_state
+    l_bytes = _NO_STICK if l_stick is None else bytes(l_stick)
+    r_bytes = _NO_STICK if r_stick is None else bytes(r_stick)
+    if frame_cache is None:
+        input_report.set_button_status(controller_state.button_state)
+        input_report.set_stick_status(l_bytes, r_bytes)
+        return bytes(input_report)
+
+    key = (controller_state.button_state.get_mask(), l_bytes, r_bytes)
+    frame = frame_cache.get(key)
+    if frame is None:
+        input_report.set_button_status(controller_state.button_state)
+        input_report.set_stick_status(l_bytes, r_bytes)
+        frame = bytes(input_report)
+        frame_cache.put(key, frame)
+    return frame
+
+
+def controller_protocol_factory(controller: Controller, spi_flash=None, combined=False, controller_state=None):
+    """
+    :param combined: True if the Joy-Con is one half of a Joy-Con pair, see ControllerProtocol
+    :param controller_state: ControllerState shared with another protocol, see ControllerProtocol
+    """
     if isinstance(spi_flash, bytes):
         spi_flash = FlashMemory(spi_flash_memory_data=spi_flash)
 
     def create_controller_protocol():
-        return ControllerProtocol(controller, spi_flash=spi_flash)
+        return ControllerProtocol(controller, spi_flash=spi_flash, combined=combined,
+                                  controller_state=controller_state)
 
     return create_controller_protocol
 
 
 class ControllerProtocol(BaseProtocol):
-    def __init__(self, controller: Controller, spi_flash: FlashMemory = None):
+    def __init__(self, controller: Controller, spi_flash: FlashMemory = None, combined=False, frame_cache_size=64,
+                 controller_state: ControllerState = None):
+        """
+        :param combined: True if the Joy-Con is paired as one half of a combined Joy-Con pair (L + R pressed)
+                         instead of a single sideways Joy-Con (SL + SR pressed)
+        :param frame_cache_size: number of encoded 0x30 input reports kept, see EncodedFrameCache. 0 disables it.
+        :param controller_state: ControllerState of another protocol to send, e.g. to drive several consoles with
+                                 the same input (see scheduler.FanOutScheduler). None creates a new state.
+        """
+        if combined and controller not in (Controller.JOYCON_L, Controller.JOYCON_R):
+            raise ValueError('Only Joy-Cons can be combined.')
         self.controller = controller
+        self.combined = combined
         self.spi_flash = spi_flash
 
         self.transport = None
@@ -39,12 +131,21 @@ class ControllerProtocol(BaseProtocol):
 
         self._data_received = asyncio.Event()
 
-        self._controller_state = ControllerState(
-            self, controller, spi_flash=spi_flash)
+        if controller_state is None:
+            controller_state = ControllerState(self, controller, spi_flash=spi_flash)
+        elif controller_state.get_controller() != controller:
+            raise ValueError('A shared controller state must belong to the same controller type.')
+        self._controller_state = controller_state
         self._controller_state_sender = None
 
+        # NFC/IR MCU, answers 0x11 output reports in 0x31 input reports
+        self._mcu = MicroControllerUnit(self._controller_state)
+
+        # Input report mode state machine, see _set_input_report_mode
         # None = Just answer to sub commands
         self._input_report_mode = None
+        # replaced by a new event on every transition
+        self._sig_input_report_mode = asyncio.Event()
 
         # This event gets triggered once the Switch assigns a player number to the controller and accepts user inputs
         self.sig_set_player_lights = asyncio.Event()
@@ -56,7 +157,25 @@ class ControllerProtocol(BaseProtocol):
         self.ended = False
 
         self.throughput = ThroughputMonitor()
-        self.dirty = False
+        self.bulk_report = None
+        self._frame_counter = 0
+        self.frame_cache = EncodedFrameCache(frame_cache_size) if frame_cache_size else None
+        # controller state generation contained in the last input report
+        self._sent_generation = -1
+
+        # Called with the rumble data of every output report, see set_rumble_listener
+        self._rumble_listener = None
+
+        # connection life cycle, a protocol survives reconnects (see server.reconnect_hid_server)
+        # set while there is no connection
+        self._sig_connection_lost = asyncio.Event()
+        self._sig_connection_lost.set()
+        self._connection_lost_time = None
+        self.connections = 0
+        # True if the Switch unplugged the virtual cable (removed the pairing) instead of just disconnecting
+        self.unplugged = False
+        self.last_recovery_time = None
+        self.max_recovery_time = 0
 
     async def send_controller_state(self):
         """
@@ -80,9 +199,113 @@ class ControllerProtocol(BaseProtocol):
     async def flush(self):
         if self.transport is None:
             return False
+        if self.bulk_report is None:
+            # no continuous input report mode yet
+            return True
         await self.write(self.bulk_report)
+        self._frame_counter += 1
+        return True
+
+    async def flush_frame(self, frame, generation):
+        """
+        Like flush, but sends a 0x30 input report encoded once for several protocols sharing the controller state
+        (see encode_frame and scheduler.FanOutScheduler). Only the timer byte is set per protocol.
+        :param frame: encoded 0x30 input report
+        :param generation: controller state generation contained in the frame
+        :returns False if the connection was lost
+        """
+        data = self.prepare_frame(frame)
+        if data is None:
+            return False
+        await self.transport.write(data)
+        self.frame_sent(data, generation)
         return True
 
+    def prepare_frame(self, frame):
+        """
+        First step of flush_frame: sets the timer byte of this protocol.
+        The caller sends the report with transport.write_nowait and calls frame_sent.
+        :param frame: encoded 0x30 input report
+        :returns the input report to send, None if not connected
+        """
+        if self.transport is None:
+            return None
+        data = bytearray(frame)
+        data[2] = self._input_report_timer
+        self._input_report_timer = (self._input_report_timer + 1) % 0x100
+        return bytes(data)
+
+    def frame_sent(self, data, generation):
+        """
+        Last step of flush_frame, see prepare_frame.
+        :param data: input report returned by prepare_frame
+        :param generation: controller state generation contained in the frame
+        """
+        if self._input_report_mode == 0x30:
+            self._sent_generation = generation
+        self._controller_state.sig_is_send.set()
+        self.throughput.increment(len(data))
+        self._frame_counter += 1
+
+    def get_frame_counter(self):
+        """
+        :returns number of input reports send in the continuous input report modes
+        """
+        return self._frame_counter
+
+    def has_unsent_changes(self):
+        """
+        :returns True if the controller state changed since the last input report was send
+        """
+        return self._controller_state.generation != self._sent_generation
+
+    def get_input_report_mode(self):
+        """
+        :returns the current input report mode (0x30, 0x31, 0x3F) or None if only sub commands are answered
+        """
+        return self._input_report_mode
+
+    async def wait_for_input_report_mode(self, modes=None):
+        """
+        Waits until the Switch sets one of the given input report modes.
+        :param modes: collection of modes, None for any continuous mode
+        :returns the input report mode
+        """
+        while self._input_report_mode is None or (modes is not None and self._input_report_mode not in modes):
+            await self._sig_input_report_mode.wait()
+        return self._input_report_mode
+
+    def _set_input_report_mode(self, mode):
+        """
+        Transition of the input report mode state machine.
+        Replaces the continuous input report and wakes up everyone waiting for a mode change.
+        :param mode: one of INPUT_REPORT_INTERVALS or None
+        """
+        if mode is None:
+            self.bulk_report = None
+        else:
+            input_report = InputReport()
+            input_report.set_input_report_id(mode)
+            if mode != 0x3F:
+                input_report.set_vibrator_input()
+                input_report.set_misc()
+            self.bulk_report = input_report
+            # the first report in the new mode carries the state
+            self._sent_generation = -1
+        if self.frame_cache is not None:
+            self.frame_cache.clear()
+
+        self._input_report_mode = mode
+
+        sig, self._sig_input_report_mode = self._sig_input_report_mode, asyncio.Event()
+        sig.set()
+
+    def get_frame_interval(self):
+        """
+        :returns seconds between two input reports in the current input report mode
+        """
+        return INPUT_REPORT_INTERVALS.get(self._input_report_mode, 1 / 60)
+
     async def write(self, input_report: InputReport):
         """
         Sets timer byte and current button state in the input report and sends it.
@@ -93,30 +316,75 @@ class ControllerProtocol(BaseProtocol):
         if self.transport is None:
             raise NotConnectedError('Transport not registered.')
 
-        # set button and stick data of input report
-        input_report.set_button_status(self._controller_state.button_state)
-        if self._controller_state.l_stick_state is None:
-            l_stick = [0x00, 0x00, 0x00]
+        # changes made while the report is send are part of the next report
+        generation = self._controller_state.generation
+
+        report_id = input_report.get_input_report_id()
+        if report_id == 0x30 and input_report is self.bulk_report and self.frame_cache is not None:
+            data = self._encode_cached(input_report)
+        elif report_id == 0x3F:
+            # simple HID reports have their own layout and no timer
+            input_report.set_simple_hid_data(encode_simple_hid(self._controller_state))
+            data = bytes(input_report)
         else:
+            # set button and stick data of input report
+            input_report.set_button_status(self._controller_state.button_state)
+            # stick states cache their encoding, idle sticks cost a single copy
             l_stick = self._controller_state.l_stick_state
-        if self._controller_state.r_stick_state is None:
-            r_stick = [0x00, 0x00, 0x00]
-        else:
             r_stick = self._controller_state.r_stick_state
-        input_report.set_stick_status(l_stick, r_stick)
+            input_report.set_stick_status(_NO_STICK if l_stick is None else l_stick,
+                                          _NO_STICK if r_stick is None else r_stick)
 
-        # set timer byte of input report
-        input_report.set_timer(self._input_report_timer)
-        self._input_report_timer = (self._input_report_timer + 1) % 0x100
+            # 0x31 reports carry one MCU message each
+            if input_report.get_input_report_id() == 0x31:
+                input_report.set_ir_nfc_data(self._mcu.get_data())
 
-        await self.transport.write(input_report)
+            # set timer byte of input report
+            input_report.set_timer(self._input_report_timer)
+            self._input_report_timer = (self._input_report_timer + 1) % 0x100
+            data = bytes(input_report)
+
+        await self.transport.write(data)
+        # only the reports of the current mode count, the console does not take the state from sub command replies
+        if report_id == self._input_report_mode:
+            self._sent_generation = generation
 
         self._controller_state.sig_is_send.set()
-        self.throughput.increment()
+        self.throughput.increment(len(data))
+
+    def _encode_cached(self, input_report):
+        # the cached frame only differs from the one to send in the timer byte
+        frame = encode_frame(input_report, self._controller_state, self.frame_cache)
+
+        data = bytearray(frame)
+        data[2] = self._input_report_timer
+        self._input_report_timer = (self._input_report_timer + 1) % 0x100
+        return bytes(data)
 
     def get_controller_state(self) -> ControllerState:
         return self._controller_state
 
+    def mcu_data_pending(self):
+        """
+        :returns True if MCU responses are waiting for the next 0x31 input reports
+        """
+        return self._mcu.has_data()
+
+    def set_rumble_listener(self, listener):
+        """
+        Registers a function which receives the 8 rumble bytes of every output report (e.g. RumbleForwarder.submit).
+        It is called from the reader and must not block.
+        :param listener: function taking the rumble data, None to remove the listener
+        """
+        self._rumble_listener = listener
+
+    def _notify_rumble(self, report: OutputReport):
+        if self._rumble_listener is not None:
+            try:
+                self._rumble_listener(report.get_rumble_data())
+            except ValueError as err:
+                logger.warning(f'Rumble data error "{err}" - IGNORE')
+
     async def wait_for_output_report(self):
         """
         Waits until an output report from the Switch is received.
@@ -124,16 +392,50 @@ class ControllerProtocol(BaseProtocol):
         self._data_received.clear()
         await self._data_received.wait()
 
+    async def wait_for_connection_lost(self):
+        """
+        Waits until the current connection is lost, returns immediately if there is none.
+        """
+        await self._sig_connection_lost.wait()
+
+    def get_connection_stats(self):
+        """
+        :returns number of connections and the seconds from a lost connection to the next one
+        """
+        return {
+            'connections': self.connections,
+            'last_recovery_time': self.last_recovery_time,
+            'max_recovery_time': self.max_recovery_time,
+        }
+
     def connection_made(self, transport: BaseTransport) -> None:
         logger.debug('Connection established.')
         self.transport = transport
+        self.ended = False
+        self.unplugged = False
+        self._sig_connection_lost.clear()
+        # the first input report of a new connection carries the state, even if it did not change
+        self._sent_generation = -1
+
+        self.connections += 1
+        if self._connection_lost_time is not None:
+            self.last_recovery_time = time.monotonic() - self._connection_lost_time
+            self.max_recovery_time = max(self.max_recovery_time, self.last_recovery_time)
+            self._connection_lost_time = None
 
     def connection_lost(self, exc: Optional[Exception] = None) -> None:
         if self.transport is not None:
             logger.error('Connection lost.')
+            flight_recorder = self.transport.get_extra_info('flight_recorder')
+            if flight_recorder is not None:
+                asyncio.ensure_future(flight_recorder.dump_async('connection_lost'))
             asyncio.ensure_future(self.transport.close())
             self.transport = None
             self.ended = True
+            self.unplugged = isinstance(exc, VirtualCableUnplugError)
+            self._set_input_report_mode(None)
+            self._connection_lost_time = time.monotonic()
+            self._sig_connection_lost.set()
 
             if self._controller_state_sender is not None:
                 self._controller_state_sender.set_exception(NotConnectedError)
@@ -142,50 +444,10 @@ class ControllerProtocol(BaseProtocol):
         # TODO?
         raise NotImplementedError()
 
-    async def input_report_mode_full(self):
+    async def report_received(self, data: Union[bytes, Text], addr: Tuple[str, int]) -> None:
         """
-        Continuously sends:
-            0x30 input reports containing the controller state OR
-            0x31 input reports containing the controller state and nfc data
+        Called by the transport reader for every output report, independent of the input report mode.
         """
-        if self.transport.is_reading():
-            raise ValueError(
-                'Transport must be paused in full input report mode')
-
-        input_report = InputReport()
-        self.bulk_report = input_report
-        input_report.set_vibrator_input()
-        input_report.set_misc()
-
-
-        while self._input_report_mode is None:
-            await asyncio.sleep(0)
-        input_report.set_input_report_id(self._input_report_mode)
-
-        try:
-            while True:
-                data = await self.transport.read()
-                try:
-                    report = OutputReport(list(data))
-                    output_report_id = report.get_output_report_id()
-                    if output_report_id == OutputReportID.RUMBLE_ONLY:
-                        pass
-                    elif output_report_id == OutputReportID.SUB_COMMAND:
-                        if await self._reply_to_sub_command(report):
-                            asyncio.sleep(0.1)
-                    else:
-                        logger.warning(
-                            f'Report unknown output report "{output_report_id}" - IGNORE')
-                except ValueError as v_err:
-                    logger.warning(f'Report parsing error "{v_err}" - IGNORE')
-                except NotImplementedError as err:
-                    logger.warning(err)
-        except NotConnectedError as err:
-            logger.error(err)
-        finally:
-            self._input_report_mode = None
-
-    async def report_received(self, data: Union[bytes, Text], addr: Tuple[str, int]) -> None:
         self._data_received.set()
         try:
             report = OutputReport(list(data))
@@ -197,9 +459,18 @@ class ControllerProtocol(BaseProtocol):
         except NotImplementedError as err:
             logger.warning(err)
             return
+
+        # all output reports carry rumble data
+        self._notify_rumble(report)
+
         if output_report_id == OutputReportID.SUB_COMMAND:
-            await self._reply_to_sub_command(report)
-        else:
+            try:
+                await self._reply_to_sub_command(report)
+            except ValueError as v_err:
+                logger.warning(f'Report parsing error "{v_err}" - IGNORE')
+        elif output_report_id == OutputReportID.REQUEST_IR_NFC_MCU:
+            self._mcu.received_11(report)
+        elif output_report_id != OutputReportID.RUMBLE_ONLY:
             logger.warning(
                 f'Output report {output_report_id} not implemented - ignoring')
 
@@ -228,6 +499,10 @@ class ControllerProtocol(BaseProtocol):
                 await self._command_set_shipment_state(sub_command_data)
             elif sub_command == SubCommand.SPI_FLASH_READ:
                 await self._command_spi_flash_read(sub_command_data)
+            elif sub_command == SubCommand.SPI_FLASH_WRITE:
+                await self._command_spi_flash_write(sub_command_data)
+            elif sub_command == SubCommand.SPI_SECTOR_ERASE:
+                await self._command_spi_sector_erase(sub_command_data)
             elif sub_command == SubCommand.SET_INPUT_REPORT_MODE:
                 await self._command_set_input_report_mode(sub_command_data)
             elif sub_command == SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME:
@@ -305,37 +580,56 @@ class ControllerProtocol(BaseProtocol):
 
         await self.write(input_report)
 
-    async def _command_set_input_report_mode(self, sub_command_data):
-        if self._input_report_mode == sub_command_data[0]:
-            logger.warning(
-                f'Already in input report mode {sub_command_data[0]} - ignoring request')
+    async def _command_spi_flash_write(self, sub_command_data):
+        input_report = InputReport()
+        input_report.set_input_report_id(0x21)
+        input_report.set_misc()
 
-        # Start input report reader
-        if sub_command_data[0] in (0x30, 0x31):
-            new_reader = asyncio.ensure_future(self.input_report_mode_full())
+        input_report.set_ack(0x80)
+
+        offset = int.from_bytes(bytes(sub_command_data[0:4]), 'little')
+        size = sub_command_data[4]
+
+        if self.spi_flash is None or size > 0x1D or offset + size > len(self.spi_flash):
+            logger.warning(f'Refusing SPI flash write of {size} bytes at {hex(offset)}')
+            input_report.sub_0x11_spi_flash_write(status=0x01)
         else:
-            logger.error(
-                f'input report mode {sub_command_data[0]} not implemented - ignoring request')
-            return
+            # only updates the overlay and queues a journal record, persisting happens in the background
+            self.spi_flash.spi_write(offset, sub_command_data[5:5 + size])
+            input_report.sub_0x11_spi_flash_write()
+
+        await self.write(input_report)
 
-        # Replace the currently running reader with the input report mode sender,
-        # which will also handle incoming requests in the future
+    async def _command_spi_sector_erase(self, sub_command_data):
+        input_report = InputReport()
+        input_report.set_input_report_id(0x21)
+        input_report.set_misc()
 
-        self.transport.pause_reading()
+        input_report.set_ack(0x80)
 
-        # We need to replace the reader in the future because this function was probably called by it
-        async def set_reader():
-            await self.transport.set_reader(new_reader)
+        offset = int.from_bytes(bytes(sub_command_data[0:4]), 'little')
 
-            logger.info(
-                f'Setting input report mode to {hex(sub_command_data[0])}...')
-            self._input_report_mode = sub_command_data[0]
+        if self.spi_flash is None or offset >= len(self.spi_flash):
+            logger.warning(f'Refusing SPI sector erase at {hex(offset)}')
+            input_report.sub_0x12_spi_sector_erase(status=0x01)
+        else:
+            self.spi_flash.spi_erase(offset)
+            input_report.sub_0x12_spi_sector_erase()
 
-            self.transport.resume_reading()
+        await self.write(input_report)
 
-        asyncio.ensure_future(set_reader()).add_done_callback(
-            utils.create_error_check_callback()
-        )
+    async def _command_set_input_report_mode(self, sub_command_data):
+        mode = sub_command_data[0]
+        if self._input_report_mode == mode:
+            logger.warning(
+                f'Already in input report mode {hex(mode)} - ignoring request')
+        elif mode in INPUT_REPORT_INTERVALS:
+            logger.info(f'Setting input report mode to {hex(mode)}...')
+            self._set_input_report_mode(mode)
+        else:
+            logger.error(
+                f'input report mode {hex(mode)} not implemented - ignoring request')
+            return
 
         # Send acknowledgement
         input_report = InputReport()
@@ -359,8 +653,13 @@ class ControllerProtocol(BaseProtocol):
         if self.controller == Controller.PRO_CONTROLLER:
             input_report.sub_0x04_trigger_buttons_elapsed_time(
                 L_ms=3000, R_ms=3000)
+        elif self.combined:
+            # a combined pair is assigned by pressing L on the left and R on the right Joy-Con
+            if self.controller == Controller.JOYCON_L:
+                input_report.sub_0x04_trigger_buttons_elapsed_time(L_ms=3000)
+            else:
+                input_report.sub_0x04_trigger_buttons_elapsed_time(R_ms=3000)
         elif self.controller in (Controller.JOYCON_L, Controller.JOYCON_R):
-            # TODO: What do we do if we want to pair a combined JoyCon?
             input_report.sub_0x04_trigger_buttons_elapsed_time(
                 SL_ms=3000, SR_ms=3000)
         else:
@@ -387,33 +686,31 @@ class ControllerProtocol(BaseProtocol):
         await self.write(input_report)
 
     async def _command_set_nfc_ir_mcu_config(self, sub_command_data):
-        # TODO NFC
         input_report = InputReport()
         input_report.set_input_report_id(0x21)
         input_report.set_misc()
         input_report.set_ack(0xA0)
         input_report.reply_to_subcommand_id(
             SubCommand.SET_NFC_IR_MCU_CONFIG.value)
-        data = [1, 0, 255, 0, 8, 0, 27, 1, 0, 0, 0, 0, 0, 0, 0, 0,
-                0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 200]
-        for i in range(len(data)):
-            input_report.data[16 + i] = data[i]
+        data = self._mcu.set_config(sub_command_data)
+        input_report.data[16:16 + len(data)] = data
 
         await self.write(input_report)
 
     async def _command_set_nfc_ir_mcu_state(self, sub_command_data):
-        # TODO NFC
         input_report = InputReport()
         input_report.set_input_report_id(0x21)
         input_report.set_misc()
 
         if sub_command_data[0] == 0x01:
             # 0x01 = Resume
+            self._mcu.set_power_state(True)
             input_report.set_ack(0x80)
             input_report.reply_to_subcommand_id(
                 SubCommand.SET_NFC_IR_MCU_STATE.value)
         elif sub_command_data[0] == 0x00:
             # 0x00 = Suspend
+            self._mcu.set_power_state(False)
             input_report.set_ack(0x80)
             input_report.reply_to_subcommand_id(
                 SubCommand.SET_NFC_IR_MCU_STATE.value)
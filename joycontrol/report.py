@@ -40,7 +40,8 @@ class InputReport:
         """
         :param _id: e.g. 0x21 Standard input reports used for sub command replies
                          0x30 Input reports with IMU data instead of sub command replies
-                         etc... (TODO)
+                         0x31 Input reports with IMU and NFC/IR MCU data
+                         0x3F Simple HID input reports
         """
         self.data[1] = _id
 
@@ -61,7 +62,7 @@ class InputReport:
         """
         Sets the button status bytes
         """
-        self.data[4:7] = iter(button_status)
+        self.data[4:7] = bytes(button_status)
 
     def set_stick_status(self, left_stick, right_stick):
         """
@@ -114,13 +115,22 @@ class InputReport:
         for i in range(14, 50):
             self.data[i] = 0x00
 
+    def set_simple_hid_data(self, data):
+        """
+        Sets the data of 0x3F (simple HID) input reports, see joycontrol.simple_hid.
+        These reports have no timer, the data directly follows the report id.
+        :param data: 11 bytes
+        """
+        if len(data) != 11:
+            raise ValueError('Simple HID data must be exactly 11 bytes!')
+        self.data[2:13] = data
+
     def set_ir_nfc_data(self, data):
         if 50 + len(data) > len(self.data):
             raise ValueError('Too much data.')
 
         # write to data
-        for i in range(len(data)):
-            self.data[50 + i] = data[i]
+        self.data[50:50 + len(data)] = data
 
     def reply_to_subcommand_id(self, _id):
         if isinstance(_id, SubCommand):
@@ -178,6 +188,22 @@ class InputReport:
         self.data[20] = size
         self.data[21:21+len(data)] = data
 
+    def sub_0x11_spi_flash_write(self, status=0x00):
+        """
+        Sub command 0x11 SPI flash write response.
+        :param status: 0x00 = success, 0x01 = write protected
+        """
+        self.reply_to_subcommand_id(0x11)
+        self.data[16] = status
+
+    def sub_0x12_spi_sector_erase(self, status=0x00):
+        """
+        Sub command 0x12 SPI sector erase response.
+        :param status: 0x00 = success, 0x01 = write protected
+        """
+        self.reply_to_subcommand_id(0x12)
+        self.data[16] = status
+
     def sub_0x04_trigger_buttons_elapsed_time(self, L_ms=0, R_ms=0, ZL_ms=0, ZR_ms=0, SL_ms=0, SR_ms=0, HOME_ms=0):
         """
         Set sub command data for 0x04 reply. Arguments are in ms and must be divisible by 10.
@@ -208,6 +234,8 @@ class InputReport:
             return bytes(self.data[:14])
         elif _id == 0x31:
             return bytes(self.data[:363])
+        elif _id == 0x3F:
+            return bytes(self.data[:13])
         else:
             return bytes(self.data[:51])
 
@@ -227,6 +255,8 @@ class SubCommand(Enum):
     TRIGGER_BUTTONS_ELAPSED_TIME = 0x04
     SET_SHIPMENT_STATE = 0x08
     SPI_FLASH_READ = 0x10
+    SPI_FLASH_WRITE = 0x11
+    SPI_SECTOR_ERASE = 0x12
     SET_NFC_IR_MCU_CONFIG = 0x21
     SET_NFC_IR_MCU_STATE = 0x22
     SET_PLAYER_LIGHTS = 0x30
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import time
+
+try:
+    import evdev
+    from evdev import ecodes
+except ImportError:
+    evdev = None
+
+logger = logging.getLogger(__name__)
+
+"""
+HD rumble decoding. Reference:
+https://github.com/dekuNukem/Nintendo_Switch_Reverse_Engineering/blob/master/rumble_data_table.md
+
+Every output report carries 8 rumble bytes, 4 for the left and 4 for the right actuator:
+    byte 0, bit 0 of byte 1     high band frequency (7 bit code, shifted by 2)
+    bits 1-7 of byte 1          high band amplitude (7 bit code)
+    bits 0-6 of byte 2          low band frequency (7 bit code)
+    bit 7 of byte 2, byte 3     low band amplitude (7 bit code, offset by 0x40, lsb in byte 2)
+"""
+
+
+def _amplitude(code):
+    """
+    Approximates the amplitude table of the reference. Codes above 0x64 exceed the safe maximum and are clamped.
+    """
+    if code == 0:
+        return 0.0
+    elif code < 0x10:
+        return 0.01 * 2 ** ((code - 1) / 4)
+    elif code < 0x20:
+        return 2 ** (code / 16) / 17
+    else:
+        return min(2 ** (code / 32) / 8.7, 1.0)
+
+
+# Lookup tables, decoding a rumble report is just indexing
+HIGH_FREQUENCIES = tuple(10 * 2 ** ((code + 0x60) / 32) for code in range(0x80))
+LOW_FREQUENCIES = tuple(10 * 2 ** ((code + 0x40) / 32) for code in range(0x80))
+# indexed by byte 1 >> 1
+HIGH_AMPLITUDES = tuple(_amplitude(code) for code in range(0x80))
+# indexed by (byte 3 << 1) | (byte 2 >> 7)
+LOW_AMPLITUDES = tuple(_amplitude(min(max(index - 0x80, 0), 0x7F)) for index in range(0x200))
+
+# neutral rumble data (320Hz/160Hz at zero amplitude) for both actuators
+NEUTRAL_RUMBLE_DATA = bytes((0x00, 0x01, 0x40, 0x40, 0x00, 0x01, 0x40, 0x40))
+
+
+class RumbleState:
+    """
+    Decoded rumble of a single actuator. Frequencies in Hz, amplitudes in [0, 1].
+    """
+    __slots__ = ('high_freq', 'high_amp', 'low_freq', 'low_amp')
+
+    def __init__(self, high_freq, high_amp, low_freq, low_amp):
+        self.high_freq = high_freq
+        self.high_amp = high_amp
+        self.low_freq = low_freq
+        self.low_amp = low_amp
+
+    def __str__(self):
+        return f'high:{self.high_freq:.1f}Hz@{self.high_amp:.3f} low:{self.low_freq:.1f}Hz@{self.low_amp:.3f}'
+
+
+def decode_actuator(data, offset=0):
+    """
+    :param data: rumble data
+    :param offset: 0 for the left, 4 for the right actuator
+    :returns RumbleState of the actuator
+    """
+    b0, b1, b2, b3 = data[offset], data[offset + 1], data[offset + 2], data[offset + 3]
+    return RumbleState(HIGH_FREQUENCIES[((b1 & 0x01) << 8 | b0) >> 2],
+                       HIGH_AMPLITUDES[b1 >> 1],
+                       LOW_FREQUENCIES[b2 & 0x7F],
+                       LOW_AMPLITUDES[(b3 << 1) | (b2 >> 7)])
+
+
+def decode_rumble(data):
+    """
+    :param data: 8 rumble bytes, see OutputReport.get_rumble_data
+    :returns tuple of left and right RumbleState
+    """
+    if len(data) != 8:
+        raise ValueError(f'Rumble data must be exactly 8 bytes, got {len(data)}.')
+    return decode_actuator(data, 0), decode_actuator(data, 4)
+
+
+def rumble_magnitudes(data):
+    """
+    Maps rumble data to the two motors of a FF_RUMBLE device.
+    The low band drives the strong motor, the high band the weak one.
+    Only amplitude table lookups are done, frequencies are ignored.
+
+    :param data: 8 rumble bytes
+    :returns strong and weak magnitude in [0, 0xFFFF]
+    """
+    if len(data) != 8:
+        raise ValueError(f'Rumble data must be exactly 8 bytes, got {len(data)}.')
+    strong = max(LOW_AMPLITUDES[(data[3] << 1) | (data[2] >> 7)], LOW_AMPLITUDES[(data[7] << 1) | (data[6] >> 7)])
+    weak = max(HIGH_AMPLITUDES[data[1] >> 1], HIGH_AMPLITUDES[data[5] >> 1])
+    return int(strong * 0xFFFF), int(weak * 0xFFFF)
+
+
+class EvdevRumbleDevice:
+    """
+    FF_RUMBLE effect of an evdev device, e.g. the physical controller used as input.
+    """
+
+    def __init__(self, device_path, duration_ms=250):
+        """
+        :param device_path: evdev device, e.g. /dev/input/event5
+        :param duration_ms: effect duration, the forwarder replays active rumble before it runs out
+        """
+        if evdev is None:
+            raise ImportError('Rumble forwarding requires the "evdev" package.')
+
+        self._device = evdev.InputDevice(device_path)
+        if ecodes.FF_RUMBLE not in self._device.capabilities().get(ecodes.EV_FF, []):
+            raise ValueError(f'Device {device_path} does not support FF_RUMBLE.')
+
+        self.duration_ms = duration_ms
+        self._effect_id = -1
+
+    def play(self, strong, weak):
+        effect = evdev.ff.Effect(
+            ecodes.FF_RUMBLE, self._effect_id, 0,
+            evdev.ff.Trigger(0, 0),
+            evdev.ff.Replay(self.duration_ms, 0),
+            evdev.ff.EffectType(ff_rumble_effect=evdev.ff.Rumble(strong_magnitude=strong, weak_magnitude=weak))
+        )
+        # uploading with an existing id updates the effect in place
+        self._effect_id = self._device.upload_effect(effect)
+        self._device.write(ecodes.EV_FF, self._effect_id, 1)
+
+    def stop(self):
+        if self._effect_id != -1:
+            self._device.write(ecodes.EV_FF, self._effect_id, 0)
+
+
+class RumbleForwarder:
+    """
+    Forwards rumble received from the Switch to a rumble device (see EvdevRumbleDevice).
+
+    submit() only decodes and stores the newest magnitudes, it never touches the device.
+    A separate task writes to the device at most once per min_interval, so a flood of rumble packets
+    is coalesced into a single effect update and never delays the input report sender.
+    """
+
+    def __init__(self, device, min_interval=0.02, refresh_interval=0.1):
+        """
+        :param device: object with play(strong, weak) and stop() functions
+        :param min_interval: minimum time between two device writes in seconds
+        :param refresh_interval: unchanged rumble is only written again after this time
+                                 (the Switch keeps repeating active rumble)
+        """
+        self._device = device
+        self.min_interval = min_interval
+        self.refresh_interval = refresh_interval
+
+        self._last_data = None
+        self._last_magnitudes = (0, 0)
+        self._played = (0, 0)
+        self._last_play_time = 0
+
+        self._pending = None
+        self._pending_since = 0
+        self._wakeup = asyncio.Event()
+
+        # statistics
+        self.received = 0
+        self.decoded = 0
+        self.coalesced = 0
+        self.forwarded = 0
+        self.decode_time = 0
+        self.latency_sum = 0
+        self.latency_max = 0
+        self._latency_samples = 0
+
+    def submit(self, rumble_data):
+        """
+        Queues rumble data for forwarding. Cheap enough to be called for every output report.
+        :param rumble_data: 8 rumble bytes
+        """
+        self.received += 1
+        now = time.perf_counter()
+
+        rumble_data = bytes(rumble_data)
+        if rumble_data != self._last_data:
+            self._last_data = rumble_data
+            self._last_magnitudes = rumble_magnitudes(rumble_data)
+            self.decoded += 1
+            self.decode_time += time.perf_counter() - now
+
+        if self._pending is None:
+            self._pending_since = now
+        else:
+            self.coalesced += 1
+        self._pending = self._last_magnitudes
+        self._wakeup.set()
+
+    def get_stats(self):
+        """
+        :returns dict containing the mean decode time and forwarding latency in seconds
+        """
+        return {
+            'received': self.received,
+            'coalesced': self.coalesced,
+            'forwarded': self.forwarded,
+            'decode_mean': self.decode_time / max(self.decoded, 1),
+            'latency_mean': self.latency_sum / max(self._latency_samples, 1),
+            'latency_max': self.latency_max,
+        }
+
+    async def run(self):
+        """
+        Writes pending rumble to the device until cancelled.
+        """
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+
+                delay = self._last_play_time + self.min_interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                magnitudes, self._pending = self._pending, None
+                if magnitudes is None:
+                    continue
+                self._play(*magnitudes)
+
+                latency = time.perf_counter() - self._pending_since
+                self.latency_sum += latency
+                self._latency_samples += 1
+                self.latency_max = max(self.latency_max, latency)
+        finally:
+            self._stop()
+
+    def _play(self, strong, weak):
+        now = time.perf_counter()
+        if (strong, weak) == self._played and now - self._last_play_time < self.refresh_interval:
+            return
+
+        try:
+            if strong == 0 and weak == 0:
+                self._device.stop()
+            else:
+                self._device.play(strong, weak)
+        except OSError as err:
+            logger.warning(f'Rumble forwarding failed - {err}')
+            return
+
+        self._played = (strong, weak)
+        self._last_play_time = now
+        self.forwarded += 1
+
+    def _stop(self):
+        try:
+            self._device.stop()
+        except OSError as err:
+            logger.warning(f'Stopping rumble failed - {err}')
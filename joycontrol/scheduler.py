@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import time
+
+from joycontrol.protocol import EncodedFrameCache, encode_frame
+from joycontrol.report import InputReport
+from joycontrol.transport import NotConnectedError
+
+logger = logging.getLogger(__name__)
+
+
+class FrameScheduler:
+    """
+    Sends the input reports of one or more protocols from a single task.
+
+    Every tick, all protocols with unsent changes (or pending MCU data) are flushed together, so e.g. the
+    left and right Joy-Con of a pair report the same input in the same tick.
+    Ticks follow absolute deadlines, the time spent sending does not accumulate as drift.
+    """
+
+    def __init__(self, protocols=()):
+        self._protocols = list(protocols)
+        self._wakeup = asyncio.Event()
+        # protocol -> loop time of its last input report
+        self._last_send = {}
+        # functions called at the start of every tick, e.g. to sample external input
+        self._tick_listeners = []
+
+        # statistics
+        self.ticks = 0
+        self.frames = 0
+        self.late_ticks = 0
+        self.max_lateness = 0
+
+    def add(self, protocol):
+        """
+        Adds a protocol, its input reports are send starting with the next tick.
+        """
+        if protocol not in self._protocols:
+            self._protocols.append(protocol)
+            self._wakeup.set()
+
+    def remove(self, protocol):
+        if protocol in self._protocols:
+            self._protocols.remove(protocol)
+            self._last_send.pop(protocol, None)
+
+    def add_tick_listener(self, listener):
+        """
+        :param listener: function without arguments called at the start of every tick, must not block
+        """
+        self._tick_listeners.append(listener)
+
+    def remove_tick_listener(self, listener):
+        self._tick_listeners.remove(listener)
+
+    def get_protocols(self):
+        return tuple(self._protocols)
+
+    def get_interval(self):
+        """
+        :returns seconds between two ticks, the shortest frame interval of all protocols
+        """
+        return min((protocol.get_frame_interval() for protocol in self._protocols), default=1 / 60)
+
+    def get_stats(self):
+        return {
+            'ticks': self.ticks,
+            'frames': self.frames,
+            'late_ticks': self.late_ticks,
+            'max_lateness': self.max_lateness,
+        }
+
+    def _disconnected(self, protocol):
+        logger.info(f'{protocol.controller.device_name()} disconnected - removing it from the scheduler')
+        self.remove(protocol)
+
+    async def _flush(self, protocol):
+        try:
+            connected = await protocol.flush()
+        except NotConnectedError:
+            # the send failed, the transport already reported the lost connection
+            connected = False
+        if not connected:
+            self._disconnected(protocol)
+        return connected
+
+    async def _send(self, protocols):
+        """
+        Sends the input reports of the protocols due in this tick.
+        :returns number of input reports send
+        """
+        results = await asyncio.gather(*(self._flush(protocol) for protocol in protocols))
+        return sum(results)
+
+    async def run(self, stop_when_empty=True):
+        """
+        Runs until cancelled or, if stop_when_empty is True, until all protocols were removed.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time()
+        while True:
+            if not self._protocols:
+                if stop_when_empty:
+                    break
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                deadline = loop.time()
+
+            for listener in self._tick_listeners:
+                listener()
+
+            # protocols in a slower input report mode than the tick rate skip ticks
+            now = loop.time()
+            due = [protocol for protocol in self._protocols
+                   if (protocol.has_unsent_changes() or protocol.mcu_data_pending()) and
+                   now - self._last_send.get(protocol, float('-inf')) >= protocol.get_frame_interval() * 0.9]
+            if due:
+                for protocol in due:
+                    self._last_send[protocol] = now
+                self.frames += await self._send(due)
+            self.ticks += 1
+
+            deadline += self.get_interval()
+            delay = deadline - loop.time()
+            if delay < 0:
+                self.late_ticks += 1
+                self.max_lateness = max(self.max_lateness, -delay)
+                # skip the missed ticks instead of sending a burst
+                deadline = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+        logger.info('Frame scheduler stopped')
+
+
+class FanOutScheduler(FrameScheduler):
+    """
+    Drives several consoles with the input of one controller state, e.g. one physical pad for multiple Switches.
+    The protocols (one per console) share the controller state, see ControllerProtocol.
+
+    Every tick the 0x30 input report is encoded once and written to the transports of all protocols in the 0x30
+    mode back to back, only the timer byte differs. This narrows the send skew, the time between writing the
+    report to the first and the last transport. It does not make the consoles receive it closer together if the
+    receiving side dominates (see benchmark.py fan_out). Protocols in other modes (e.g. during the handshake or with
+    NFC/IR in 0x31) are flushed one by one.
+    """
+
+    def __init__(self, controller_state, protocols=(), frame_cache_size=64):
+        """
+        :param controller_state: controller state shared by all protocols
+        :param frame_cache_size: number of encoded frames kept, see EncodedFrameCache. 0 disables it.
+        """
+        super().__init__(protocols)
+        self._controller_state = controller_state
+        self._input_report = InputReport()
+        self._input_report.set_input_report_id(0x30)
+        self._input_report.set_vibrator_input()
+        self._input_report.set_misc()
+        self._frame_cache = EncodedFrameCache(frame_cache_size) if frame_cache_size else None
+
+        # statistics: skew is the time between writing a frame to the first and to the last transport
+        self.fan_out_frames = 0
+        self.last_skew = 0
+        self.max_skew = 0
+        self._skew_total = 0
+
+    def add(self, protocol):
+        if protocol.get_controller_state() is not self._controller_state:
+            raise ValueError('Protocols of a fan out must share the controller state.')
+        super().add(protocol)
+
+    async def _send(self, protocols):
+        bulk = [protocol for protocol in protocols if protocol.get_input_report_mode() == 0x30]
+        if len(bulk) < 2:
+            return await super()._send(protocols)
+        others = [protocol for protocol in protocols if protocol.get_input_report_mode() != 0x30]
+
+        # rotating the order spreads the skew evenly, no console is always the last one
+        start = self.fan_out_frames % len(bulk)
+        bulk = bulk[start:] + bulk[:start]
+
+        generation = self._controller_state.generation
+        frame = encode_frame(self._input_report, self._controller_state, self._frame_cache)
+        # all reports are prepared first and written back to back without awaiting, the bookkeeping follows
+        prepared = []
+        for protocol in bulk:
+            data = protocol.prepare_frame(frame)
+            if data is None:
+                self._disconnected(protocol)
+            else:
+                prepared.append((protocol, data))
+        written = []
+        first = last = time.perf_counter()
+        for protocol, data in prepared:
+            last = time.perf_counter()
+            try:
+                protocol.transport.write_nowait(data)
+            except NotConnectedError:
+                # the transport already reported the lost connection
+                self._disconnected(protocol)
+            else:
+                written.append((protocol, data))
+        skew = last - first
+        for protocol, data in written:
+            protocol.frame_sent(data, generation)
+        sent = len(written)
+
+        self.fan_out_frames += 1
+        self.last_skew = skew
+        self.max_skew = max(self.max_skew, skew)
+        self._skew_total += skew
+        if others:
+            sent += await super()._send(others)
+        return sent
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats.update({
+            'fan_out_frames': self.fan_out_frames,
+            'skew_mean': self._skew_total / self.fan_out_frames if self.fan_out_frames else 0,
+            'skew_max': self.max_skew,
+        })
+        return stats
@@ -8,6 +8,7 @@ import pkg_resources
 from joycontrol import utils
 from joycontrol.device import HidDevice
 from joycontrol.report import InputReport
+from joycontrol.simulation import create_loopback_server, reconnect_loopback_server
 from joycontrol.transport import L2CAP_Transport
 
 PROFILE_PATH = pkg_resources.resource_filename(
@@ -15,6 +16,28 @@ PROFILE_PATH = pkg_resources.resource_filename(
 logger = logging.getLogger(__name__)
 
 
+class PortsInUseError(OSError):
+    """
+    The HID ports of the adapter are taken, usually by the bluez "input" plugin, see create_hid_server.
+    """
+
+
+BLUETOOTH_RESTART_COMMAND = 'systemctl restart bluetooth.service'
+
+
+async def restart_bluetooth():
+    """
+    Restarts the bluetooth service, frees the HID ports taken by the bluez "input" plugin.
+    """
+    logger.info('Restarting bluetooth service...')
+    await utils.run_system_command(BLUETOOTH_RESTART_COMMAND)
+    await asyncio.sleep(1)
+
+
+def _is_bt_address(device_id):
+    return isinstance(device_id, str) and len(device_id) == 17 and device_id.count(':') == 5
+
+
 async def _send_empty_input_reports(transport):
     report = InputReport()
     for i in range(10):
@@ -22,8 +45,36 @@ async def _send_empty_input_reports(transport):
         await asyncio.sleep(1)
 
 
+async def _connect(reconnect_bt_addr, ctl_psm, itr_psm, device_id=None):
+    """
+    Connects the control and interrupt channel to a Switch without blocking the event loop.
+    :returns connected sockets (ctl, itr)
+    """
+    loop = asyncio.get_event_loop()
+    client_ctl = socket.socket(
+        socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
+    client_itr = socket.socket(
+        socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
+    client_ctl.setblocking(False)
+    client_itr.setblocking(False)
+    try:
+        if device_id is not None:
+            # connect from the given adapter, an adapter address needs no D-Bus lookup
+            address = device_id if _is_bt_address(device_id) else HidDevice(device_id=device_id).address
+            client_ctl.bind((address, 0))
+            client_itr.bind((address, 0))
+        await loop.sock_connect(client_ctl, (reconnect_bt_addr, ctl_psm))
+        await loop.sock_connect(client_itr, (reconnect_bt_addr, itr_psm))
+    except BaseException:
+        client_ctl.close()
+        client_itr.close()
+        raise
+    return client_ctl, client_itr
+
+
 async def create_hid_server(protocol_factory, ctl_psm=17, itr_psm=19, device_id=None, reconnect_bt_addr=None,
-                            capture_file=None):
+                            capture_file=None, flight_recorder=None, send_options=None, console=None,
+                            restart_bluetooth_service=True):
     """
     :param protocol_factory: Factory function returning a ControllerProtocol instance
     :param ctl_psm: hid control channel port
@@ -37,9 +88,18 @@ async def create_hid_server(protocol_factory, ctl_psm=17, itr_psm=19, device_id=
                       If None, a new hid server will be started for the initial paring.
                       Otherwise, the function assumes an initial pairing with the console was already done
                       and reconnects to the provided Bluetooth address.
-    :param capture_file: opened file to log incoming and outgoing messages
+    :param capture_file: opened file or CaptureWriter to log incoming and outgoing messages
+    :param flight_recorder: FlightRecorder keeping the last messages, dumped if the connection is lost
+    :param send_options: SendOptions of the interrupt channel (socket priority, flushable, send queue limit)
+    :param console: SimulatedConsole to connect to instead of a Switch, no Bluetooth is used
+    :param restart_bluetooth_service: If the HID ports are taken, True restarts the bluetooth service,
+                      False raises PortsInUseError (e.g. to let a supervisor restart it once for all adapters)
     :returns transport for input reports and protocol which handles incoming output reports
     """
+    if console is not None:
+        return await create_loopback_server(protocol_factory, console, capture_file=capture_file,
+                                            flight_recorder=flight_recorder, send_options=send_options)
+
     protocol = protocol_factory()
 
     if reconnect_bt_addr is None:
@@ -58,6 +118,10 @@ async def create_hid_server(protocol_factory, ctl_psm=17, itr_psm=19, device_id=
             ctl_sock.bind((hid.address, ctl_psm))
             itr_sock.bind((hid.address, itr_psm))
         except OSError as err:
+            if not restart_bluetooth_service:
+                ctl_sock.close()
+                itr_sock.close()
+                raise PortsInUseError(*err.args) from err
             logger.warning(err)
             # If the ports are already taken, this probably means that the bluez "input" plugin is enabled.
             logger.warning('Fallback: Restarting bluetooth due to incompatibilities with the bluez "input" plugin. '
@@ -65,9 +129,7 @@ async def create_hid_server(protocol_factory, ctl_psm=17, itr_psm=19, device_id=
             # HACK: To circumvent incompatibilities with the bluetooth "input" plugin, we need to restart Bluetooth here.
             # The Switch does not connect to the sockets if we don't.
             # For more info see: https://github.com/mart1nro/joycontrol/issues/8
-            logger.info('Restarting bluetooth service...')
-            await utils.run_system_command('systemctl restart bluetooth.service')
-            await asyncio.sleep(1)
+            await restart_bluetooth()
 
             hid = HidDevice(device_id=device_id)
 
@@ -112,18 +174,12 @@ async def create_hid_server(protocol_factory, ctl_psm=17, itr_psm=19, device_id=
 
     else:
         # Reconnection to reconnect_bt_addr
-        client_ctl = socket.socket(
-            socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
-        client_itr = socket.socket(
-            socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
-        client_ctl.connect((reconnect_bt_addr, ctl_psm))
-        client_itr.connect((reconnect_bt_addr, itr_psm))
-        client_ctl.setblocking(False)
-        client_itr.setblocking(False)
+        client_ctl, client_itr = await _connect(reconnect_bt_addr, ctl_psm, itr_psm, device_id=device_id)
 
     # create transport for the established connection and activate the HID protocol
     transport = L2CAP_Transport(asyncio.get_event_loop(
-    ), protocol, client_itr, client_ctl, 50, capture_file=capture_file)
+    ), protocol, client_itr, client_ctl, 50, capture_file=capture_file, flight_recorder=flight_recorder,
+                                send_options=send_options)
     protocol.connection_made(transport)
 
     # HACK: send some empty input reports until the Switch decides to reply
@@ -138,3 +194,48 @@ async def create_hid_server(protocol_factory, ctl_psm=17, itr_psm=19, device_id=
     """
 
     return protocol.transport, protocol
+
+
+async def reconnect_hid_server(protocol, reconnect_bt_addr, ctl_psm=17, itr_psm=19, device_id=None,
+                               capture_file=None, flight_recorder=None, send_options=None, console=None,
+                               initial_delay=0.5, max_delay=8.0, max_attempts=None):
+    """
+    Connects a protocol to the Switch again after its connection was lost. The protocol keeps its controller
+    state, so held buttons and scripts using the state carry on once the Switch accepts the connection.
+    Failed attempts are retried with exponential backoff.
+
+    :param protocol: ControllerProtocol of the lost connection
+    :param reconnect_bt_addr: Bluetooth address of the Switch
+    :param device_id: ID of the bluetooth adapter to connect from, None for any
+    :param capture_file: opened file or CaptureWriter to log incoming and outgoing messages
+    :param console: SimulatedConsole to connect to instead of a Switch
+    :param initial_delay: seconds before the second attempt, doubled after every failed attempt
+    :param max_delay: maximum seconds between two attempts
+    :param max_attempts: number of attempts before the last error is raised, None to try forever
+    :returns the new transport
+    """
+    if console is not None:
+        return await reconnect_loopback_server(protocol, console, capture_file=capture_file,
+                                               flight_recorder=flight_recorder, send_options=send_options)
+
+    delay = initial_delay
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            client_ctl, client_itr = await _connect(reconnect_bt_addr, ctl_psm, itr_psm, device_id=device_id)
+            break
+        except OSError as err:
+            if max_attempts is not None and attempt >= max_attempts:
+                raise
+            logger.info(f'Reconnect attempt {attempt} failed - {err}, retrying in {delay:.1f} s')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    transport = L2CAP_Transport(asyncio.get_event_loop(), protocol, client_itr, client_ctl, 50,
+                                capture_file=capture_file, flight_recorder=flight_recorder,
+                                send_options=send_options)
+    protocol.connection_made(transport)
+    logger.info(f'Reconnected to {reconnect_bt_addr} after {attempt} attempts, '
+                f'{protocol.last_recovery_time:.2f} s after the connection was lost')
+    return transport
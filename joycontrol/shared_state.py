@@ -0,0 +1,183 @@
+import logging
+import struct
+from multiprocessing import shared_memory
+
+from joycontrol.controller_state import AVAILABLE_BUTTON_MASKS
+from joycontrol.memory import attach_shared_memory, unlink_shared_memory
+
+logger = logging.getLogger(__name__)
+
+"""
+Shared memory control block for injecting input from other processes (e.g. computer vision bots).
+
+Producers write buttons and sticks with plain memory stores, no syscalls and no messages are involved.
+The sender samples the block once per frame (see ControlBlockInput) and publishes the number of the last
+input report it has send.
+
+Layout (little endian, 64 bytes):
+    offset  size
+    0       4       magic b'JCCB'
+    4       4       layout version (1)
+    8       8       sequence counter, odd while the producer is writing (seqlock)
+    16      4       buttons mask, see joycontrol.controller_state.BUTTON_BITS
+    20      2       left stick horizontal, raw 12 bit value, 0xFFFF = leave unchanged
+    22      2       left stick vertical
+    24      2       right stick horizontal
+    26      2       right stick vertical
+    28      4       reserved
+    32      8       scheduled frame, the input is applied once the frame counter reaches it (0 = immediately)
+    40      8       frame counter, number of the last input report send (written by the sender)
+    48      8       sequence counter of the last applied input (written by the sender)
+    56      8       reserved
+
+A producer only ever writes the sequence counter and the input fields, the sender only the fields at 40 and 48.
+"""
+
+MAGIC = b'JCCB'
+VERSION = 1
+BLOCK_SIZE = 64
+
+STICK_UNCHANGED = 0xFFFF
+
+_HEADER = struct.Struct('<4sI')
+_SEQUENCE = struct.Struct('<Q')
+_INPUT = struct.Struct('<IHHHHxxxxQ')
+_SEQUENCE_OFFSET = 8
+_INPUT_OFFSET = 16
+_FRAME_OFFSET = 40
+_APPLIED_OFFSET = 48
+
+
+class ControlBlock:
+    """
+    Control block in shared memory, see module documentation for the layout.
+    """
+
+    def __init__(self, name=None, create=False):
+        """
+        :param name: name of the shared memory block, generated if None and create is True
+        :param create: True to create the block, False to attach to an existing one
+        """
+        if create:
+            self._block = shared_memory.SharedMemory(name=name, create=True, size=BLOCK_SIZE)
+            self._block.buf[:BLOCK_SIZE] = bytes(BLOCK_SIZE)
+            _HEADER.pack_into(self._block.buf, 0, MAGIC, VERSION)
+            _INPUT.pack_into(self._block.buf, _INPUT_OFFSET, 0, *(STICK_UNCHANGED,) * 4, 0)
+        else:
+            self._block = attach_shared_memory(name)
+            magic, version = _HEADER.unpack_from(self._block.buf, 0)
+            if magic != MAGIC or version != VERSION:
+                self._block.close()
+                raise ValueError(f'Shared memory {name} is not a control block of version {VERSION}.')
+        self._owner = create
+        self._buf = self._block.buf
+        self.name = self._block.name
+
+    def get_sequence(self):
+        return _SEQUENCE.unpack_from(self._buf, _SEQUENCE_OFFSET)[0]
+
+    def get_frame(self):
+        """
+        :returns number of the last input report send
+        """
+        return _SEQUENCE.unpack_from(self._buf, _FRAME_OFFSET)[0]
+
+    def get_applied_sequence(self):
+        """
+        :returns sequence counter of the last input applied by the sender
+        """
+        return _SEQUENCE.unpack_from(self._buf, _APPLIED_OFFSET)[0]
+
+    def write(self, buttons, l_stick=None, r_stick=None, frame=0):
+        """
+        Producer side: publishes a new input.
+        :param buttons: buttons mask
+        :param l_stick: raw (horizontal, vertical) values of the left stick, None to leave it unchanged
+        :param r_stick: raw (horizontal, vertical) values of the right stick, None to leave it unchanged
+        :param frame: frame counter value the input is scheduled for, 0 to apply it with the next frame
+        :returns sequence counter of the input
+        """
+        sequence = _SEQUENCE.unpack_from(self._buf, _SEQUENCE_OFFSET)[0]
+        l_h, l_v = l_stick if l_stick is not None else (STICK_UNCHANGED, STICK_UNCHANGED)
+        r_h, r_v = r_stick if r_stick is not None else (STICK_UNCHANGED, STICK_UNCHANGED)
+        # odd sequence: readers retry until the write is complete
+        _SEQUENCE.pack_into(self._buf, _SEQUENCE_OFFSET, sequence + 1)
+        _INPUT.pack_into(self._buf, _INPUT_OFFSET, buttons, l_h, l_v, r_h, r_v, frame)
+        _SEQUENCE.pack_into(self._buf, _SEQUENCE_OFFSET, sequence + 2)
+        return sequence + 2
+
+    def read(self):
+        """
+        Sender side: reads a consistent input.
+        :returns sequence counter and input tuple (buttons, l_h, l_v, r_h, r_v, frame),
+                 None if the producer is writing at the moment
+        """
+        sequence = _SEQUENCE.unpack_from(self._buf, _SEQUENCE_OFFSET)[0]
+        if sequence & 1:
+            return None
+        values = _INPUT.unpack_from(self._buf, _INPUT_OFFSET)
+        if _SEQUENCE.unpack_from(self._buf, _SEQUENCE_OFFSET)[0] != sequence:
+            return None
+        return sequence, values
+
+    def set_frame(self, frame):
+        _SEQUENCE.pack_into(self._buf, _FRAME_OFFSET, frame)
+
+    def set_applied_sequence(self, sequence):
+        _SEQUENCE.pack_into(self._buf, _APPLIED_OFFSET, sequence)
+
+    def close(self):
+        """
+        Detaches from the block, the creator also removes it.
+        """
+        self._buf.release()
+        self._block.close()
+        if self._owner:
+            unlink_shared_memory(self._block)
+
+
+class ControlBlockInput:
+    """
+    Applies the input of a control block to a controller state. Register tick() with a FrameScheduler
+    (see FrameScheduler.add_tick_listener), it is called once per frame.
+    """
+
+    def __init__(self, control_block: ControlBlock, protocol):
+        self._control_block = control_block
+        self._protocol = protocol
+        self._controller_state = protocol.get_controller_state()
+        # buttons of other controllers are ignored, so both Joy-Cons of a pair can share one block
+        self._available = AVAILABLE_BUTTON_MASKS[protocol.controller]
+        self._applied = control_block.get_applied_sequence()
+
+        # statistics
+        self.applied = 0
+        self.torn_reads = 0
+
+    def tick(self):
+        self._control_block.set_frame(self._protocol.get_frame_counter())
+
+        result = self._control_block.read()
+        if result is None:
+            # picked up by the next frame
+            self.torn_reads += 1
+            return
+        sequence, (buttons, l_h, l_v, r_h, r_v, frame) = result
+        if sequence == self._applied or frame > self._protocol.get_frame_counter() + 1:
+            return
+
+        state = self._controller_state
+        try:
+            state.button_state.replace_buttons(buttons & self._available)
+            for stick, h, v in ((state.l_stick_state, l_h, l_v), (state.r_stick_state, r_h, r_v)):
+                if stick is not None:
+                    if h != STICK_UNCHANGED:
+                        stick.set_h(h)
+                    if v != STICK_UNCHANGED:
+                        stick.set_v(v)
+        except ValueError as err:
+            logger.warning(f'Invalid control block input {sequence} - {err}')
+
+        self._applied = sequence
+        self._control_block.set_applied_sequence(sequence)
+        self.applied += 1
@@ -0,0 +1,139 @@
+from joycontrol.controller import Controller
+
+"""
+Encoding of 0x3F (simple HID) input reports. Reference:
+https://github.com/dekuNukem/Nintendo_Switch_Reverse_Engineering/blob/master/bluetooth_hid_notes.md
+
+Layout after the report id (11 bytes):
+    byte 0-1    buttons, controller specific mapping (see _BUTTON_MAPPING)
+    byte 2      hat switch: 0 = up, clockwise up to 7 = up-left, 8 = neutral
+    byte 3-10   Pro Controller: left stick x/y, right stick x/y (16 bit little endian)
+                Joy-Cons: filler, the stick is reported as hat switch
+"""
+
+SIMPLE_HID_DATA_SIZE = 11
+
+HAT_NEUTRAL = 0x08
+
+# names of the standard 3 button bytes (see ButtonState) by byte and bit
+_STANDARD_BUTTONS = (
+    ('y', 'x', 'b', 'a', 'sr', 'sl', 'r', 'zr'),
+    ('minus', 'plus', 'r_stick', 'l_stick', 'home', 'capture', None, None),
+    ('down', 'up', 'right', 'left', 'sr', 'sl', 'l', 'zl'),
+)
+
+# simple HID button bit (0-15) of each button
+_BUTTON_MAPPING = {
+    Controller.PRO_CONTROLLER: {
+        'b': 0, 'a': 1, 'y': 2, 'x': 3, 'l': 4, 'r': 5, 'zl': 6, 'zr': 7,
+        'minus': 8, 'plus': 9, 'l_stick': 10, 'r_stick': 11, 'home': 12, 'capture': 13,
+    },
+    # Joy-Cons are held sideways
+    Controller.JOYCON_L: {
+        'left': 0, 'down': 1, 'up': 2, 'right': 3, 'sl': 4, 'sr': 5,
+        'minus': 8, 'l_stick': 10, 'capture': 13, 'l': 14, 'zl': 15,
+    },
+    Controller.JOYCON_R: {
+        'a': 0, 'x': 1, 'b': 2, 'y': 3, 'sl': 4, 'sr': 5,
+        'plus': 9, 'r_stick': 11, 'home': 12, 'r': 14, 'zr': 15,
+    },
+}
+
+# hat value by (up, right, down, left)
+_HAT = {
+    (1, 0, 0, 0): 0, (1, 1, 0, 0): 1, (0, 1, 0, 0): 2, (0, 1, 1, 0): 3,
+    (0, 0, 1, 0): 4, (0, 0, 1, 1): 5, (0, 0, 0, 1): 6, (1, 0, 0, 1): 7,
+}
+
+# Joy-Con stick filler bytes
+_STICK_FILLER = bytes((0x00, 0x80, 0x00, 0x80, 0x00, 0x80, 0x00, 0x80))
+
+
+def _build_tables(controller):
+    """
+    :returns for each standard button byte a table mapping the byte value to the simple HID button bits
+    """
+    mapping = _BUTTON_MAPPING[controller]
+    tables = []
+    for names in _STANDARD_BUTTONS:
+        table = []
+        for value in range(0x100):
+            bits = 0
+            for bit, name in enumerate(names):
+                if value >> bit & 1 and name in mapping:
+                    bits |= 1 << mapping[name]
+            table.append(bits)
+        tables.append(tuple(table))
+    return tuple(tables)
+
+
+_BUTTON_TABLES = {controller: _build_tables(controller) for controller in Controller}
+
+# Pro Controller d-pad (low nibble of the third button byte: down, up, right, left) to hat
+_DPAD_HAT = tuple(_HAT.get((value >> 1 & 1, value >> 2 & 1, value & 1, value >> 3 & 1), HAT_NEUTRAL)
+                  for value in range(0x10))
+
+
+def stick_hat(stick_state, dead_zone=0.5):
+    """
+    Maps an analog stick to a hat value (used by the Joy-Cons).
+    :param dead_zone: fraction of the calibrated range that is considered neutral
+    """
+    if stick_state is None:
+        return HAT_NEUTRAL
+    try:
+        calibration = stick_state.get_calibration()
+    except ValueError:
+        return HAT_NEUTRAL
+    h = stick_state.get_h() - calibration.h_center
+    v = stick_state.get_v() - calibration.v_center
+    up = v > calibration.v_max_above_center * dead_zone
+    down = v < -calibration.v_max_below_center * dead_zone
+    right = h > calibration.h_max_above_center * dead_zone
+    left = h < -calibration.h_max_below_center * dead_zone
+    return _HAT.get((up, right, down, left), HAT_NEUTRAL)
+
+
+def _stick_bytes(stick_state, out, offset):
+    if stick_state is None:
+        h = v = 0x800
+    else:
+        h = stick_state.get_h()
+        # HID y axis points down
+        v = 0xFFF - stick_state.get_v()
+    # scale 12 to 16 bit
+    h = h << 4 | h >> 8
+    v = v << 4 | v >> 8
+    out[offset] = h & 0xFF
+    out[offset + 1] = h >> 8
+    out[offset + 2] = v & 0xFF
+    out[offset + 3] = v >> 8
+
+
+def encode_simple_hid(controller_state):
+    """
+    :returns the 11 data bytes of a 0x3F input report for the given controller state
+    """
+    controller = controller_state.get_controller()
+    tables = _BUTTON_TABLES[controller]
+    mask = controller_state.button_state.get_mask()
+    byte_3 = mask >> 16
+
+    buttons = tables[0][mask & 0xFF] | tables[1][mask >> 8 & 0xFF] | tables[2][byte_3]
+
+    out = bytearray(SIMPLE_HID_DATA_SIZE)
+    out[0] = buttons & 0xFF
+    out[1] = buttons >> 8
+
+    if controller == Controller.PRO_CONTROLLER:
+        out[2] = _DPAD_HAT[byte_3 & 0x0F]
+        _stick_bytes(controller_state.l_stick_state, out, 3)
+        _stick_bytes(controller_state.r_stick_state, out, 7)
+    else:
+        if controller == Controller.JOYCON_L:
+            out[2] = stick_hat(controller_state.l_stick_state)
+        else:
+            out[2] = stick_hat(controller_state.r_stick_state)
+        out[3:11] = _STICK_FILLER
+
+    return out
@@ -0,0 +1,350 @@
+import asyncio
+import collections
+import logging
+import socket
+import time
+
+from joycontrol.report import OutputReport, OutputReportID, SubCommand
+from joycontrol.rumble import NEUTRAL_RUMBLE_DATA
+from joycontrol.transport import L2CAP_Transport
+
+logger = logging.getLogger(__name__)
+
+"""
+Offline stand-in for a Nintendo Switch. The controller side runs the real protocol and transport code over
+AF_UNIX SOCK_SEQPACKET socket pairs, which keep the report boundaries like L2CAP sockets do.
+"""
+
+# (sub command, data) as send by a Switch connecting a new controller in the "Change Grip/Order" menu
+DEFAULT_HANDSHAKE = (
+    (SubCommand.REQUEST_DEVICE_INFO, []),
+    (SubCommand.SET_SHIPMENT_STATE, [0x00]),
+    (SubCommand.SPI_FLASH_READ, [0x00, 0x60, 0x00, 0x00, 0x10]),
+    (SubCommand.SET_INPUT_REPORT_MODE, [0x30]),
+    (SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME, []),
+    (SubCommand.SPI_FLASH_READ, [0x50, 0x60, 0x00, 0x00, 0x0D]),
+    (SubCommand.SPI_FLASH_READ, [0x80, 0x60, 0x00, 0x00, 0x18]),
+    (SubCommand.SPI_FLASH_READ, [0x98, 0x60, 0x00, 0x00, 0x12]),
+    (SubCommand.SPI_FLASH_READ, [0x10, 0x80, 0x00, 0x00, 0x18]),
+    (SubCommand.SPI_FLASH_READ, [0x3D, 0x60, 0x00, 0x00, 0x19]),
+    (SubCommand.SPI_FLASH_READ, [0x20, 0x60, 0x00, 0x00, 0x18]),
+    (SubCommand.ENABLE_6AXIS_SENSOR, [0x01]),
+    (SubCommand.ENABLE_VIBRATION, [0x01]),
+    (SubCommand.SET_PLAYER_LIGHTS, [0x01]),
+)
+
+# send by a Switch reconnecting an already paired controller
+RECONNECT_HANDSHAKE = (
+    (SubCommand.REQUEST_DEVICE_INFO, []),
+    (SubCommand.SET_INPUT_REPORT_MODE, [0x30]),
+    (SubCommand.ENABLE_VIBRATION, [0x01]),
+    (SubCommand.SET_PLAYER_LIGHTS, [0x01]),
+)
+
+# neutral and a strong low frequency rumble, alternated by the simulated console
+_RUMBLE_PATTERN = (NEUTRAL_RUMBLE_DATA, bytes((0x28, 0x88, 0x60, 0x61, 0x28, 0x88, 0x60, 0x61)))
+
+
+def _decode_stick(data, offset):
+    return data[offset] | (data[offset + 1] & 0x0F) << 8, data[offset + 1] >> 4 | data[offset + 2] << 4
+
+
+class ReceivedReport:
+    """
+    Input report as seen by the simulated console.
+    """
+
+    def __init__(self, receive_time, data):
+        """
+        :param receive_time: time.perf_counter() when the report was received
+        :param data: input report bytes
+        """
+        self.receive_time = receive_time
+        self.data = data
+        self.report_id = data[1]
+        self.timer = data[2]
+        if self.report_id == 0x3F or len(data) < 13:
+            # simple HID reports have their own layout
+            self.buttons = None
+            self.l_stick = None
+            self.r_stick = None
+        else:
+            self.buttons = int.from_bytes(data[4:7], 'little')
+            self.l_stick = _decode_stick(data, 7)
+            self.r_stick = _decode_stick(data, 10)
+
+    def get_reply_to_sub_command(self):
+        """
+        :returns sub command id the 0x21 report replies to, None for other reports
+        """
+        if self.report_id != 0x21 or len(self.data) < 16:
+            return None
+        return self.data[15]
+
+    def __repr__(self):
+        return f'ReceivedReport(report_id=0x{self.report_id:02x}, timer={self.timer}, buttons={self.buttons}, ' \
+               f'l_stick={self.l_stick}, r_stick={self.r_stick})'
+
+
+class SimulatedConsole:
+    """
+    Plays the Switch side of a connection: runs the pairing handshake, sends rumble at a fixed cadence and
+    decodes every input report it receives. Pass it to create_hid_server (or create_loopback_server) instead of
+    connecting to a real Switch.
+    """
+
+    def __init__(self, handshake=DEFAULT_HANDSHAKE, rumble_interval=0.015, reply_timeout=0.5, retries=3,
+                 history=1024, address='98:B6:E9:00:00:01'):
+        """
+        :param handshake: (sub command, data) tuples send after connecting, each one waits for its reply
+        :param rumble_interval: seconds between rumble only output reports, None disables rumble
+        :param reply_timeout: seconds until an unanswered sub command is send again
+        :param retries: number of times an unanswered sub command is send again before giving up
+        :param history: number of received reports kept, see get_history
+        :param address: Bluetooth address the console pretends to have
+        """
+        self.handshake = handshake
+        self.rumble_interval = rumble_interval
+        self.reply_timeout = reply_timeout
+        self.retries = retries
+        self.address = address
+
+        self._loop = None
+        self._ctl_sock = None
+        self._itr_sock = None
+        self._tasks = []
+        self._output_timer = 0
+        self._history = collections.deque(maxlen=history)
+        # (predicate, future) tuples, see wait_for_report
+        self._waiters = []
+        self.handshake_done = None
+
+        # statistics
+        self.connect_time = None
+        self.handshake_time = None
+        self.reports_received = collections.Counter()
+        self.sub_command_retries = 0
+        self.rumble_sent = 0
+        self.timer_gaps = 0
+        self._last_timer = None
+        self._last_receive_time = None
+        self.max_report_interval = 0
+
+    def connect(self):
+        """
+        Creates the socket pairs of the control and interrupt channel.
+        :returns controller side sockets (ctl, itr), non blocking
+        """
+        self._loop = asyncio.get_event_loop()
+        self._ctl_sock, client_ctl = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._itr_sock, client_itr = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        for sock in (self._ctl_sock, self._itr_sock, client_ctl, client_itr):
+            sock.setblocking(False)
+        self.handshake_done = self._loop.create_future()
+        self.connect_time = time.perf_counter()
+        return client_ctl, client_itr
+
+    def start(self):
+        """
+        Starts receiving, the handshake and afterwards rumble.
+        """
+        self._tasks.append(asyncio.ensure_future(self._receive()))
+        self._tasks.append(asyncio.ensure_future(self._run()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, ConnectionError):
+                pass
+        self._tasks.clear()
+        self._itr_sock.close()
+        self._ctl_sock.close()
+
+    async def _run(self):
+        start = time.perf_counter()
+        try:
+            for sub_command, data in self.handshake:
+                await self.send_sub_command(sub_command, data)
+        except Exception as err:
+            self.handshake_done.set_exception(err)
+            raise
+        self.handshake_time = time.perf_counter() - start
+        self.handshake_done.set_result(self.handshake_time)
+        logger.info(f'Simulated console: handshake done in {self.handshake_time * 1e3:.1f} ms')
+
+        if self.rumble_interval is not None:
+            await self._rumble()
+
+    async def _send(self, report):
+        report.set_timer(self._output_timer)
+        self._output_timer = (self._output_timer + 1) % 0x10
+        await self._loop.sock_sendall(self._itr_sock, bytes(report))
+
+    async def send_control(self, message):
+        """
+        Sends a HIDP message on the control channel, e.g. HID_CONTROL which has no reply.
+        """
+        await self._loop.sock_sendall(self._ctl_sock, bytes(message))
+
+    async def control_transaction(self, message, timeout=1.0):
+        """
+        Sends a HIDP message on the control channel and waits for the reply.
+        :returns reply (bytes)
+        """
+        await self.send_control(message)
+        return await asyncio.wait_for(self._loop.sock_recv(self._ctl_sock, 400), timeout)
+
+    def close_control_channel(self):
+        """
+        Closes only the control channel, like a Switch tearing down the connection.
+        """
+        self._ctl_sock.close()
+
+    async def send_sub_command(self, sub_command, data=()):
+        """
+        Sends a sub command and waits for its reply, sends it again after reply_timeout.
+        :returns ReceivedReport of the reply
+        """
+        sub_command_id = sub_command.value if isinstance(sub_command, SubCommand) else sub_command
+        report = OutputReport()
+        report.set_output_report_id(OutputReportID.SUB_COMMAND)
+        report.set_sub_command(sub_command)
+        report.set_sub_command_data(data)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.sub_command_retries += 1
+                logger.warning(f'Simulated console: no reply to sub command 0x{sub_command_id:02x} - retrying')
+            reply = self._add_waiter(lambda _report: _report.get_reply_to_sub_command() == sub_command_id)
+            await self._send(report)
+            try:
+                return await asyncio.wait_for(reply, self.reply_timeout)
+            except asyncio.TimeoutError:
+                pass
+        raise TimeoutError(f'No reply to sub command 0x{sub_command_id:02x}.')
+
+    async def _rumble(self):
+        report = OutputReport()
+        report.set_output_report_id(OutputReportID.RUMBLE_ONLY)
+        deadline = self._loop.time()
+        while True:
+            report.data[3:11] = _RUMBLE_PATTERN[self.rumble_sent // 8 % len(_RUMBLE_PATTERN)]
+            await self._send(report)
+            self.rumble_sent += 1
+            deadline += self.rumble_interval
+            await asyncio.sleep(max(0, deadline - self._loop.time()))
+
+    async def _receive(self):
+        while True:
+            data = await self._loop.sock_recv(self._itr_sock, 400)
+            if not data:
+                logger.info('Simulated console: controller disconnected')
+                break
+            report = ReceivedReport(time.perf_counter(), data)
+            self._update_stats(report)
+            self._history.append(report)
+
+            if self._waiters:
+                for waiter in list(self._waiters):
+                    predicate, future = waiter
+                    if future.done():
+                        self._waiters.remove(waiter)
+                    elif predicate(report):
+                        future.set_result(report)
+                        self._waiters.remove(waiter)
+
+    def _update_stats(self, report):
+        self.reports_received[report.report_id] += 1
+        if report.report_id in (0x30, 0x31):
+            # the timer increments with every periodic report, a jump means reports were dropped on the way
+            if self._last_timer is not None and report.timer != (self._last_timer + 1) % 0x100:
+                self.timer_gaps += 1
+            self._last_timer = report.timer
+            if self._last_receive_time is not None:
+                self.max_report_interval = max(self.max_report_interval,
+                                               report.receive_time - self._last_receive_time)
+            self._last_receive_time = report.receive_time
+
+    def _add_waiter(self, predicate):
+        future = self._loop.create_future()
+        self._waiters.append((predicate, future))
+        return future
+
+    async def wait_for_report(self, predicate, timeout=None):
+        """
+        :param predicate: function called with every received ReceivedReport
+        :param timeout: seconds, None to wait forever
+        :returns first ReceivedReport received afterwards the predicate returns True for
+        """
+        return await asyncio.wait_for(self._add_waiter(predicate), timeout)
+
+    def get_history(self):
+        """
+        :returns the last received reports (ReceivedReport), oldest first
+        """
+        return list(self._history)
+
+    def get_stats(self):
+        return {
+            'handshake_time': self.handshake_time,
+            'reports_received': dict(self.reports_received),
+            'sub_command_retries': self.sub_command_retries,
+            'rumble_sent': self.rumble_sent,
+            'timer_gaps': self.timer_gaps,
+            'max_report_interval': self.max_report_interval,
+        }
+
+
+class LoopbackTransport(L2CAP_Transport):
+    """
+    L2CAP_Transport over socket pairs. Reports fake Bluetooth addresses, the protocol uses them e.g. in the
+    device info reply.
+    """
+
+    def __init__(self, loop, protocol, itr_sock, ctr_sock, read_buffer_size, address='94:58:CB:00:00:01',
+                 peer_address='98:B6:E9:00:00:01', **kwargs):
+        """
+        :param address: Bluetooth address of the emulated controller
+        :param peer_address: Bluetooth address of the simulated console
+        """
+        super().__init__(loop, protocol, itr_sock, ctr_sock, read_buffer_size, **kwargs)
+        self._extra_info['sockname'] = (address, 19)
+        self._extra_info['peername'] = (peer_address, 19)
+
+
+async def create_loopback_server(protocol_factory, console, capture_file=None, flight_recorder=None,
+                                 send_options=None):
+    """
+    Counterpart of create_hid_server connecting to a SimulatedConsole.
+    :returns transport for input reports and protocol which handles incoming output reports
+    """
+    protocol = protocol_factory()
+    client_ctl, client_itr = console.connect()
+
+    transport = LoopbackTransport(asyncio.get_event_loop(), protocol, client_itr, client_ctl, 50,
+                                  peer_address=console.address, capture_file=capture_file,
+                                  flight_recorder=flight_recorder, send_options=send_options)
+    protocol.connection_made(transport)
+
+    output_report = asyncio.ensure_future(protocol.wait_for_output_report())
+    console.start()
+    await output_report
+
+    return protocol.transport, protocol
+
+
+async def reconnect_loopback_server(protocol, console, capture_file=None, flight_recorder=None, send_options=None):
+    """
+    Counterpart of reconnect_hid_server connecting an existing protocol to a SimulatedConsole.
+    :returns the new transport
+    """
+    client_ctl, client_itr = console.connect()
+    transport = LoopbackTransport(asyncio.get_event_loop(), protocol, client_itr, client_ctl, 50,
+                                  peer_address=console.address, capture_file=capture_file,
+                                  flight_recorder=flight_recorder, send_options=send_options)
+    protocol.connection_made(transport)
+    console.start()
+    return transport
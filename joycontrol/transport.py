@@ -1,32 +1,170 @@
+import array
 import asyncio
+import collections
+import fcntl
 import logging
-import struct
-import time
+import socket
+import termios
 from typing import Any
 
 from joycontrol import utils
+from joycontrol.capture import CaptureWriter
 
 logger = logging.getLogger(__name__)
 
 
+# Bluetooth socket options, see <bluetooth/bluetooth.h>
+SOL_BLUETOOTH = 274
+BT_FLUSHABLE = 8
+
+# SIOCOUTQ, same value as TIOCOUTQ
+_SIOCOUTQ = getattr(termios, 'TIOCOUTQ', 0x5411)
+
+# periodic input reports, an unsent one is worthless once a newer one exists
+_REPLACEABLE_REPORTS = (0x30, 0x3F)
+
+# seconds until a report held back because of a full send queue is tried again
+_RETRY_INTERVAL = 0.002
+
+# maximum number of output reports received per reader wakeup
+MAX_READ_BATCH = 32
+
+# HIDP transaction types (high nibble of the control channel header byte), see the Bluetooth HID profile
+HIDP_HANDSHAKE = 0x00
+HIDP_HID_CONTROL = 0x10
+HIDP_GET_REPORT = 0x40
+HIDP_SET_REPORT = 0x50
+HIDP_GET_PROTOCOL = 0x60
+HIDP_SET_PROTOCOL = 0x70
+HIDP_DATA = 0xA0
+
+# HANDSHAKE result codes
+HANDSHAKE_SUCCESSFUL = 0x00
+HANDSHAKE_ERR_INVALID_REPORT_ID = 0x02
+HANDSHAKE_ERR_UNSUPPORTED_REQUEST = 0x03
+HANDSHAKE_ERR_INVALID_PARAMETER = 0x04
+HANDSHAKE_ERR_UNKNOWN = 0x0E
+
+# HID_CONTROL operations
+HID_CONTROL_SUSPEND = 0x03
+HID_CONTROL_EXIT_SUSPEND = 0x04
+HID_CONTROL_VIRTUAL_CABLE_UNPLUG = 0x05
+
+# report types of GET_REPORT, SET_REPORT and DATA
+REPORT_TYPE_INPUT = 0x01
+REPORT_TYPE_OUTPUT = 0x02
+
+PROTOCOL_REPORT = 0x01
+
+
 class NotConnectedError(ConnectionResetError):
     pass
 
 
+class VirtualCableUnplugError(ConnectionResetError):
+    """
+    The host unplugged the virtual cable, i.e. it removed the pairing. Reconnecting is pointless.
+    """
+
+
+class SendOptions:
+    """
+    Options of the interrupt channel send path.
+    """
+
+    def __init__(self, priority=None, flushable=None, max_queue_bytes=None):
+        """
+        :param priority: SO_PRIORITY of the interrupt socket (0-6 without CAP_NET_ADMIN), None leaves it unchanged
+        :param flushable: True marks the packets L2CAP flushable (BT_FLUSHABLE), so the adapter may discard
+                          packets exceeding the flush timeout instead of retransmitting them, None leaves it unchanged
+        :param max_queue_bytes: periodic input reports are held back while the kernel send queue holds more than
+                                this many bytes, a held back report is replaced by newer ones. The kernel accounts
+                                socket memory, including some hundred bytes overhead per packet.
+                                None disables the check.
+        """
+        self.priority = priority
+        self.flushable = flushable
+        self.max_queue_bytes = max_queue_bytes
+
+    def apply(self, sock):
+        if self.priority is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, self.priority)
+            except OSError as err:
+                logger.warning(f'Setting socket priority {self.priority} failed - {err}')
+        if self.flushable is not None:
+            try:
+                sock.setsockopt(SOL_BLUETOOTH, BT_FLUSHABLE, int(self.flushable))
+            except OSError as err:
+                logger.warning(f'Setting L2CAP flushable option failed - {err}')
+
+
 class L2CAP_Transport(asyncio.Transport):
-    def __init__(self, loop, protocol, itr_sock, ctr_sock, read_buffer_size, capture_file=None) -> None:
+    def __init__(self, loop, protocol, itr_sock, ctr_sock, read_buffer_size, capture_file=None,
+                 flight_recorder=None, send_options=None) -> None:
+        """
+        :param capture_file: opened file or CaptureWriter, every report is written to it
+        :param flight_recorder: FlightRecorder keeping the last reports for dumps after failures
+        :param send_options: SendOptions of the interrupt channel
+        """
         super(L2CAP_Transport, self).__init__()
         self._loop = loop
         self._protocol = protocol
         self._itr_sock = itr_sock
         self._ctr_sock = ctr_sock
         self._read_buffer_size = read_buffer_size
-        self._capture_file = capture_file
+        # preallocated receive buffers of the reader, see _read_batch
+        self._read_buffers = [bytearray(read_buffer_size) for _ in range(MAX_READ_BATCH)]
+        if capture_file is None or isinstance(capture_file, CaptureWriter):
+            # a given writer is closed by its owner, it may outlive the transport (see server.reconnect_hid_server)
+            self._capture = capture_file
+            self._owns_capture = False
+        else:
+            self._capture = CaptureWriter(capture_file)
+            self._owns_capture = True
+        self._flight_recorder = flight_recorder
         self._extra_info = {
             'peername': self._itr_sock.getpeername(),
             'sockname': self._itr_sock.getsockname(),
-            'socket': self._itr_sock
+            'socket': self._itr_sock,
+            'flight_recorder': flight_recorder,
+            'capture_writer': self._capture,
         }
+
+        self._send_options = send_options or SendOptions()
+        self._send_options.apply(itr_sock)
+        self._sndbuf = itr_sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        # Bluetooth sockets report the free space of the send buffer instead of the queued bytes
+        self._outq_is_free_space = itr_sock.family == getattr(socket, 'AF_BLUETOOTH', None)
+        self._outq = array.array('i', [0])
+        # reports which must be delivered in order, e.g. sub command replies
+        self._pending_reports = collections.deque()
+        # newest periodic input report which could not be send yet
+        self._pending_frame = None
+        self._held_frame = None
+        self._writer_registered = False
+        self._retry_handle = None
+
+        # statistics
+        self.reports_sent = 0
+        self.frames_replaced = 0
+        self.frames_held = 0
+        self.send_blocked = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.reader_wakeups = 0
+        self.reports_received = 0
+        self.rumble_collapsed = 0
+        self.max_read_batch = 0
+        self.control_messages = 0
+
+        # control channel state, see _control_reader
+        self.suspended = False
+        # report id -> last input report send, answers GET_REPORT
+        self._last_input_reports = {}
+        self._control_task = asyncio.ensure_future(self._control_reader())
+        self._control_task.add_done_callback(utils.create_error_check_callback(ignore=asyncio.CancelledError))
+        self.unplugged = False
         self._is_closing = False
         self._is_reading = asyncio.Event()
         # start underlying reader
@@ -37,16 +175,71 @@ class L2CAP_Transport(asyncio.Transport):
     async def _reader(self):
         while True:
             try:
-                data = await self.read()
+                batch = await self._read_batch()
             except NotConnectedError:
                 self._read_thread = None
                 break
 
-            await self._protocol.report_received(data, self._itr_sock.getpeername())
+            for data in batch:
+                try:
+                    await self._protocol.report_received(data, self._extra_info['peername'])
+                except Exception:
+                    if self._flight_recorder is not None:
+                        # written in the executor, the event loop keeps serving the other connections
+                        asyncio.ensure_future(self._flight_recorder.dump_async('error'))
+                    raise
+
+    async def _read_batch(self):
+        """
+        Waits for an output report and receives all others already queued in the socket without waiting.
+        Rumble only reports followed by a newer report are skipped, every output report carries rumble data.
+
+        :returns list of memoryviews of the reports, valid until the next call
+        """
+        await self._is_reading.wait()
+        buffers = self._read_buffers
+        views = []
+        size = await self._loop.sock_recv_into(self._itr_sock, buffers[0])
+        while True:
+            if not size:
+                # disconnect happened
+                logger.error('No data received.')
+                self._protocol.connection_lost()
+                raise NotConnectedError('No data received.')
+            views.append(memoryview(buffers[len(views)])[:size])
+            if len(views) == len(buffers):
+                break
+            try:
+                size = self._itr_sock.recv_into(buffers[len(views)])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as err:
+                logger.error(err)
+                self._protocol.connection_lost()
+                raise NotConnectedError(err)
+
+        self.reader_wakeups += 1
+        self.reports_received += len(views)
+        if len(views) > self.max_read_batch:
+            self.max_read_batch = len(views)
+
+        batch = []
+        last = len(views) - 1
+        for i, view in enumerate(views):
+            if self._flight_recorder is not None:
+                self._flight_recorder.record(view)
+            if self._capture is not None:
+                self._capture.write(view)
+            if i < last and len(view) > 1 and view[0] == 0xA2 and view[1] == 0x10:
+                self.rumble_collapsed += 1
+                continue
+            batch.append(view)
+        return batch
 
     def start_reader(self):
         """
-        Starts the transport reader which calls the protocols report_received function for every incoming message
+        Starts the transport reader which calls the protocols report_received function for every incoming message.
+        The reader runs for the lifetime of the transport, the protocol dispatches reports by input report mode.
         """
         if self._read_thread is not None:
             raise ValueError('Reader is already running.')
@@ -56,29 +249,6 @@ class L2CAP_Transport(asyncio.Transport):
             ignore=asyncio.CancelledError)
         self._read_thread.add_done_callback(callback)
 
-    async def set_reader(self, reader: asyncio.Future):
-        """
-        Cancel the currently running reader and register the new one.
-        A reader is a coroutine that calls this transports 'read' function.
-        The 'read' function calls can be paused by calling pause_reading of this transport.
-        :param reader: future reader
-        """
-        if self._read_thread is not None:
-            # cancel currently running reader
-            if self._read_thread.cancel():
-                try:
-                    await self._read_thread
-                except asyncio.CancelledError:
-                    pass
-        # Create callback for debugging in case the reader is failing
-        err_callback = utils.create_error_check_callback(
-            ignore=asyncio.CancelledError)
-        reader.add_done_callback(err_callback)
-        self._read_thread = reader
-
-    def get_reader(self):
-        return self._read_thread
-
     async def read(self):
         """
         Read data from the underlying socket. This function waits,
@@ -97,11 +267,11 @@ class L2CAP_Transport(asyncio.Transport):
             self._protocol.connection_lost()
             raise NotConnectedError('No data received.')
 
-        if self._capture_file is not None:
-            # write data to log file
-            _time = struct.pack('d', time.time())
-            size = struct.pack('i', len(data))
-            self._capture_file.write(_time + size + data)
+        if self._flight_recorder is not None:
+            self._flight_recorder.record(data)
+
+        if self._capture is not None:
+            self._capture.write(data)
 
         return data
 
@@ -109,7 +279,7 @@ class L2CAP_Transport(asyncio.Transport):
         """
         :returns True if the reader is running
         """
-        return self._reader is not None and self._is_reading.is_set()
+        return self._read_thread is not None and self._is_reading.is_set()
 
     def pause_reading(self) -> None:
         """
@@ -125,31 +295,249 @@ class L2CAP_Transport(asyncio.Transport):
 
     def set_read_buffer_size(self, size):
         self._read_buffer_size = size
+        self._read_buffers = [bytearray(size) for _ in range(MAX_READ_BATCH)]
 
     async def write(self, data: Any) -> None:
+        """
+        Sends a report without waiting for the socket. Reports which can not be send right away are kept and send
+        by a writer callback. A periodic input report (0x30, 0x3F) which is still pending is replaced by the
+        newer one.
+
+        Raises NotConnectedError if the connection was lost.
+        """
         if isinstance(data, bytes):
             _bytes = data
         else:
             _bytes = bytes(data)
 
-        if self._capture_file is not None:
-            # write data to log file
-            _time = struct.pack('d', time.time())
-            size = struct.pack('i', len(_bytes))
-            self._capture_file.write(_time + size + _bytes)
-
         # logger.debug(f'sending "{_bytes}"')
 
+        if len(_bytes) > 1 and _bytes[0] == 0xA1 and _bytes[1] in _REPLACEABLE_REPORTS:
+            if self._pending_frame is not None:
+                self.frames_replaced += 1
+            self._pending_frame = _bytes
+        else:
+            self._pending_reports.append(_bytes)
+        self._send_pending()
+
+    def write_nowait(self, data):
+        """
+        Like write for a periodic input report, for callers sending to several transports back to back
+        (see scheduler.FanOutScheduler). The report goes straight to the socket if nothing is queued before it and
+        no queue limit is set, the queue depth statistics are not updated then.
+
+        Raises NotConnectedError if the connection was lost.
+        """
+        if (self._pending_frame is None and not self._pending_reports and not self.suspended and
+                self._send_options.max_queue_bytes is None):
+            try:
+                self._itr_sock.send(data)
+            except BlockingIOError:
+                pass
+            except OSError as err:
+                self._cancel_send_callbacks()
+                logger.error(err)
+                self._protocol.connection_lost()
+                raise NotConnectedError(err)
+            else:
+                self._sent(data)
+                return
+        if self._pending_frame is not None:
+            self.frames_replaced += 1
+        self._pending_frame = data
+        self._send_pending()
+
+    def _sent(self, data):
+        self.reports_sent += 1
+        if data[0] == 0xA1:
+            self._last_input_reports[data[1]] = data
+        if self._flight_recorder is not None:
+            self._flight_recorder.record(data)
+        if self._capture is not None:
+            self._capture.write(data)
+
+    def get_queue_depth(self):
+        """
+        :returns bytes of socket memory queued in the kernel for sending
+        """
+        try:
+            fcntl.ioctl(self._itr_sock.fileno(), _SIOCOUTQ, self._outq, True)
+        except OSError:
+            return 0
+        if self._outq_is_free_space:
+            return max(0, self._sndbuf - self._outq[0])
+        return self._outq[0]
+
+    def _send_pending(self):
+        sock = self._itr_sock
         try:
-            await self._loop.sock_sendall(self._itr_sock, _bytes)
+            while self._pending_reports:
+                sock.send(self._pending_reports[0])
+                self._sent(self._pending_reports.popleft())
+
+            if self._pending_frame is not None and not self.suspended:
+                depth = self.queue_depth = self.get_queue_depth()
+                if depth > self.max_queue_depth:
+                    self.max_queue_depth = depth
+                max_queue_bytes = self._send_options.max_queue_bytes
+                if max_queue_bytes is not None and depth > max_queue_bytes:
+                    # the report would arrive late, hold it back until the queue drained or a newer one replaces it
+                    if self._held_frame is not self._pending_frame:
+                        self.frames_held += 1
+                        self._held_frame = self._pending_frame
+                    # the socket is writable, a registered writer would fire until the queue drained
+                    if self._writer_registered:
+                        self._loop.remove_writer(sock.fileno())
+                        self._writer_registered = False
+                    if self._retry_handle is None:
+                        self._retry_handle = self._loop.call_later(_RETRY_INTERVAL, self._retry)
+                    return
+                sock.send(self._pending_frame)
+                self._sent(self._pending_frame)
+                self._pending_frame = self._held_frame = None
+        except BlockingIOError:
+            self.send_blocked += 1
+            if not self._writer_registered:
+                self._loop.add_writer(sock.fileno(), self._on_writable)
+                self._writer_registered = True
+            return
         except OSError as err:
+            self._cancel_send_callbacks()
             logger.error(err)
             self._protocol.connection_lost()
             raise NotConnectedError(err)
-        except ConnectionResetError as err:
-            logger.error(err)
-            self._protocol.connection_lost()
-            raise err
+
+        if self._writer_registered:
+            self._loop.remove_writer(sock.fileno())
+            self._writer_registered = False
+
+    def _on_writable(self):
+        try:
+            self._send_pending()
+        except NotConnectedError:
+            pass
+
+    def _retry(self):
+        self._retry_handle = None
+        self._on_writable()
+
+    def _cancel_send_callbacks(self):
+        if self._retry_handle is not None:
+            self._retry_handle.cancel()
+            self._retry_handle = None
+        if self._writer_registered:
+            self._loop.remove_writer(self._itr_sock.fileno())
+            self._writer_registered = False
+
+    async def _control_reader(self):
+        """
+        Answers the HIDP transactions of the control channel. A closed control channel is reported as lost
+        connection right away, without waiting for a failing interrupt channel send.
+        """
+        while True:
+            try:
+                data = await self._loop.sock_recv(self._ctr_sock, max(64, self._read_buffer_size))
+            except OSError as err:
+                logger.error(f'Control channel error - {err}')
+                data = b''
+            if not data:
+                logger.error('Control channel closed.')
+                self._protocol.connection_lost()
+                break
+
+            self.control_messages += 1
+            try:
+                reply = await self._handle_control_message(data)
+            except (NotConnectedError, asyncio.CancelledError):
+                raise
+            except Exception as err:
+                # a broken message must not end the disconnect detection
+                logger.exception(f'Control channel message 0x{data[0]:02x} failed - {err}')
+                reply = bytes((HIDP_HANDSHAKE | HANDSHAKE_ERR_UNKNOWN,))
+            if self.unplugged:
+                break
+            if reply is not None:
+                try:
+                    await self._loop.sock_sendall(self._ctr_sock, reply)
+                except OSError as err:
+                    logger.error(f'Control channel error - {err}')
+                    self._protocol.connection_lost()
+                    break
+
+    async def _handle_control_message(self, data):
+        """
+        :param data: HIDP message received on the control channel
+        :returns reply (bytes) or None
+        """
+        transaction = data[0] & 0xF0
+        parameter = data[0] & 0x0F
+
+        if transaction == HIDP_SET_REPORT:
+            if parameter & 0x03 != REPORT_TYPE_OUTPUT or len(data) < 2:
+                return bytes((HIDP_HANDSHAKE | HANDSHAKE_ERR_UNSUPPORTED_REQUEST,))
+            # same as an output report on the interrupt channel
+            await self._protocol.report_received(bytes((HIDP_DATA | REPORT_TYPE_OUTPUT,)) + data[1:],
+                                                 self._extra_info['peername'])
+            return bytes((HIDP_HANDSHAKE | HANDSHAKE_SUCCESSFUL,))
+
+        elif transaction == HIDP_GET_REPORT:
+            report = None
+            if parameter & 0x03 == REPORT_TYPE_INPUT and len(data) >= 2:
+                report = self._last_input_reports.get(data[1])
+            if report is None:
+                return bytes((HIDP_HANDSHAKE | HANDSHAKE_ERR_INVALID_REPORT_ID,))
+            reply = bytes((HIDP_DATA | REPORT_TYPE_INPUT,)) + report[1:]
+            if parameter & 0x08 and len(data) >= 4:
+                # the host limits the size of the report
+                reply = reply[:1 + int.from_bytes(data[2:4], 'little')]
+            return reply
+
+        elif transaction == HIDP_GET_PROTOCOL:
+            return bytes((HIDP_DATA, PROTOCOL_REPORT))
+
+        elif transaction == HIDP_SET_PROTOCOL:
+            if parameter & 0x01 != PROTOCOL_REPORT:
+                # no boot protocol
+                return bytes((HIDP_HANDSHAKE | HANDSHAKE_ERR_INVALID_PARAMETER,))
+            return bytes((HIDP_HANDSHAKE | HANDSHAKE_SUCCESSFUL,))
+
+        elif transaction == HIDP_HID_CONTROL:
+            # HID_CONTROL is not answered
+            if parameter == HID_CONTROL_SUSPEND:
+                logger.info('Host suspended - holding back input reports')
+                self.suspended = True
+            elif parameter == HID_CONTROL_EXIT_SUSPEND:
+                logger.info('Host resumed')
+                self.suspended = False
+                self._on_writable()
+            elif parameter == HID_CONTROL_VIRTUAL_CABLE_UNPLUG:
+                logger.info('Host unplugged the virtual cable')
+                self.unplugged = True
+                # closes the transport, the protocol tells reconnecting apart from an unplug by the error
+                self._protocol.connection_lost(VirtualCableUnplugError('Host unplugged the virtual cable.'))
+            return None
+
+        elif transaction == HIDP_HANDSHAKE:
+            return None
+
+        logger.warning(f'HIDP transaction 0x{data[0]:02x} not supported')
+        return bytes((HIDP_HANDSHAKE | HANDSHAKE_ERR_UNSUPPORTED_REQUEST,))
+
+    def get_stats(self):
+        return {
+            'reports_sent': self.reports_sent,
+            'reports_pending': len(self._pending_reports) + (self._pending_frame is not None),
+            'frames_replaced': self.frames_replaced,
+            'frames_held': self.frames_held,
+            'send_blocked': self.send_blocked,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'reader_wakeups': self.reader_wakeups,
+            'reports_received': self.reports_received,
+            'rumble_collapsed': self.rumble_collapsed,
+            'max_read_batch': self.max_read_batch,
+            'control_messages': self.control_messages,
+        }
 
     def abort(self) -> None:
         raise NotImplementedError
@@ -167,17 +555,28 @@ class L2CAP_Transport(asyncio.Transport):
         if not self._is_closing:
             # was not already closed
             self._is_closing = True
-            if self._read_thread.cancel():
-                # wait for reader to cancel
-                try:
-                    await self._read_thread
-                except asyncio.CancelledError:
-                    pass
+            # the reader is gone already if the connection was lost
+            for task in (self._read_thread, self._control_task):
+                if task is not None and task is not asyncio.current_task() and task.cancel():
+                    # wait for reader to cancel
+                    try:
+                        await task
+                    except asyncio.CancelledError:
+                        pass
+
+            self._cancel_send_callbacks()
 
             # interrupt connection should be closed first
             self._itr_sock.close()
             self._ctr_sock.close()
 
+            if self._owns_capture:
+                # write the remaining records before the capture file is closed by the caller
+                self._capture.close()
+                await self._loop.run_in_executor(None, self._capture.wait_closed)
+                stats = self._capture.get_stats()
+                logger.info(f'Capture: {stats["records"]} records captured, {stats["dropped"]} dropped')
+
     def set_protocol(self, protocol: asyncio.BaseProtocol) -> None:
         self._protocol = protocol
 
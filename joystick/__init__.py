@@ -6,6 +6,8 @@
 
 import aiofiles
 import enum
+import glob
+import os
 import struct
 
 
@@ -40,3 +42,12 @@ async def joystick_poll(id):
         while (await joystick.readinto(event) > 0):
             time, value, type, number = struct.unpack(EVENT_FORMAT, event)
             yield JoystickEvent(time, value, type, number)
+
+
+def event_device_path(id):
+    """
+    :returns path of the evdev device belonging to joystick id (e.g. for force feedback), None if there is none
+    """
+    for path in sorted(glob.glob(f"/sys/class/input/js{id}/device/event*")):
+        return os.path.join("/dev/input", os.path.basename(path))
+    return None
@@ -9,11 +9,14 @@ from aioconsole import ainput
 
 from joycontrol import logging_default as log, utils
 from joycontrol.command_line_interface import ControllerCLI
+from joycontrol.capture import ChunkedCaptureWriter, FlightRecorder
 from joycontrol.controller import Controller
 from joycontrol.controller_state import ControllerState, button_push, button_press, button_release
-from joycontrol.memory import FlashMemory
+from joycontrol.memory import FlashMemory, FlashJournal
+from joycontrol.nfc_tag import AmiiboLibrary, NFCTag
 from joycontrol.protocol import controller_protocol_factory
 from joycontrol.server import create_hid_server
+from joycontrol.transport import SendOptions
 
 logger = logging.getLogger(__name__)
 
@@ -24,9 +27,15 @@ While running the cli, call "help" for an explanation of available commands.
 Usage:
     run_controller_cli.py <controller> [--device_id | -d  <bluetooth_adapter_id>]
                                        [--spi_flash <spi_flash_memory_file>]
+                                       [--flash_journal <flash_journal_file>]
                                        [--reconnect_bt_addr | -r <console_bluetooth_address>]
                                        [--log | -l <communication_log_file>]
+                                       [--log_compression <none|zlib|lzma>]
                                        [--nfc <nfc_data_file>]
+                                       [--amiibo_library <directory>]
+                                       [--flight_recorder <directory>]
+                                       [--socket_priority <priority>] [--flushable]
+                                       [--max_send_queue <bytes>]
     run_controller_cli.py -h | --help
 
 Arguments:
@@ -43,14 +52,36 @@ Options:
                                             Allows displaying of JoyCon colors.
                                             Memory dumps can be created using the dump_spi_flash.py script.
 
+    --flash_journal <flash_journal_file>    Journal of the flash writes of the Switch (e.g. stick calibration).
+                                            Created if missing, replayed on start so the writes survive restarts.
+
     -r --reconnect_bt_addr <console_bluetooth_address>  Previously connected Switch console Bluetooth address in string
                                                         notation (e.g. "FF:FF:FF:FF:FF:FF") for reconnection.
                                                         Does not require the "Change Grip/Order" menu to be opened,
 
     -l --log <communication_log_file>       Write hid communication (input reports and output reports) to a file.
 
+    --log_compression <none|zlib|lzma>      Write the log in the chunked, indexed capture format with the given
+                                            compression instead of the legacy format.
+
     --nfc <nfc_data_file>                   Sets the nfc data of the controller to a given nfc dump upon initial
                                             connection.
+
+    --amiibo_library <directory>            Directory of nfc dumps (*.bin) that can be selected by name using the
+                                            "nfc" command. Dumps are loaded on first use.
+
+    --flight_recorder <directory>           Keep the last reports of both directions in memory. They are dumped to a
+                                            capture file in the directory if the connection is lost, on errors and
+                                            on the "dump" command.
+
+    --socket_priority <priority>            SO_PRIORITY of the interrupt channel socket.
+
+    --flushable                             Mark input reports L2CAP flushable, the adapter may discard reports
+                                            instead of retransmitting them on a bad link.
+
+    --max_send_queue <bytes>                Hold back input reports while the kernel send queue holds more than the
+                                            given number of bytes. Held back reports are replaced by newer ones
+                                            instead of reaching the Switch late.
 """
 
 
@@ -164,12 +195,13 @@ async def mash_button(controller_state, button, interval):
     await user_input
 
 
-def _register_commands_with_controller_state(controller_state, cli):
+def _register_commands_with_controller_state(controller_state, cli, amiibo_library=None):
     """
     Commands registered here can use the given controller state.
     The doc string of commands will be printed by the CLI when calling "help"
     :param cli:
     :param controller_state:
+    :param amiibo_library: optional AmiiboLibrary for the nfc command
     """
     async def test_buttons():
         """
@@ -246,9 +278,10 @@ def _register_commands_with_controller_state(controller_state, cli):
 
         Usage:
             nfc <file_name>          Set controller state NFC content to file
+            nfc <amiibo_name>        Set controller state NFC content to a dump of the amiibo library
+            nfc list                 List the dumps of the amiibo library
             nfc remove               Remove NFC content from controller state
         """
-        logger.error('NFC Support was removed from joycontrol - see https://github.com/mart1nro/joycontrol/issues/80')
         if controller_state.get_controller() == Controller.JOYCON_L:
             raise ValueError('NFC content cannot be set for JOYCON_L')
         elif not args:
@@ -256,11 +289,16 @@ def _register_commands_with_controller_state(controller_state, cli):
         elif args[0] == 'remove':
             controller_state.set_nfc(None)
             print('Removed nfc content.')
+        elif args[0] == 'list':
+            if amiibo_library is None:
+                raise ValueError('No amiibo library given, see --amiibo_library')
+            print('\n'.join(amiibo_library.list()))
+        elif os.path.isfile(args[0]):
+            controller_state.set_nfc(NFCTag.from_file(args[0]))
+        elif amiibo_library is not None:
+            controller_state.set_nfc(amiibo_library.get(args[0]))
         else:
-            _loop = asyncio.get_event_loop()
-            with open(args[0], 'rb') as nfc_file:
-                content = await _loop.run_in_executor(None, nfc_file.read)
-                controller_state.set_nfc(content)
+            raise ValueError(f'NFC dump {args[0]} not found.')
 
     cli.add_command(nfc.__name__, nfc)
 
@@ -268,31 +306,54 @@ def _register_commands_with_controller_state(controller_state, cli):
 async def _main(args):
     # parse the spi flash
     if args.spi_flash:
-        with open(args.spi_flash, 'rb') as spi_flash_file:
-            spi_flash = FlashMemory(spi_flash_file.read())
+        spi_flash = FlashMemory.from_file(args.spi_flash)
     else:
         # Create memory containing default controller stick calibration
         spi_flash = FlashMemory()
+    # persist flash writes of the Switch (e.g. stick calibration)
+    if args.flash_journal:
+        spi_flash.set_journal(FlashJournal(args.flash_journal))
 
     # Get controller name to emulate from arguments
     controller = Controller.from_arg(args.controller)
 
+    # keeps the last reports in memory, dumped if the connection is lost or on the "dump" command
+    flight_recorder = FlightRecorder(directory=args.flight_recorder) if args.flight_recorder else None
+
+    send_options = SendOptions(priority=args.socket_priority, flushable=True if args.flushable else None,
+                               max_queue_bytes=args.max_send_queue)
+
     with utils.get_output(path=args.log, default=None) as capture_file:
+        if capture_file is not None and args.log_compression is not None:
+            capture_file = ChunkedCaptureWriter(capture_file, compression=args.log_compression)
+
         # prepare the the emulated controller
         factory = controller_protocol_factory(controller, spi_flash=spi_flash)
         ctl_psm, itr_psm = 17, 19
         transport, protocol = await create_hid_server(factory, reconnect_bt_addr=args.reconnect_bt_addr,
                                                       ctl_psm=ctl_psm,
                                                       itr_psm=itr_psm, capture_file=capture_file,
-                                                      device_id=args.device_id)
+                                                      device_id=args.device_id,
+                                                      flight_recorder=flight_recorder,
+                                                      send_options=send_options)
 
         controller_state = protocol.get_controller_state()
 
         # Create command line interface and add some extra commands
         cli = ControllerCLI(controller_state)
-        _register_commands_with_controller_state(controller_state, cli)
+        amiibo_library = AmiiboLibrary(args.amiibo_library) if args.amiibo_library else None
+        _register_commands_with_controller_state(controller_state, cli, amiibo_library=amiibo_library)
         cli.add_command('amiibo', ControllerCLI.deprecated('Command was removed - use "nfc" instead!'))
 
+        if flight_recorder is not None:
+            async def dump():
+                """
+                dump - Writes the reports kept by the flight recorder to a capture file
+                """
+                print(await flight_recorder.dump_async())
+
+            cli.add_command(dump.__name__, dump)
+
         # set default nfc content supplied by argument
         if args.nfc is not None:
             await cli.commands['nfc'](args.nfc)
@@ -303,6 +364,12 @@ async def _main(args):
         finally:
             logger.info('Stopping communication...')
             await transport.close()
+            if isinstance(capture_file, ChunkedCaptureWriter):
+                # writes the index
+                capture_file.close()
+                await asyncio.get_event_loop().run_in_executor(None, capture_file.wait_closed)
+            if spi_flash.get_journal() is not None:
+                spi_flash.get_journal().close()
 
 
 if __name__ == '__main__':
@@ -317,11 +384,24 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('controller', help='JOYCON_R, JOYCON_L or PRO_CONTROLLER')
     parser.add_argument('-l', '--log')
+    parser.add_argument('--log_compression', choices=('none', 'zlib', 'lzma'), default=None,
+                        help='Write the log in the chunked capture format')
     parser.add_argument('-d', '--device_id')
     parser.add_argument('--spi_flash')
+    parser.add_argument('--flash_journal', type=str, default=None,
+                        help='File persisting flash writes of the Switch (e.g. stick calibration) across restarts')
     parser.add_argument('-r', '--reconnect_bt_addr', type=str, default=None,
                         help='The Switch console Bluetooth address, for reconnecting as an already paired controller')
     parser.add_argument('--nfc', type=str, default=None)
+    parser.add_argument('--amiibo_library', type=str, default=None)
+    parser.add_argument('--flight_recorder', type=str, default=None,
+                        help='Directory for dumps of the last reports, written if the connection is lost')
+    parser.add_argument('--socket_priority', type=int, default=None,
+                        help='SO_PRIORITY of the interrupt channel socket')
+    parser.add_argument('--flushable', action='store_true',
+                        help='Mark input reports L2CAP flushable')
+    parser.add_argument('--max_send_queue', type=int, default=None,
+                        help='Hold back input reports while the kernel send queue exceeds this many bytes')
     args = parser.parse_args()
 
     loop = asyncio.get_event_loop()
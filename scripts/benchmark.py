@@ -0,0 +1,936 @@
+import argparse
+import asyncio
+import io
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import tempfile
+import time
+import timeit
+
+from joycontrol.broadcast import StateBroadcaster
+from joycontrol.capture import CaptureWriter, FlightRecorder
+from joycontrol.controller import Controller
+from joycontrol.controller_state import ButtonState, ControllerState, JoyConPairState, SNAPSHOT
+from joycontrol.mcu import MicroControllerUnit, crc8
+from joycontrol.memory import FlashMemory
+from joycontrol.nfc_tag import NFCTag
+from joycontrol.protocol import ControllerProtocol, controller_protocol_factory
+from joycontrol.report import InputReport, OutputReport, OutputReportID, SubCommand
+from joycontrol.rumble import decode_rumble, rumble_magnitudes, RumbleForwarder, NEUTRAL_RUMBLE_DATA
+from joycontrol.scheduler import FanOutScheduler, FrameScheduler
+from joycontrol.shared_state import ControlBlock, ControlBlockInput
+from joycontrol.simulation import DEFAULT_HANDSHAKE, RECONNECT_HANDSHAKE, SimulatedConsole, create_loopback_server, \
+    reconnect_loopback_server
+from joycontrol.transport import HID_CONTROL_EXIT_SUSPEND, HID_CONTROL_SUSPEND, HIDP_GET_REPORT, \
+    HIDP_HID_CONTROL, HIDP_SET_REPORT, L2CAP_Transport, SendOptions
+
+""" joycontrol micro benchmarks. No Bluetooth hardware required.
+
+Usage:
+    benchmark.py <benchmark> [-n <number>]
+    benchmark.py -h | --help
+"""
+
+
+def _report(name, seconds, number):
+    print(f'{name:<40} {seconds / number * 1e6:10.3f} us/op')
+
+
+def _random_rumble(count):
+    rnd = random.Random(0)
+    return [bytes(rnd.randrange(0x100) for _ in range(8)) for _ in range(count)]
+
+
+def bench_rumble(number):
+    data = _random_rumble(256)
+
+    def decode():
+        for d in data:
+            decode_rumble(d)
+
+    def magnitudes():
+        for d in data:
+            rumble_magnitudes(d)
+
+    _report('decode_rumble', timeit.timeit(decode, number=number // 256), number)
+    _report('rumble_magnitudes', timeit.timeit(magnitudes, number=number // 256), number)
+
+    class _Device:
+        def play(self, strong, weak):
+            pass
+
+        def stop(self):
+            pass
+
+    async def flood():
+        # 200Hz of changing rumble for one second, the device should only be written at 1 / min_interval
+        forwarder = RumbleForwarder(_Device())
+        task = asyncio.ensure_future(forwarder.run())
+        for i in range(200):
+            forwarder.submit(data[i % len(data)] if i % 4 else NEUTRAL_RUMBLE_DATA)
+            await asyncio.sleep(0.005)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return forwarder.get_stats()
+
+    stats = asyncio.get_event_loop().run_until_complete(flood())
+    print(f'forwarding at 200Hz: {stats["received"]} received, {stats["coalesced"]} coalesced, '
+          f'{stats["forwarded"]} forwarded, submit decode {stats["decode_mean"] * 1e6:.2f} us, '
+          f'latency {stats["latency_mean"] * 1e3:.2f} ms (max {stats["latency_max"] * 1e3:.2f} ms)')
+
+
+def bench_nfc(number):
+    class _State:
+        def __init__(self, tag):
+            self.tag = tag
+
+        def get_nfc(self):
+            return self.tag
+
+    data = bytes(random.Random(0).randrange(0x100) for _ in range(540))
+    _report('crc8 (312 bytes)', timeit.timeit(lambda: crc8(data[:312]), number=number // 100), number // 100)
+    _report('NFCTag (pre-chunking)', timeit.timeit(lambda: NFCTag(data), number=number // 100), number // 100)
+
+    mcu = MicroControllerUnit(_State(NFCTag(data)))
+    mcu.set_power_state(True)
+    mcu.set_config([0x21, 0x00, 0x04])
+    read = OutputReport()
+    read.set_output_report_id(OutputReportID.REQUEST_IR_NFC_MCU)
+    read.data[11:13] = [0x02, 0x06]
+
+    report = InputReport()
+    report.set_input_report_id(0x31)
+
+    def frame():
+        # streams a tag read every third frame
+        if not mcu.has_data():
+            mcu.received_11(read)
+        report.set_ir_nfc_data(mcu.get_data())
+        bytes(report)
+
+    _report('0x31 frame while reading a tag', timeit.timeit(frame, number=number), number)
+
+
+class _NullTransport:
+    """
+    Transport discarding all writes, used to measure the protocol without a connection
+    """
+    def __init__(self):
+        self.written = 0
+
+    async def write(self, data):
+        self.written += len(data)
+
+    def get_extra_info(self, name, default=None):
+        return {'sockname': ('00:00:00:00:00:00', 19), 'peername': ('00:00:00:00:00:00', 19)}.get(name, default)
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def bench_report_modes(number):
+    for mode in (0x30, 0x31, 0x3F):
+        protocol = ControllerProtocol(Controller.PRO_CONTROLLER, spi_flash=FlashMemory())
+        protocol.connection_made(_NullTransport())
+        protocol._set_input_report_mode(mode)
+        report = protocol.bulk_report
+        buttons = protocol.get_controller_state().button_state
+
+        async def frames():
+            for i in range(number):
+                buttons.a(i & 1 == 0)
+                await protocol.write(report)
+
+        start = time.perf_counter()
+        _run(frames())
+        elapsed = time.perf_counter() - start
+        size = protocol.transport.written // number
+        rate = 1 / protocol.get_frame_interval()
+        _report(f'send 0x{mode:02X} ({size} bytes, max {size * rate / 1000:.1f} kB/s)', elapsed, number)
+
+
+def bench_pairing(number):
+    """
+    Replays the sub commands of a pairing over a socket pair at console pace
+    and measures the CPU time the event loop spends meanwhile.
+    """
+    handshake = (
+        (SubCommand.SET_SHIPMENT_STATE, [0x00]),
+        (SubCommand.SPI_FLASH_READ, [0x00, 0x60, 0x00, 0x00, 0x10]),
+        (SubCommand.SET_INPUT_REPORT_MODE, [0x30]),
+        (SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME, []),
+        (SubCommand.ENABLE_6AXIS_SENSOR, [0x01]),
+        (SubCommand.ENABLE_VIBRATION, [0x01]),
+        (SubCommand.SET_PLAYER_LIGHTS, [0x01]),
+    )
+
+    async def pairing():
+        loop = asyncio.get_event_loop()
+        switch, controller = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        switch.setblocking(False)
+        controller.setblocking(False)
+        # the transport treats a closed control channel as lost connection
+        switch_ctl, ctl = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ctl.setblocking(False)
+
+        protocol = ControllerProtocol(Controller.PRO_CONTROLLER, spi_flash=FlashMemory())
+        transport = L2CAP_Transport(loop, protocol, controller, ctl, 50)
+        protocol.connection_made(transport)
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        for sub_command, data in handshake:
+            report = OutputReport()
+            report.set_output_report_id(OutputReportID.SUB_COMMAND)
+            report.set_sub_command(sub_command)
+            report.set_sub_command_data(data)
+            await loop.sock_sendall(switch, bytes(report))
+            # wait for the reply
+            while (await loop.sock_recv(switch, 400))[1] != 0x21:
+                pass
+            await asyncio.sleep(0.1)
+        # the console idles until the user confirms the controller
+        await asyncio.sleep(1)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+        await transport.close()
+        switch.close()
+        switch_ctl.close()
+        return wall, cpu
+
+    wall, cpu = _run(pairing())
+    print(f'pairing: {wall:.2f} s wall, {cpu:.3f} s cpu ({cpu / wall * 100:.1f}% loop cpu)')
+
+
+class _IdleProtocol:
+    async def report_received(self, data, addr):
+        pass
+
+    def connection_lost(self):
+        pass
+
+
+def bench_send_queue(number):
+    """
+    Degraded link: 60 Hz input reports to a receiver draining 30 reports per second for 3 s.
+    Compares the age of the reports on arrival for sock_sendall and the transport with and without send
+    queue limit. Ignores number.
+    """
+    frames = 180
+    interval = 1 / 60
+    drain_interval = 1 / 30
+
+    async def run(mode):
+        loop = asyncio.get_event_loop()
+        receiver, sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        receiver.setblocking(False)
+        sender.setblocking(False)
+        # the transport treats a closed control channel as lost connection
+        switch_ctl, ctl = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ctl.setblocking(False)
+        transport = None
+        if mode != 'sock_sendall':
+            # about two queued reports, AF_UNIX accounts 768 bytes of socket memory per report
+            send_options = SendOptions(max_queue_bytes=2048 if mode == 'transport, queue limit' else None)
+            transport = L2CAP_Transport(loop, _IdleProtocol(), sender, ctl, 50, send_options=send_options)
+
+        ages = []
+
+        async def drain():
+            while True:
+                data = await loop.sock_recv(receiver, 100)
+                ages.append(time.perf_counter() - struct.unpack_from('d', data, 2)[0])
+                await asyncio.sleep(drain_interval)
+
+        drain_task = asyncio.ensure_future(drain())
+        deadline = time.perf_counter()
+        for _ in range(frames):
+            frame = b'\xA1\x30' + struct.pack('d', time.perf_counter()) + bytes(40)
+            if transport is None:
+                await loop.sock_sendall(sender, frame)
+            else:
+                await transport.write(frame)
+            deadline += interval
+            await asyncio.sleep(max(0, deadline - time.perf_counter()))
+        await asyncio.sleep(0.1)
+        drain_task.cancel()
+
+        stats = transport.get_stats() if transport is not None else None
+        if transport is not None:
+            await transport.close()
+        else:
+            sender.close()
+            ctl.close()
+        receiver.close()
+        switch_ctl.close()
+        return ages, stats
+
+    for mode in ('sock_sendall', 'transport', 'transport, queue limit'):
+        ages, stats = _run(run(mode))
+        print(f'{mode:<24} {len(ages):4} received, age mean {sum(ages) / len(ages) * 1e3:7.1f} ms, '
+              f'max {max(ages) * 1e3:7.1f} ms')
+        if stats is not None:
+            print(f'  {stats}')
+
+
+def bench_console(number):
+    """
+    Connects to a simulated console: handshake time of 10 connections, then the latency from a button change
+    to the console receiving it for 60 changes at random times, with rumble flowing. Ignores number.
+    """
+    rnd = random.Random(0)
+
+    async def connect():
+        console = SimulatedConsole()
+        factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory())
+        transport, protocol = await create_loopback_server(factory, console)
+        scheduler = FrameScheduler([protocol])
+        scheduler_task = asyncio.ensure_future(scheduler.run())
+        await console.handshake_done
+        return console, transport, protocol, scheduler_task
+
+    async def disconnect(console, transport, scheduler_task):
+        scheduler_task.cancel()
+        await console.stop()
+        await transport.close()
+
+    async def handshakes():
+        times = []
+        for _ in range(10):
+            console, transport, _, scheduler_task = await connect()
+            times.append(console.handshake_time)
+            await disconnect(console, transport, scheduler_task)
+        return times
+
+    async def latency():
+        console, transport, protocol, scheduler_task = await connect()
+        buttons = protocol.get_controller_state().button_state
+        latencies = []
+        for i in range(60):
+            await asyncio.sleep(rnd.uniform(0.02, 0.06))
+            pushed = i % 2 == 0
+            buttons.set_button('a', pushed)
+            start = time.perf_counter()
+            report = await console.wait_for_report(
+                lambda _report: _report.buttons is not None and bool(_report.buttons & buttons.to_mask(('a',))) == pushed,
+                timeout=1)
+            latencies.append(report.receive_time - start)
+        stats = console.get_stats()
+        await disconnect(console, transport, scheduler_task)
+        return latencies, stats
+
+    times = _run(handshakes())
+    print(f'handshake ({len(DEFAULT_HANDSHAKE)} sub commands): mean {sum(times) / len(times) * 1e3:.2f} ms, '
+          f'max {max(times) * 1e3:.2f} ms')
+    latencies, stats = _run(latency())
+    print(f'button change to console: mean {sum(latencies) / len(latencies) * 1e3:.2f} ms, '
+          f'max {max(latencies) * 1e3:.2f} ms')
+    print(f'  {stats}')
+
+
+class _SingleReadTransport(L2CAP_Transport):
+    """
+    Previous reader: one receive per wakeup, every report is handled.
+    """
+
+    async def _reader(self):
+        while True:
+            data = await self.read()
+            await self._protocol.report_received(data, self._extra_info['peername'])
+
+
+def bench_rumble_flood(number):
+    """
+    200 Hz rumble in bursts of 4 reports every 20 ms plus a sub command every 100 ms, sent from another thread
+    while the event loop stalls for 8 ms every 50 ms. Rumble is decoded like a rumble forwarder does.
+    Compares the previous single receive reader to the draining one: event loop CPU time, wakeups and the
+    queueing delay until the rumble of each report, or a newer one, was applied. Ignores number.
+    """
+    duration = 3
+
+    async def flood(transport_class):
+        loop = asyncio.get_event_loop()
+        switch, controller = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        controller.setblocking(False)
+        # the transport treats a closed control channel as lost connection
+        switch_ctl, ctl = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ctl.setblocking(False)
+
+        protocol = ControllerProtocol(Controller.PRO_CONTROLLER, spi_flash=FlashMemory())
+        transport = transport_class(loop, protocol, controller, ctl, 50)
+        protocol.connection_made(transport)
+
+        sent_times = []
+        # (send time of the applied rumble, time applied)
+        applied = []
+
+        def apply_rumble(data):
+            decode_rumble(bytes(data))
+            applied.append((struct.unpack('d', bytes(data))[0], time.perf_counter()))
+
+        protocol.set_rumble_listener(apply_rumble)
+
+        async def stall():
+            while True:
+                await asyncio.sleep(0.05)
+                time.sleep(0.008)
+
+        stall_task = asyncio.ensure_future(stall())
+        rumble = OutputReport()
+        rumble.set_output_report_id(OutputReportID.RUMBLE_ONLY)
+        sub_command = OutputReport()
+        sub_command.set_output_report_id(OutputReportID.SUB_COMMAND)
+        sub_command.set_sub_command(SubCommand.SET_PLAYER_LIGHTS)
+        sub_command.set_sub_command_data([0x01])
+
+        def send():
+            # the console side runs in its own thread, reports keep arriving while the loop stalls
+            deadline = time.perf_counter()
+            for burst in range(int(duration / 0.02)):
+                reports = [rumble] * 4 + ([sub_command] if burst % 5 == 0 else [])
+                for report in reports:
+                    sent_time = time.perf_counter()
+                    report.data[3:11] = struct.pack('d', sent_time)
+                    switch.send(bytes(report))
+                    sent_times.append(sent_time)
+                deadline += 0.02
+                time.sleep(max(0, deadline - time.perf_counter()))
+
+        # CPU time of the event loop thread only
+        cpu = time.thread_time()
+        await loop.run_in_executor(None, send)
+        await asyncio.sleep(0.1)
+        cpu = time.thread_time() - cpu
+
+        stall_task.cancel()
+        stats = transport.get_stats()
+        await transport.close()
+        switch.close()
+        switch_ctl.close()
+
+        delays = []
+        index = 0
+        for sent_time in sent_times:
+            while applied[index][0] < sent_time:
+                index += 1
+            delays.append(applied[index][1] - sent_time)
+        return len(sent_times), len(applied), delays, cpu, stats
+
+    for name, transport_class in (('single receive', _SingleReadTransport), ('drain', L2CAP_Transport)):
+        sent, applied, delays, cpu, stats = _run(flood(transport_class))
+        delays.sort()
+        print(f'{name:<16} {sent} sent, {applied} applied, delay mean {sum(delays) / len(delays) * 1e3:.2f} ms '
+              f'p99 {delays[len(delays) * 99 // 100] * 1e3:.2f} ms, loop cpu {cpu * 1e3:.0f} ms')
+        if transport_class is L2CAP_Transport:
+            print(f'  wakeups {stats["reader_wakeups"]}, max batch {stats["max_read_batch"]}, '
+                  f'rumble collapsed {stats["rumble_collapsed"]}')
+
+
+def bench_control_channel(number):
+    """
+    HIDP transactions of a simulated console on the control channel: SET_REPORT and GET_REPORT round trips,
+    suspend, and the time until a closed control channel is noticed as lost connection.
+    """
+    async def control():
+        console = SimulatedConsole(rumble_interval=None)
+        factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory())
+        transport, protocol = await create_loopback_server(factory, console)
+        scheduler_task = asyncio.ensure_future(FrameScheduler([protocol]).run())
+        await console.handshake_done
+        await protocol.flush()
+
+        rumble = OutputReport()
+        rumble.set_output_report_id(OutputReportID.RUMBLE_ONLY)
+        set_report = bytes((HIDP_SET_REPORT | 0x02,)) + bytes(rumble)[1:]
+        get_report = bytes((HIDP_GET_REPORT | 0x01, 0x30))
+        count = min(number, 1000)
+        results = {}
+        for name, message in (('SET_REPORT', set_report), ('GET_REPORT', get_report)):
+            start = time.perf_counter()
+            for _ in range(count):
+                reply = await console.control_transaction(message)
+            results[name] = ((time.perf_counter() - start) / count, reply[:2].hex())
+
+        await console.send_control((HIDP_HID_CONTROL | HID_CONTROL_SUSPEND,))
+        await asyncio.sleep(0.2)
+        received = sum(console.reports_received.values())
+        protocol.get_controller_state().button_state.set_button('a')
+        await asyncio.sleep(0.2)
+        suspended_reports = sum(console.reports_received.values()) - received
+        await console.send_control((HIDP_HID_CONTROL | HID_CONTROL_EXIT_SUSPEND,))
+        report = await console.wait_for_report(lambda _report: _report.buttons, timeout=1)
+
+        start = time.perf_counter()
+        console.close_control_channel()
+        while protocol.transport is not None:
+            await asyncio.sleep(0)
+        detection = time.perf_counter() - start
+
+        scheduler_task.cancel()
+        await console.stop()
+        await transport.close()
+        return results, suspended_reports, report, detection
+
+    results, suspended_reports, report, detection = _run(control())
+    for name, (seconds, reply) in results.items():
+        print(f'{name} round trip {seconds * 1e6:.1f} us (reply {reply})')
+    print(f'suspend: {suspended_reports} reports while suspended, after resume {report}')
+    print(f'closed control channel noticed after {detection * 1e6:.0f} us')
+
+
+def bench_reconnect(number):
+    """
+    Drops the link of a simulated console 10 times while button A is held and the scheduler keeps running,
+    then reconnects the same protocol: time from the drop to the new connection and to the first report
+    with A pushed at the new console. Ignores number.
+    """
+    async def reconnect():
+        console = SimulatedConsole()
+        factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory())
+        transport, protocol = await create_loopback_server(factory, console)
+        scheduler = FrameScheduler([protocol])
+        scheduler_task = asyncio.ensure_future(scheduler.run(stop_when_empty=False))
+        await console.handshake_done
+        button_state = protocol.get_controller_state().button_state
+        button_state.set_button('a')
+        a_mask = button_state.to_mask(('a',))
+
+        times = []
+        for _ in range(10):
+            await asyncio.sleep(0.05)
+            start = time.perf_counter()
+            await console.stop()
+            await protocol.wait_for_connection_lost()
+            await transport.close()
+
+            console = SimulatedConsole(handshake=RECONNECT_HANDSHAKE)
+            transport = await reconnect_loopback_server(protocol, console)
+            scheduler.add(protocol)
+            connected = time.perf_counter() - start
+            report = await console.wait_for_report(
+                lambda _report: _report.report_id == 0x30 and _report.buttons and _report.buttons & a_mask,
+                timeout=2)
+            times.append((connected, report.receive_time - start))
+
+        stats = protocol.get_connection_stats()
+        scheduler_task.cancel()
+        await console.stop()
+        await transport.close()
+        return times, stats
+
+    times, stats = _run(reconnect())
+    for name, values in (('connected', [connected for connected, _ in times]),
+                         ('held button at console', [first for _, first in times])):
+        print(f'drop to {name}: mean {sum(values) / len(values) * 1e3:.2f} ms, max {max(values) * 1e3:.2f} ms')
+    print(f'  {stats}')
+
+
+def bench_fan_out(number):
+    """
+    One input driving 4 simulated consoles: 60 button changes at random times, skew between the first and the
+    last console receiving the change. Compares a controller state per console (an input pipeline each),
+    one shared state sent by a FrameScheduler and the FanOutScheduler encoding one frame per tick. Ignores number.
+    The simulated consoles read in the same event loop one after another, which dominates the skew at the
+    consoles: the FanOutScheduler narrows the send skew, but does not reduce the skew measured at the consoles.
+    """
+    consoles_count = 4
+
+    async def fan_out(mode):
+        rnd = random.Random(0)
+        consoles, transports, protocols = [], [], []
+        for i in range(consoles_count):
+            console = SimulatedConsole(address=f'98:B6:E9:00:00:{i + 1:02X}')
+            shared_state = protocols[0].get_controller_state() if protocols and mode != 'separate' else None
+            factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory(),
+                                                  controller_state=shared_state)
+            transport, protocol = await create_loopback_server(factory, console)
+            consoles.append(console)
+            transports.append(transport)
+            protocols.append(protocol)
+        if mode == 'fan_out':
+            scheduler = FanOutScheduler(protocols[0].get_controller_state(), protocols)
+        else:
+            scheduler = FrameScheduler(protocols)
+        scheduler_task = asyncio.ensure_future(scheduler.run())
+        await asyncio.gather(*(console.handshake_done for console in consoles))
+
+        states = [protocol.get_controller_state() for protocol in protocols]
+        if mode != 'separate':
+            states = states[:1]
+        a_mask = states[0].button_state.to_mask(('a',))
+        skews = []
+        offsets = [0] * consoles_count
+        for i in range(60):
+            await asyncio.sleep(rnd.uniform(0.02, 0.06))
+            pushed = i % 2 == 0
+            for state in states:
+                state.button_state.set_button('a', pushed)
+            reports = await asyncio.gather(*(console.wait_for_report(
+                lambda _report: _report.buttons is not None and bool(_report.buttons & a_mask) == pushed,
+                timeout=1) for console in consoles))
+            times = [report.receive_time for report in reports]
+            skews.append(max(times) - min(times))
+            for j, receive_time in enumerate(times):
+                offsets[j] += (receive_time - min(times)) / 60
+
+        stats = scheduler.get_stats()
+        scheduler_task.cancel()
+        for console, transport in zip(consoles, transports):
+            await console.stop()
+            await transport.close()
+        return skews, offsets, stats
+
+    for mode in ('separate', 'shared', 'fan_out'):
+        skews, offsets, stats = _run(fan_out(mode))
+        print(f'{mode:10} skew at the consoles: mean {sum(skews) / len(skews) * 1e6:7.1f} us, '
+              f'max {max(skews) * 1e6:7.1f} us, mean lag per console '
+              f'{" ".join(f"{offset * 1e6:.0f}" for offset in offsets)} us')
+        if mode == 'fan_out':
+            print(f'  send skew: mean {stats["skew_mean"] * 1e6:.1f} us, max {stats["skew_max"] * 1e6:.1f} us, '
+                  f'{stats["fan_out_frames"]} frames')
+
+
+def bench_buttons(number):
+    _report('ButtonState()', timeit.timeit(lambda: ButtonState(Controller.PRO_CONTROLLER), number=number), number)
+
+    button_state = ButtonState(Controller.PRO_CONTROLLER)
+
+    def toggle():
+        button_state.set_button('a', True)
+        button_state.set_button('a', False)
+
+    _report('set_button', timeit.timeit(toggle, number=number), number * 2)
+
+    buttons = ('a', 'b', 'x', 'y')
+
+    def hold_each():
+        for button in buttons:
+            button_state.set_button(button, True)
+        for button in buttons:
+            button_state.set_button(button, False)
+
+    _report('hold + release 4 buttons (set_button)', timeit.timeit(hold_each, number=number), number)
+
+    def hold_bulk():
+        button_state.set_buttons(buttons)
+        button_state.set_buttons(buttons, pushed=False)
+
+    _report('hold + release 4 buttons (set_buttons)', timeit.timeit(hold_bulk, number=number), number)
+
+    mask = button_state.to_mask(buttons)
+
+    def hold_mask():
+        button_state.set_buttons(mask)
+        button_state.set_buttons(mask, pushed=False)
+
+    _report('hold + release 4 buttons (mask)', timeit.timeit(hold_mask, number=number), number)
+    _report('button bytes', timeit.timeit(lambda: bytes(button_state), number=number), number)
+
+    # the same with the generation tracking of a ControllerState, the bare ButtonState above is the baseline
+    tracked = ControllerState(None, Controller.PRO_CONTROLLER).button_state
+
+    def toggle_tracked():
+        tracked.set_button('a', True)
+        tracked.set_button('a', False)
+
+    _report('set_button (tracked)', timeit.timeit(toggle_tracked, number=number), number * 2)
+
+    def hold_bulk_tracked():
+        tracked.set_buttons(mask)
+        tracked.set_buttons(mask, pushed=False)
+
+    _report('hold + release 4 buttons (mask, tracked)', timeit.timeit(hold_bulk_tracked, number=number), number)
+
+
+def bench_sticks(number):
+    stick = ControllerState(None, Controller.PRO_CONTROLLER, spi_flash=FlashMemory()).l_stick_state
+    _report('bytes (idle stick)', timeit.timeit(lambda: bytes(stick), number=number), number)
+
+    def moving():
+        stick.set_h(stick.get_h() ^ 1)
+        bytes(stick)
+
+    _report('set_h + bytes (moving stick)', timeit.timeit(moving, number=number), number)
+    _report('set_normalized', timeit.timeit(lambda: stick.set_normalized(0.5, -0.25), number=number), number)
+    _report('set_polar', timeit.timeit(lambda: stick.set_polar(45, 0.8), number=number), number)
+    _report('get_normalized', timeit.timeit(stick.get_normalized, number=number), number)
+
+
+def bench_joycon_pair(number):
+    """
+    Drives a combined Joy-Con pair through one scheduler for one second and measures
+    how far apart the left and right input reports of a tick are send.
+    """
+    class _TimedTransport(_NullTransport):
+        def __init__(self):
+            super().__init__()
+            self.times = []
+
+        async def write(self, data):
+            self.times.append(time.perf_counter())
+            await super().write(data)
+
+    async def pair():
+        protocols = []
+        for controller in (Controller.JOYCON_L, Controller.JOYCON_R):
+            protocol = ControllerProtocol(controller, spi_flash=FlashMemory(), combined=True)
+            protocol.connection_made(_TimedTransport())
+            protocol._set_input_report_mode(0x30)
+            protocols.append(protocol)
+        state = JoyConPairState(protocols[0].get_controller_state(), protocols[1].get_controller_state())
+
+        scheduler = FrameScheduler(protocols)
+        task = asyncio.ensure_future(scheduler.run())
+        cpu = time.process_time()
+        for i in range(60):
+            # one input changing both Joy-Cons
+            state.button_state.set_buttons(('l', 'r'), pushed=i % 2 == 0)
+            await asyncio.sleep(1 / 60)
+        cpu = time.process_time() - cpu
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        left, right = (protocol.transport.times for protocol in protocols)
+        return scheduler.get_stats(), [abs(l - r) for l, r in zip(left, right)], cpu
+
+    stats, skew, cpu = _run(pair())
+    print(f'joycon pair: {stats["ticks"]} ticks, {stats["frames"]} frames, {stats["late_ticks"]} late, '
+          f'left/right skew mean {sum(skew) / len(skew) * 1e6:.1f} us, max {max(skew) * 1e6:.1f} us, '
+          f'{cpu * 1e3:.1f} ms cpu')
+
+
+def _produce(name, number):
+    control_block = ControlBlock(name)
+    for i in range(number):
+        control_block.write(i & 0xF, l_stick=(i & 0xFFF, 0x800))
+    control_block.close()
+
+
+def bench_control_block(number):
+    control_block = ControlBlock(create=True)
+    try:
+        protocol = ControllerProtocol(Controller.PRO_CONTROLLER, spi_flash=FlashMemory())
+        control_input = ControlBlockInput(control_block, protocol)
+
+        i = 0
+
+        def write():
+            nonlocal i
+            i += 1
+            control_block.write(i & 0xF, l_stick=(i & 0xFFF, 0x800))
+
+        _report('producer write', timeit.timeit(write, number=number), number)
+
+        def write_and_tick():
+            write()
+            control_input.tick()
+
+        _report('producer write + sender tick', timeit.timeit(write_and_tick, number=number), number)
+        _report('sender tick (no new input)', timeit.timeit(control_input.tick, number=number), number)
+
+        # sender sampling while another process writes as fast as it can
+        producer = multiprocessing.Process(target=_produce, args=(control_block.name, number))
+        producer.start()
+        ticks = 0
+        while producer.is_alive():
+            control_input.tick()
+            ticks += 1
+        producer.join()
+        print(f'concurrent producer: {ticks} ticks, {control_input.torn_reads} torn reads retried')
+
+        queue = multiprocessing.Queue()
+
+        def queue_round_trip():
+            queue.put('a')
+            queue.get()
+
+        _report('multiprocessing.Queue put + get', timeit.timeit(queue_round_trip, number=number // 10), number // 10)
+    finally:
+        control_block.close()
+
+
+def bench_flight_recorder(number):
+    recorder = FlightRecorder()
+    report = bytes(InputReport())
+    mcu_report = bytes(363)
+
+    _report('record (50 byte report)', timeit.timeit(lambda: recorder.record(report), number=number), number)
+    _report('record (363 byte report)', timeit.timeit(lambda: recorder.record(mcu_report), number=number), number)
+
+    start = time.perf_counter()
+    path = recorder.dump(path=os.devnull)
+    print(f'dump of {len(recorder)} reports: {(time.perf_counter() - start) * 1e3:.2f} ms ({path})')
+
+
+class _SlowDisk(io.RawIOBase):
+    """
+    Raw file whose writes stall like a busy SD card.
+    """
+
+    def __init__(self, stall):
+        self.stall = stall
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        time.sleep(self.stall)
+        return len(data)
+
+
+def bench_capture(number):
+    """
+    Capture of 50 byte reports: the previous inline writes against the CaptureWriter, on a temporary file and
+    on a disk stalling 5 ms per write. Reports the mean and the worst single call, the stall the sender sees.
+    """
+    report = bytes(InputReport())
+
+    def direct(capture_file):
+        _time = struct.pack('d', time.time())
+        size = struct.pack('i', len(report))
+        capture_file.write(_time + size + report)
+
+    def measure(name, write, count):
+        worst = 0
+        start = time.perf_counter()
+        for _ in range(count):
+            call_start = time.perf_counter()
+            write()
+            worst = max(worst, time.perf_counter() - call_start)
+        _report(name, time.perf_counter() - start, count)
+        print(f'  worst call {worst * 1e6:.1f} us')
+
+    for disk, count in (('tmp file', number), ('slow disk', number // 10)):
+        def open_file():
+            return tempfile.TemporaryFile() if disk == 'tmp file' else io.BufferedWriter(_SlowDisk(0.005))
+
+        with open_file() as capture_file:
+            measure(f'{disk}: inline pack + write', lambda: direct(capture_file), count)
+
+        with open_file() as capture_file:
+            writer = CaptureWriter(capture_file)
+            measure(f'{disk}: CaptureWriter.write', lambda: writer.write(report), count)
+            writer.close()
+            writer.wait_closed()
+            stats = writer.get_stats()
+            print(f'  {stats["records"]} records, {stats["dropped"]} dropped, {stats["flushes"]} flushes, '
+                  f'flush latency mean {stats["mean_flush_latency"] * 1e3:.2f} ms max '
+                  f'{stats["max_flush_latency"] * 1e3:.2f} ms')
+
+
+def bench_broadcast(number):
+    """
+    Publishes a changing state as fast as possible to a reading subscriber and to one that never reads,
+    and measures the publish cost seen by the frame sender.
+    """
+    async def broadcast():
+        state = ControllerState(None, Controller.PRO_CONTROLLER, spi_flash=FlashMemory())
+        path = os.path.join(tempfile.mkdtemp(), 'state.sock')
+        broadcaster = StateBroadcaster(state, path)
+        await broadcaster.start()
+
+        reader, writer = await asyncio.open_unix_connection(path)
+        stalled_reader, stalled_writer = await asyncio.open_unix_connection(path)
+        received = 0
+
+        async def read():
+            nonlocal received
+            while True:
+                await reader.readexactly(SNAPSHOT.size)
+                received += 1
+
+        read_task = asyncio.ensure_future(read())
+        await asyncio.sleep(0.01)
+
+        publish_time = 0
+        for i in range(number):
+            state.button_state.set_button('a', i % 2 == 0)
+            state.l_stick_state.set_h(i & 0xFFF)
+            start = time.perf_counter()
+            broadcaster.publish()
+            publish_time += time.perf_counter() - start
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+
+        stats = broadcaster.get_stats()
+        read_task.cancel()
+        writer.close()
+        stalled_writer.close()
+        await broadcaster.stop()
+        return publish_time / number, received, stats
+
+    publish, received, stats = _run(broadcast())
+    print(f'broadcast: publish {publish * 1e6:.2f} us, {stats["published"]} published, fast subscriber received '
+          f'{received}, {stats["dropped"]} snapshots replaced by newer ones')
+
+
+def bench_frame_cache(number):
+    """
+    Macro workload: a menu bot cycling through 6 input states, one state change per frame.
+    """
+    states = [(), ('a',), ('down',), ('down', 'a'), ('b',), ('zl', 'r')]
+
+    for cache_size in (0, 64):
+        protocol = ControllerProtocol(Controller.PRO_CONTROLLER, spi_flash=FlashMemory(), frame_cache_size=cache_size)
+        protocol.connection_made(_NullTransport())
+        protocol._set_input_report_mode(0x30)
+        report = protocol.bulk_report
+        state = protocol.get_controller_state()
+
+        async def frames():
+            for i in range(number):
+                state.button_state.replace_buttons(states[i % len(states)])
+                state.l_stick_state.set_normalized_h(0.5 if i % 3 == 0 else 0)
+                await protocol.write(report)
+
+        start = time.perf_counter()
+        _run(frames())
+        elapsed = time.perf_counter() - start
+        stats = protocol.frame_cache.get_stats() if protocol.frame_cache is not None else None
+        _report(f'macro frame, cache size {cache_size}', elapsed, number)
+        if stats is not None:
+            print(f'  {stats["hits"]} hits, {stats["misses"]} misses')
+
+
+BENCHMARKS = {
+    'frame_cache': bench_frame_cache,
+    'broadcast': bench_broadcast,
+    'capture': bench_capture,
+    'flight_recorder': bench_flight_recorder,
+    'control_block': bench_control_block,
+    'control_channel': bench_control_channel,
+    'joycon_pair': bench_joycon_pair,
+    'buttons': bench_buttons,
+    'console': bench_console,
+    'fan_out': bench_fan_out,
+    'pairing': bench_pairing,
+    'reconnect': bench_reconnect,
+    'report_modes': bench_report_modes,
+    'nfc': bench_nfc,
+    'rumble': bench_rumble,
+    'rumble_flood': bench_rumble_flood,
+    'send_queue': bench_send_queue,
+    'sticks': bench_sticks,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS) + ['all'])
+    parser.add_argument('-n', '--number', type=int, default=100000, help='operations per measurement')
+    args = parser.parse_args()
+
+    for name, benchmark in sorted(BENCHMARKS.items()):
+        if args.benchmark in (name, 'all'):
+            print(f'--- {name}')
+            start = time.perf_counter()
+            benchmark(args.number)
+            print(f'({time.perf_counter() - start:.2f} s)')
@@ -0,0 +1,83 @@
+import argparse
+import concurrent.futures
+import os
+import time
+
+from joycontrol.capture import CaptureReader, COMPRESSION, CAPTURE_MAGIC, CAPTURE_VERSION, FILE_HEADER, \
+    RECORD_HEADER, encode_chunk, encode_index
+
+""" Converts a legacy capture (see run_controller_cli.py --log) to the chunked, indexed capture format.
+
+Usage:
+    convert_capture.py <capture_file> <output_file> [--compression <none|zlib|lzma>] [--chunk_size <bytes>]
+    convert_capture.py -h | --help
+"""
+
+
+def _read_buffers(reader, chunk_size):
+    """
+    :returns generator of version 1 record buffers of about chunk_size bytes
+    """
+    buffer = bytearray()
+    for _time, data in reader.records():
+        buffer += RECORD_HEADER.pack(_time, len(data))
+        buffer += data
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer = bytearray()
+    if buffer:
+        yield bytes(buffer)
+
+
+def convert(reader, output, compression, chunk_size):
+    """
+    Compresses the chunks in worker threads (zlib and lzma release the GIL) and writes them in order.
+    :returns number of chunks
+    """
+    output.write(FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+    offset = FILE_HEADER.size
+    chunks = []
+
+    def write(future):
+        nonlocal offset
+        chunk, info = future.result()
+        output.write(chunk)
+        info.offset = offset
+        chunks.append(info)
+        offset += len(chunk)
+
+    workers = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for buffer in _read_buffers(reader, chunk_size):
+            pending.append(executor.submit(encode_chunk, buffer, compression))
+            # bounds the memory use to a few chunks per worker
+            if len(pending) >= 2 * workers:
+                write(pending.pop(0))
+        for future in pending:
+            write(future)
+
+    output.write(encode_index(chunks, offset))
+    return len(chunks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--compression', choices=sorted(COMPRESSION), default='zlib')
+    parser.add_argument('--chunk_size', type=int, default=0x40000,
+                        help='uncompressed bytes per chunk, the granularity of seeking')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(args.capture_file, 'rb') as capture, open(args.output_file, 'wb') as output:
+        reader = CaptureReader(capture)
+        if reader.version != 1:
+            raise ValueError(f'{args.capture_file} is not a legacy capture.')
+        count = convert(reader, output, COMPRESSION[args.compression], args.chunk_size)
+
+    size = os.path.getsize(args.capture_file)
+    converted_size = os.path.getsize(args.output_file)
+    print(f'{count} chunks, {size} -> {converted_size} bytes ({converted_size / max(size, 1):.1%}) '
+          f'in {time.perf_counter() - start:.2f} s')
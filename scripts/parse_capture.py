@@ -1,29 +1,35 @@
 import argparse
-import struct
 
+from joycontrol.capture import CaptureReader
 from joycontrol.report import InputReport, OutputReport, SubCommand
 
-""" joycontrol capture parsing example.
+""" joycontrol capture parsing example. Reads both the legacy and the chunked capture format.
 
 Usage:
-    parse_capture.py <capture_file>
+    parse_capture.py <capture_file> [--start <seconds>] [--end <seconds>]
     parse_capture.py -h | --help
 """
 
 
-def _eof_read(file, size):
+def _get_start_time(reader):
     """
-    Raises EOFError if end of file is reached.
+    :returns time of the first record, None if the capture is empty
     """
-    data = file.read(size)
-    if not data:
-        raise EOFError()
-    return data
+    chunks = reader.get_chunks()
+    if chunks:
+        return chunks[0].start_time
+    for _time, _ in reader.records():
+        return _time
+    return None
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('capture_file')
+    parser.add_argument('--start', type=float, default=None,
+                        help='skip reports before this many seconds after the start of the capture')
+    parser.add_argument('--end', type=float, default=None,
+                        help='skip reports after this many seconds after the start of the capture')
     args = parser.parse_args()
 
     # list of time, report tuples
@@ -31,19 +37,24 @@ if __name__ == '__main__':
     output_reports = []
 
     with open(args.capture_file, 'rb') as capture:
-        try:
-            start_time = None
-            while True:
-                # parse capture time
-                time = struct.unpack('d', _eof_read(capture, 8))[0]
-                if start_time is None:
-                    start_time = time
+        reader = CaptureReader(capture)
+        start_time = _get_start_time(reader)
 
-                # parse data size
-                size = struct.unpack('i', _eof_read(capture, 4))[0]
-                # parse data
-                data = list(_eof_read(capture, size))
+        if reader.version > 1:
+            chunks = reader.get_chunks()
+            print(f'Capture version {reader.version}, {len(chunks)} chunks')
+            for chunk in chunks:
+                print(f'  {chunk.start_time - start_time:10.3f} s - {chunk.end_time - start_time:10.3f} s: '
+                      f'{chunk.records} reports')
 
+        if start_time is not None:
+            # only chunks within the time range are decompressed
+            records = reader.records(
+                start_time=start_time + args.start if args.start is not None else None,
+                end_time=start_time + args.end if args.end is not None else None
+            )
+            for time, data in records:
+                data = list(data)
                 if data[0] == 0xA1:
                     report = InputReport(data)
                     # normalise time
@@ -54,8 +65,6 @@ if __name__ == '__main__':
                     output_reports.append((time - start_time, report))
                 else:
                     raise ValueError(f'Unexpected data.')
-        except EOFError:
-            pass
 
     print('Finished parsing reports.')
     print('Input reports:', len(input_reports))
@@ -3,12 +3,11 @@ import asyncio
 import logging
 import os
 import socket
-import struct
-import time
 
 import hid
 
 from joycontrol import logging_default as log, utils
+from joycontrol.capture import CaptureWriter, ChunkedCaptureWriter
 from joycontrol.device import HidDevice
 from joycontrol.server import PROFILE_PATH
 from joycontrol.utils import AsyncHID
@@ -22,8 +21,28 @@ PRODUCT_ID_PC = 8201
 
 
 class Relay:
-    def __init__(self, capture_file=None):
-        self._capture_file = capture_file
+    def __init__(self, capture_file=None, compression=None):
+        """
+        :param capture_file: opened file the reports are written to
+        :param compression: None for the legacy capture format, otherwise compression of the chunked format
+        """
+        # reports are written by a background thread, the relay never waits for the disk
+        if capture_file is None:
+            self._capture = None
+        elif compression is None:
+            self._capture = CaptureWriter(capture_file)
+        else:
+            self._capture = ChunkedCaptureWriter(capture_file, compression=compression)
+
+    def close(self):
+        """
+        Writes the remaining captured reports.
+        """
+        if self._capture is not None:
+            self._capture.close()
+            self._capture.wait_closed()
+            stats = self._capture.get_stats()
+            logger.info(f'Capture: {stats["records"]} records captured, {stats["dropped"]} dropped')
 
     async def relay_input(self, hid_device, client_itr):
         loop = asyncio.get_event_loop()
@@ -33,11 +52,8 @@ class Relay:
             # add adding byte for input report
             data = b'\xa1' + data
 
-            if self._capture_file is not None:
-                # write data to log file
-                current_time = struct.pack('d', time.time())
-                size = struct.pack('i', len(data))
-                self._capture_file.write(current_time + size + data)
+            if self._capture is not None:
+                self._capture.write(data)
 
             await loop.sock_sendall(client_itr, data)
             await asyncio.sleep(0)
@@ -48,11 +64,8 @@ class Relay:
         while True:
             data = await loop.sock_recv(client_itr, 50)
 
-            if self._capture_file is not None:
-                # write data to log file
-                current_time = struct.pack('d', time.time())
-                size = struct.pack('i', len(data))
-                self._capture_file.write(current_time + size + data)
+            if self._capture is not None:
+                self._capture.write(data)
 
             # remove padding byte for output report (not required when using the hid driver)
             data = data[1:]
@@ -81,7 +94,7 @@ async def get_hid_controller():
     return controller
 
 
-async def _main(capture_file=None, reconnect_bt_addr=None):
+async def _main(capture_file=None, reconnect_bt_addr=None, compression=None):
     loop = asyncio.get_event_loop()
 
     if reconnect_bt_addr == None:
@@ -143,7 +156,7 @@ async def _main(capture_file=None, reconnect_bt_addr=None):
         client_ctl.setblocking(False)
         client_itr.setblocking(False)
 
-    relay = Relay(capture_file)
+    relay = Relay(capture_file, compression=compression)
 
     logger.info('Relaying starting...')
 
@@ -157,6 +170,7 @@ async def _main(capture_file=None, reconnect_bt_addr=None):
         logger.info('Stopping communication...')
         client_itr.close()
         client_ctl.close()
+        relay.close()
 
 
 if __name__ == '__main__':
@@ -166,6 +180,8 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--log', help='log file path for capturing communication')
+    parser.add_argument('--log_compression', choices=('none', 'zlib', 'lzma'), default=None,
+                        help='Write the log in the chunked capture format')
     parser.add_argument('-r', '--reconnect_bt_addr', type=str, default=None,
                         help='The Switch console Bluetooth address, for reconnecting as an already paired controller')
     args = parser.parse_args()
@@ -176,6 +192,7 @@ if __name__ == '__main__':
     with utils.get_output(args.log, default=None) as capture_file:
         loop = asyncio.get_event_loop()
         loop.run_until_complete(
-            _main(capture_file=capture_file, reconnect_bt_addr=args.reconnect_bt_addr)
+            _main(capture_file=capture_file, reconnect_bt_addr=args.reconnect_bt_addr,
+                  compression=args.log_compression)
         )
 
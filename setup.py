@@ -10,7 +10,10 @@ setup(name='joycontrol',
       package_data={'joycontrol': ['profile/sdp_record_hid.xml']},
       zip_safe=False,
       install_requires=[
-          'hid', 'aioconsole', 'dbus-python', 'crc8', 'pygame'
-      ]
+          'hid', 'aioconsole', 'dbus-python', 'pygame'
+      ],
+      extras_require={
+          'rumble': ['evdev']
+      }
       )
 
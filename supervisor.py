@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import time
+
+import bridge
+from joycontrol import logging_default as log, utils
+from joycontrol.capture import FlightRecorder
+from joycontrol.controller import Controller
+from joycontrol.device import HidDevice
+from joycontrol.memory import FlashMemory, share_flash_image, unlink_shared_flash_images
+from joycontrol.pairing import DEFAULT_PATH as PAIRING_CACHE_PATH, PairingCache
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.scheduler import FrameScheduler
+from joycontrol.server import BLUETOOTH_RESTART_COMMAND, PortsInUseError
+
+logger = logging.getLogger(__name__)
+
+"""
+Runs one bridge worker process per Bluetooth adapter, e.g. for 4 players with 4 pads and 4 adapters.
+
+The supervisor discovers the adapters with a single D-Bus call and publishes every flash image once in shared
+memory, the workers attach to them. Workers are pinned to a CPU each and restarted with backoff when they exit.
+If the HID ports are taken by the bluez "input" plugin, the supervisor restarts the bluetooth service once for
+all workers instead of every worker doing it on its own. Workers report their metrics to the supervisor, which
+logs them together with the totals.
+
+Config (JSON):
+    {
+        "workers": [
+            {"adapter": "hci0", "pad": 0, "controller": "PRO_CONTROLLER"},
+            {"adapter": "hci1", "pad": 1, "controller": "JOYCON_L", "spi_flash": "dump.bin", "cpu": 3}
+        ]
+    }
+adapter: hci name or Bluetooth address, pad: joystick number (/dev/input/js<pad>), controller: see Controller.
+Optional: spi_flash memory dump, cpu to pin the worker to (default: the CPUs of the supervisor in turn) and
+console, the Switch to reconnect to (default: pairing cache).
+"""
+
+# exit code of a worker which found the HID ports of its adapter taken
+EXIT_PORTS_IN_USE = 3
+
+METRICS_INTERVAL = 5
+# the bluetooth service restart drops all connections, it is done at most once in this many seconds
+BLUETOOTH_RESTART_INTERVAL = 60
+# seconds the bluetooth service gets to come up after the restart, before workers are started again
+BLUETOOTH_SETTLE_TIME = 1
+
+
+def load_config(path):
+    """
+    :returns worker specifications (dicts) of a config file, see module documentation
+    """
+    with open(path, 'r') as config_file:
+        config = json.load(config_file)
+    specs = []
+    for i, worker in enumerate(config.get('workers', ())):
+        if 'adapter' not in worker:
+            raise ValueError(f'Worker {i} of {path} has no adapter.')
+        specs.append({
+            'adapter': str(worker['adapter']),
+            'pad': int(worker.get('pad', i)),
+            # validated here, workers get the name
+            'controller': Controller.from_arg(worker.get('controller', 'PRO_CONTROLLER')).name,
+            'spi_flash': worker.get('spi_flash'),
+            'cpu': worker.get('cpu'),
+            'console': worker.get('console'),
+        })
+    if not specs:
+        raise ValueError(f'{path} configures no workers.')
+    return specs
+
+
+def resolve_adapters(specs, adapters):
+    """
+    Sets the Bluetooth address of the adapter of each worker, the workers need no adapter discovery of their own.
+    :param adapters: dict of adapter name to address, see HidDevice.get_adapters
+    """
+    addresses = set(adapters.values())
+    for spec in specs:
+        if spec['adapter'] in adapters:
+            spec['address'] = adapters[spec['adapter']]
+        elif spec['adapter'].upper() in addresses:
+            spec['address'] = spec['adapter'].upper()
+        else:
+            raise ValueError(f'Adapter {spec["adapter"]} not found, available: {", ".join(sorted(adapters))}.')
+    used = [spec['address'] for spec in specs]
+    if len(set(used)) != len(used):
+        raise ValueError('An adapter emulates a single controller, each worker needs its own adapter.')
+
+
+def assign_cpus(specs, cpus):
+    """
+    Pins workers without a configured CPU to the given CPUs in turn.
+    """
+    cpus = sorted(cpus)
+    for i, spec in enumerate(specs):
+        if spec['cpu'] is None:
+            spec['cpu'] = cpus[i % len(cpus)]
+
+
+def share_flash_images(specs):
+    """
+    Publishes the flash image of every worker in shared memory, identical images only once.
+    """
+    for spec in specs:
+        if spec['spi_flash']:
+            with open(spec['spi_flash'], 'rb') as spi_flash_file:
+                spec['flash_image'] = share_flash_image(spi_flash_file.read())
+        else:
+            # blank memory, the default stick calibration is added per controller
+            spec['flash_image'] = share_flash_image(b'\xFF' * 0x80000)
+
+
+async def _report_metrics(spec, protocol, scheduler, rumble, metrics_queue):
+    last_frames, last_time = protocol.get_frame_counter(), time.monotonic()
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        frames, now = protocol.get_frame_counter(), time.monotonic()
+        metrics = {
+            'adapter': spec['adapter'],
+            'pid': os.getpid(),
+            'connected': protocol.transport is not None,
+            'reports_sec': (frames - last_frames) / (now - last_time),
+            'rumble_forwarded': rumble.get_stats()['forwarded'] if rumble is not None else 0,
+        }
+        metrics.update(protocol.get_connection_stats())
+        metrics.update(scheduler.get_stats())
+        last_frames, last_time = frames, now
+        metrics_queue.put(metrics)
+
+
+async def _run_worker(spec, metrics_queue):
+    controller = Controller.from_arg(spec['controller'])
+    spi_flash = FlashMemory.from_shared(spec['flash_image'], default_stick_cal=not spec['spi_flash'])
+    factory = controller_protocol_factory(controller, spi_flash=spi_flash)
+    pairing_cache = PairingCache(spec['pairing_cache']) if spec['pairing_cache'] else None
+    flight_recorder = FlightRecorder(directory=spec['flight_recorder']) if spec['flight_recorder'] else None
+
+    # binding to the adapter address needs no D-Bus lookup, the supervisor restarts the bluetooth service if needed.
+    # The pairing cache is keyed by the adapter name like in bridge.py.
+    _, protocol, paired = await bridge.connect_controller(factory, controller, spec['address'], pairing_cache,
+                                                          spec['console'], restart_bluetooth_service=False,
+                                                          adapter=spec['adapter'], flight_recorder=flight_recorder)
+    ns_addr = protocol.transport.get_extra_info('peername')[0]
+    controller_state = protocol.get_controller_state()
+    await controller_state.connect()
+    logger.info(f'{spec["adapter"]}: {controller.device_name()} connected to {ns_addr}'
+                f'{" (new pairing)" if paired else ""}')
+
+    scheduler = FrameScheduler([protocol])
+    scheduler_task = asyncio.ensure_future(scheduler.run(stop_when_empty=False))
+    scheduler_task.add_done_callback(utils.create_error_check_callback(ignore=asyncio.CancelledError))
+    reconnector = asyncio.ensure_future(bridge.keep_connected(protocol, scheduler, ns_addr, spec['address'], 17, 19,
+                                                              pairing_cache, spec['adapter'], flight_recorder))
+    rumble = bridge.start_rumble_forwarding(protocol, spec['pad'])
+    reporter = asyncio.ensure_future(_report_metrics(spec, protocol, scheduler, rumble, metrics_queue))
+    relay = asyncio.ensure_future(bridge.relais(controller_state, spec['pad']))
+    try:
+        # an unplugged controller ends the worker, the restarted worker pairs again
+        done, _ = await asyncio.wait([relay, reconnector], return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        relay.cancel()
+        reconnector.cancel()
+        reporter.cancel()
+        if protocol.transport is not None:
+            await protocol.transport.close()
+
+
+def _worker(spec, metrics_queue):
+    """
+    Entry point of a worker process.
+    """
+    # spawned processes start without the logging configuration of the supervisor
+    log.configure(console_level=logging.INFO)
+    os.sched_setaffinity(0, {spec['cpu']})
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(_run_worker(spec, metrics_queue))
+    except PortsInUseError as err:
+        logger.error(f'{spec["adapter"]}: HID ports in use - {err}')
+        sys.exit(EXIT_PORTS_IN_USE)
+    except KeyboardInterrupt:
+        pass
+
+
+class _Worker:
+    def __init__(self, spec, initial_delay):
+        self.spec = spec
+        self.process = None
+        self.started = None
+        self.next_start = 0
+        self.delay = initial_delay
+        self.restarts = 0
+        self.metrics = None
+
+
+class Supervisor:
+    """
+    Starts a worker process per adapter and restarts exited workers with exponential backoff.
+    """
+
+    def __init__(self, specs, pairing_cache=PAIRING_CACHE_PATH, restart_delay=1.0, max_restart_delay=30.0,
+                 stable_time=60.0, flight_recorder=None):
+        """
+        :param specs: worker specifications, see load_config, resolve_adapters, assign_cpus and share_flash_images
+        :param pairing_cache: pairing cache file shared by the workers, None to disable
+        :param restart_delay: seconds before the first restart of a worker, doubled after every further restart
+        :param max_restart_delay: maximum seconds before a restart
+        :param stable_time: seconds a worker has to run to reset its restart delay
+        :param flight_recorder: directory of the flight recorder dumps of the workers, None to disable recording
+        """
+        # workers start with a fresh interpreter instead of inheriting D-Bus connections and event loops
+        self._context = multiprocessing.get_context('spawn')
+        self._metrics_queue = self._context.Queue()
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._stable_time = stable_time
+        self._workers = []
+        for spec in specs:
+            spec = dict(spec, pairing_cache=pairing_cache, flight_recorder=flight_recorder)
+            self._workers.append(_Worker(spec, restart_delay))
+        self._last_bluetooth_restart = float('-inf')
+        # running bluetooth service restart (subprocess.Popen), the supervise loop does not wait for it
+        self._bluetooth_restart = None
+
+    def _start(self, worker):
+        worker.process = self._context.Process(target=_worker, args=(worker.spec, self._metrics_queue),
+                                               name=f'worker-{worker.spec["adapter"]}', daemon=True)
+        worker.process.start()
+        worker.started = time.monotonic()
+        logger.info(f'Started worker {worker.spec["adapter"]} (pid {worker.process.pid}, cpu {worker.spec["cpu"]})')
+
+    def _exited(self, worker):
+        exitcode = worker.process.exitcode
+        now = time.monotonic()
+        worker.process = None
+        worker.metrics = None
+        if now - worker.started >= self._stable_time:
+            worker.delay = self._restart_delay
+
+        if exitcode == EXIT_PORTS_IN_USE:
+            if now - self._last_bluetooth_restart >= BLUETOOTH_RESTART_INTERVAL:
+                logger.warning('HID ports in use, probably by the bluez "input" plugin - restarting bluetooth '
+                               'once for all workers. Disable the plugin to avoid issues.')
+                try:
+                    self._bluetooth_restart = subprocess.Popen(BLUETOOTH_RESTART_COMMAND.split(),
+                                                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                except OSError as err:
+                    logger.error(f'Restarting bluetooth failed - {err}')
+                self._last_bluetooth_restart = now
+                # started once the restart finished, the other workers lose their connection and reconnect
+                worker.next_start = 0
+                return
+        logger.warning(f'Worker {worker.spec["adapter"]} exited with {exitcode}, '
+                       f'restarting in {worker.delay:.1f} s')
+        worker.next_start = now + worker.delay
+        worker.delay = min(worker.delay * 2, self._max_restart_delay)
+
+    def _bluetooth_restarting(self):
+        """
+        :returns True while the bluetooth service restart is running
+        """
+        if self._bluetooth_restart is None:
+            return False
+        returncode = self._bluetooth_restart.poll()
+        if returncode is None:
+            return True
+        if returncode != 0:
+            logger.error(f'Restarting bluetooth failed with {returncode}')
+        self._bluetooth_restart = None
+        settled = time.monotonic() + BLUETOOTH_SETTLE_TIME
+        for worker in self._workers:
+            worker.next_start = max(worker.next_start, settled)
+        return False
+
+    def _check_workers(self):
+        for worker in self._workers:
+            if worker.process is not None and not worker.process.is_alive():
+                worker.process.join()
+                self._exited(worker)
+            if self._bluetooth_restarting():
+                continue
+            if worker.process is None and time.monotonic() >= worker.next_start:
+                if worker.started is not None:
+                    worker.restarts += 1
+                self._start(worker)
+
+    def _receive_metrics(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                metrics = self._metrics_queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            for worker in self._workers:
+                if worker.spec['adapter'] == metrics['adapter']:
+                    worker.metrics = metrics
+
+    def get_stats(self):
+        """
+        :returns totals over all workers and the last metrics of each worker
+        """
+        metrics = [worker.metrics for worker in self._workers if worker.metrics is not None]
+        return {
+            'workers': len(self._workers),
+            'running': sum(worker.process is not None for worker in self._workers),
+            'connected': sum(m['connected'] for m in metrics),
+            'restarts': sum(worker.restarts for worker in self._workers),
+            'reports_sec': sum(m['reports_sec'] for m in metrics),
+            'late_ticks': sum(m['late_ticks'] for m in metrics),
+            'max_lateness': max((m['max_lateness'] for m in metrics), default=0),
+            'max_recovery_time': max((m['max_recovery_time'] for m in metrics), default=0),
+            'per_worker': {worker.spec['adapter']: worker.metrics for worker in self._workers},
+        }
+
+    def _log_stats(self):
+        stats = self.get_stats()
+        for adapter, metrics in stats['per_worker'].items():
+            if metrics is not None:
+                logger.info(f'{adapter}: {"connected" if metrics["connected"] else "disconnected"}, '
+                            f'{metrics["reports_sec"]:.0f} reports/s, {metrics["connections"]} connections, '
+                            f'{metrics["late_ticks"]} late ticks')
+        logger.info(f'Total: {stats["running"]}/{stats["workers"]} workers running, {stats["connected"]} connected, '
+                    f'{stats["reports_sec"]:.0f} reports/s, {stats["restarts"]} restarts')
+
+    def run(self):
+        """
+        Supervises the workers until interrupted.
+        """
+        next_log = time.monotonic() + METRICS_INTERVAL
+        while True:
+            self._check_workers()
+            self._receive_metrics(0.5)
+            if time.monotonic() >= next_log:
+                self._log_stats()
+                next_log += METRICS_INTERVAL
+
+    def stop(self):
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.terminate()
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join()
+                worker.process = None
+
+
+if __name__ == '__main__':
+    # check if root
+    if not os.geteuid() == 0:
+        raise PermissionError('Script must be run as root!')
+    log.configure(console_level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', help='Worker config (JSON), see supervisor.py')
+    parser.add_argument('--all_adapters', metavar='CONTROLLER',
+                        help='Without config: one worker emulating CONTROLLER per adapter found, pads in order')
+    parser.add_argument('--pairing_cache', default=PAIRING_CACHE_PATH,
+                        help='Pairing cache shared by the workers, empty to disable')
+    parser.add_argument('--flight_recorder', metavar='DIRECTORY',
+                        help='Workers keep their last reports in memory, dumped to DIRECTORY if a connection is lost')
+    args = parser.parse_args()
+
+    adapters = HidDevice.get_adapters()
+    if args.config:
+        specs = load_config(args.config)
+    elif args.all_adapters:
+        controller = Controller.from_arg(args.all_adapters)
+        specs = [{'adapter': name, 'pad': i, 'controller': controller.name, 'spi_flash': None, 'cpu': None,
+                  'console': None}
+                 for i, name in enumerate(sorted(adapters))]
+    else:
+        parser.error('Either --config or --all_adapters is required.')
+    resolve_adapters(specs, adapters)
+    assign_cpus(specs, os.sched_getaffinity(0))
+    share_flash_images(specs)
+
+    supervisor = Supervisor(specs, pairing_cache=args.pairing_cache or None, flight_recorder=args.flight_recorder)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+        unlink_shared_flash_images()